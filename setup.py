@@ -7,9 +7,14 @@ REQUIREMENTS = [
     "typer>=0.3.2",  # CLI
     "fastapi>=0.63.0",  # HTTP API
     "psycopg2>=2.8.6",  # PostgreSQL
-    "uvicorn>=0.13.3",  # HTTP
+    "uvicorn>=0.30.0",  # HTTP, restarts workers on SIGHUP
 ]
 
+EXTRAS = {
+    "async": ["asyncpg>=0.22.0"],  # asyncio PostgreSQL driver
+    "duckdb": ["duckdb>=0.9.0"],  # embedded columnar DB backend
+}
+
 setup(
     name="voucher_selection",
     version="0.0.1",
@@ -17,8 +22,9 @@ setup(
     package_dir={"": "src"},
     include_package_data=True,
     zip_safe=False,
-    python_requires=">=3.7",
+    python_requires=">=3.8",
     install_requires=REQUIREMENTS,
+    extras_require=EXTRAS,
     entry_points={
         "console_scripts": ["voucher_selection=voucher_selection.cli:app"],
     },
@@ -1,6 +1,9 @@
+import subprocess
+import sys
 import tempfile
 from pathlib import Path
 
+import pytest
 from typer.testing import CliRunner
 
 from voucher_selection.cli import app
@@ -123,3 +126,91 @@ def test_cli_db_seed_invalid_missing_env_vars(monkeypatch):
     )
     assert result.exit_code == 1
     assert "Missing env var" in str(result.exception)
+
+
+def test_cli_db_precompute_invalid_input_not_exists():
+    input_file = Path(tempfile.mktemp())
+    result = runner.invoke(app, ["db", "precompute", "--input-jsonl", input_file])
+    assert result.exit_code == 1
+    assert "Input requests not found" in str(result.exception)
+
+
+def test_cli_score_invalid_input_not_exists():
+    input_file = Path(tempfile.mktemp())
+    output_file = Path(tempfile.mktemp())
+    result = runner.invoke(
+        app, ["score", "--input", input_file, "--output", output_file]
+    )
+    assert result.exit_code == 1
+    assert "Input requests not found" in str(result.exception)
+
+
+SEED_CSV_DATA = """\
+timestamp,country_code,last_order_ts,first_order_ts,total_orders,voucher_amount
+2020-05-20 15:43:38+00:00,China,2020-04-19 00:00:00+00:00,2020-04-18 00:00:00+00:00,0,5720
+2020-05-20 15:24:04+00:00,Peru,2020-04-19 00:00:00+00:00,2017-07-24 00:00:00+00:00,2,2640
+2020-05-20 15:02:29+00:00,Peru,2020-04-19 00:00:00+00:00,2019-03-04 00:00:00+00:00,47,2640
+"""
+
+
+@pytest.mark.parametrize("seed_args", [[], ["--replace"], ["--incremental"]])
+def test_cli_db_seed_and_score_sqlite(monkeypatch, tmp_path: Path, seed_args):
+    monkeypatch.setenv("APP_DB_BACKEND", "sqlite")
+    monkeypatch.setenv("APP_DB_PATH", str(tmp_path / "db.sqlite"))
+    input_file = tmp_path / "data.csv"
+    input_file.write_text(SEED_CSV_DATA)
+    result = runner.invoke(
+        app, ["db", "seed", "--input-file", str(input_file), *seed_args]
+    )
+    assert result.exit_code == 0, (result.output, result.exception)
+
+    requests = tmp_path / "requests.jsonl"
+    requests.write_text(
+        '{"customer_id": 1, "country_code": "Peru"}\n'
+        '{"customer_id": 2, "country_code": "Latvia"}\n'
+    )
+    output = tmp_path / "scores.csv"
+    args = ["score", "--input", str(requests), "--output", str(output)]
+    result = runner.invoke(app, [*args, "--workers", "1"])
+    assert result.exit_code == 0, (result.output, result.exception)
+    assert output.read_text().splitlines() == [
+        "customer_id,voucher_amount",
+        "1,2640",
+        "2,",
+    ]
+
+
+# Modules which take most of the startup time, loaded by the commands using them
+HEAVY_MODULES = ["pandas", "numpy", "fastapi", "uvicorn", "psycopg2", "duckdb"]
+IMPORTS_SCRIPT = """\
+import sys
+from voucher_selection.cli import app
+try:
+    app(sys.argv[1:])
+except SystemExit:
+    pass
+print(" ".join(sorted(sys.modules)))
+"""
+
+
+@pytest.mark.parametrize(
+    "args",
+    [
+        ["--help"],
+        ["data", "clean", "--help"],
+        ["db", "seed", "--help"],
+        ["api", "run", "--help"],
+        ["bench", "http", "--help"],
+    ],
+)
+def test_cli_startup_lazy_imports(args):
+    # in a new interpreter, as the tests import all modules
+    result = subprocess.run(
+        [sys.executable, "-c", IMPORTS_SCRIPT, *args],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    modules = result.stdout.splitlines()[-1].split()
+    assert "voucher_selection.cli" in modules
+    assert [name for name in HEAVY_MODULES if name in modules] == []
@@ -1,12 +1,30 @@
+import json
+import os
+import signal
 from pathlib import Path
 from typing import Iterator
 
+import psycopg2
 import pytest
 from fastapi.testclient import TestClient
 from psycopg2.extensions import connection as Connection
 
-from voucher_selection.server.api import get_api_by_connection
-from voucher_selection.server.db import get_db_by_connection
+from voucher_selection.server.api import (
+    create_api,
+    get_api,
+    get_api_by_connection,
+    get_api_by_index,
+    get_api_by_pool,
+    get_api_by_selector,
+)
+from voucher_selection.server.config import DBConfig, ServerConfig
+from voucher_selection.server.db import ConnectionPool, get_db_by_connection
+from voucher_selection.server.index import VoucherIndex
+from voucher_selection.server.selectors import IndexVoucherSelector, PoolVoucherSelector
+
+
+ADMIN_TOKEN = "s3cr3t"
+ADMIN_HEADERS = {"Authorization": f"Bearer {ADMIN_TOKEN}"}
 
 
 @pytest.fixture
@@ -19,12 +37,102 @@ def client(postgresql: Connection, sql_file: Path) -> Iterator[TestClient]:
             yield client
 
 
+def test_api_by_connection_leaves_connection_open(postgresql: Connection):
+    with TestClient(get_api_by_connection(postgresql)) as client:
+        assert client.get("/ping").status_code == 200
+    assert not postgresql.closed
+
+
+def _async_db_config(postgresql: Connection) -> DBConfig:
+    info = postgresql.info
+    return DBConfig(
+        username=info.user,
+        password=info.password or "",
+        host=info.host,
+        port=info.port,
+        database=info.dbname,
+        driver="asyncpg",
+    )
+
+
+@pytest.fixture
+def async_client(postgresql: Connection, sql_file: Path) -> Iterator[TestClient]:
+    with get_db_by_connection(postgresql) as db:
+        db.insert_from_csv(sql_file)
+
+        server_config = ServerConfig(admin_token=ADMIN_TOKEN)
+        api = get_api(_async_db_config(postgresql), server_config)
+        with TestClient(api) as client:
+            yield client
+
+
+@pytest.fixture
+def precomputed_client(postgresql: Connection, sql_file: Path) -> Iterator[TestClient]:
+    with get_db_by_connection(postgresql) as db:
+        db.insert_from_csv(sql_file)
+        db.precompute_segments([(1, 3)], [])
+
+        pool = ConnectionPool(lambda: postgresql, min_size=1, max_size=1)
+        api = get_api_by_pool(pool, precomputed=True)
+        with TestClient(api) as client:
+            yield client
+
+
+@pytest.fixture
+def rollup_client(postgresql: Connection, sql_file: Path) -> Iterator[TestClient]:
+    with get_db_by_connection(postgresql) as db:
+        db.insert_from_file(sql_file, rollup=True)
+
+        pool = ConnectionPool(lambda: postgresql, min_size=1, max_size=1)
+        api = get_api_by_pool(pool, rollup=True)
+        with TestClient(api) as client:
+            yield client
+
+
+@pytest.fixture
+def memory_client(sql_file: Path) -> Iterator[TestClient]:
+    db_config = DBConfig(username="unused", password="unused", host="unused")
+    server_config = ServerConfig(mode="memory", dataset=str(sql_file))
+    api = get_api(db_config, server_config)
+    with TestClient(api) as client:
+        yield client
+
+
+@pytest.fixture
+def cached_client(sql_file: Path) -> Iterator[TestClient]:
+    db_config = DBConfig(username="unused", password="unused", host="unused")
+    server_config = ServerConfig(
+        mode="memory", dataset=str(sql_file), cache_size=2, admin_token=ADMIN_TOKEN
+    )
+    api = get_api(db_config, server_config)
+    with TestClient(api) as client:
+        yield client
+
+
+def test_create_api_connects_on_startup(monkeypatch):
+    monkeypatch.setenv("APP_DB_USERNAME", "unused")
+    monkeypatch.setenv("APP_DB_PASSWORD", "unused")
+    monkeypatch.setenv("APP_DB_HOST", "127.0.0.1")
+    monkeypatch.setenv("APP_DB_PORT", "1")
+    api = create_api()
+    with pytest.raises(psycopg2.OperationalError):
+        with TestClient(api):
+            pass
+
+
 def test_api_ping(client: TestClient):
     r = client.get("/ping")
     assert r.status_code == 200, r.text
     assert r.json() == {"ping": "pong"}
 
 
+def test_api_voucher_ok_multiple_requests(client: TestClient):
+    for _ in range(3):
+        r = client.post("/voucher", json={"country_code": "Latvia"})
+        assert r.status_code == 200, r.text
+        assert r.json() == {"voucher_amount": 5940}
+
+
 def test_api_voucher_invalid_missing_arguments(client: TestClient):
     r = client.post("/voucher")
     assert r.status_code == 422, r.text
@@ -54,7 +162,7 @@ def test_api_voucher_ok_country_code(client: TestClient):
 def test_api_voucher_empty_wrong_country_code(client: TestClient):
     r = client.post("/voucher", json={"country_code": "InVaLiD"})
     assert r.status_code == 204, r.text
-    assert r.json() is None
+    assert r.content == b""
 
 
 def test_api_voucher_ok_frequency_segment(client: TestClient):
@@ -79,11 +187,319 @@ def test_api_voucher_ok_country_code_and_recency_segment(
         "/voucher", json={"country_code": "Latvia", "recency_segment": "10000-20000"}
     )
     assert r.status_code == 204, r.text
-    assert r.json() is None
+    assert r.content == b""
 
 
 def test_api_voucher_ok_recency_segment(client: TestClient, postgresql):
     # TODO: freeze the time and test it properly
     r = client.post("/voucher", json={"recency_segment": "10000-20000"})
     assert r.status_code == 204, r.text
-    assert r.json() is None
+    assert r.content == b""
+
+
+def test_api_async_voucher_ok_multiple_requests(async_client: TestClient):
+    for _ in range(3):
+        r = async_client.post("/voucher", json={"country_code": "Latvia"})
+        assert r.status_code == 200, r.text
+        assert r.json() == {"voucher_amount": 5940}
+
+
+def test_api_async_voucher_ok_country_code_and_frequency_segment(
+    async_client: TestClient,
+):
+    r = async_client.post(
+        "/voucher", json={"country_code": "Latvia", "frequency_segment": "1-3"}
+    )
+    assert r.status_code == 200, r.text
+    assert r.json() == {"voucher_amount": 8800}
+
+
+def test_api_async_voucher_empty_wrong_country_code(async_client: TestClient):
+    r = async_client.post("/voucher", json={"country_code": "InVaLiD"})
+    assert r.status_code == 204, r.text
+    assert r.content == b""
+
+
+def test_api_memory_voucher_ok_country_code_and_frequency_segment(
+    memory_client: TestClient,
+):
+    r = memory_client.post(
+        "/voucher", json={"country_code": "Latvia", "frequency_segment": "1-3"}
+    )
+    assert r.status_code == 200, r.text
+    assert r.json() == {"voucher_amount": 8800}
+
+
+def test_api_memory_voucher_empty_wrong_country_code(memory_client: TestClient):
+    r = memory_client.post("/voucher", json={"country_code": "InVaLiD"})
+    assert r.status_code == 204, r.text
+    assert r.content == b""
+
+
+@pytest.mark.parametrize(
+    "input, voucher_amount",
+    [
+        # precomputed
+        ({"country_code": "Latvia", "frequency_segment": "1-3"}, 8800),
+        ({"frequency_segment": "1-3"}, 5720),
+        # not precomputed
+        ({"country_code": "Latvia", "frequency_segment": "1-2"}, 8800),
+    ],
+)
+def test_api_precomputed_voucher_ok(
+    precomputed_client: TestClient, input: dict, voucher_amount: int
+):
+    r = precomputed_client.post("/voucher", json=input)
+    assert r.status_code == 200, r.text
+    assert r.json() == {"voucher_amount": voucher_amount}
+
+
+def test_api_precomputed_voucher_empty_wrong_country_code(
+    precomputed_client: TestClient,
+):
+    r = precomputed_client.post("/voucher", json={"country_code": "InVaLiD"})
+    assert r.status_code == 204, r.text
+
+
+def test_api_rollup_voucher_ok(rollup_client: TestClient):
+    r = rollup_client.post(
+        "/voucher", json={"country_code": "Latvia", "frequency_segment": "1-3"}
+    )
+    assert r.status_code == 200, r.text
+    assert r.json() == {"voucher_amount": 8800}
+    r = rollup_client.post("/voucher", json={"country_code": "InVaLiD"})
+    assert r.status_code == 204, r.text
+
+
+def test_api_async_rollup_voucher_ok(postgresql: Connection, sql_file: Path):
+    db_config = _async_db_config(postgresql)
+    with get_db_by_connection(postgresql) as db:
+        db.insert_from_file(sql_file, rollup=True)
+
+    api = get_api(db_config, ServerConfig(mode="rollup"))
+    with TestClient(api) as client:
+        r = client.post("/voucher", json={"frequency_segment": "1-3"})
+        assert r.json() == {"voucher_amount": 5720}
+        r = client.post("/voucher", json={"country_code": "InVaLiD"})
+        assert r.status_code == 204, r.text
+        assert 'source="rollup"' in client.get("/metrics").text
+
+
+def test_api_cache_ok(cached_client: TestClient):
+    inputs = [
+        {"country_code": "Latvia"},
+        {"country_code": "Latvia", "frequency_segment": "0-3"},  # same query
+        {"country_code": "InVaLiD"},
+        {"country_code": "InVaLiD"},
+    ]
+    for input in inputs:
+        cached_client.post("/voucher", json=input)
+
+    r = cached_client.get("/cache")
+    assert r.status_code == 200, r.text
+    assert r.json() == {
+        "size": 2,
+        "maxsize": 2,
+        "hits": 2,
+        "misses": 2,
+        "evictions": 0,
+        "expirations": 0,
+    }
+
+    r = cached_client.post("/cache/invalidate")
+    assert r.status_code == 401, r.text
+    assert cached_client.get("/cache").json()["size"] == 2
+
+    r = cached_client.post("/cache/invalidate", headers=ADMIN_HEADERS)
+    assert r.status_code == 200, r.text
+    assert r.json()["size"] == 0
+
+    r = cached_client.post("/voucher", json={"country_code": "Latvia"})
+    assert r.json() == {"voucher_amount": 5940}
+    assert cached_client.get("/cache").json()["misses"] == 3
+
+
+def test_api_reload_memory_invalidates_cache(cached_client: TestClient, sql_file: Path):
+    r = cached_client.post("/voucher", json={"country_code": "Latvia"})
+    assert r.json() == {"voucher_amount": 5940}
+
+    lines = sql_file.read_text().splitlines()
+    sql_file.write_text("\n".join([lines[0], *(ln for ln in lines if "China" in ln)]))
+    r = cached_client.post("/reload", headers=ADMIN_HEADERS)
+    assert r.status_code == 200, r.text
+    assert r.json() == {"reloaded": True}
+
+    r = cached_client.post("/voucher", json={"country_code": "Latvia"})
+    assert r.status_code == 204, r.text
+    assert cached_client.get("/cache").json()["size"] == 1
+
+
+def test_api_reload_requires_admin_token(cached_client: TestClient, sql_file: Path):
+    r = cached_client.post("/reload")
+    assert r.status_code == 401, r.text
+    assert r.headers["WWW-Authenticate"] == "Bearer"
+    r = cached_client.post("/reload", headers={"Authorization": "Bearer invalid"})
+    assert r.status_code == 401, r.text
+
+    # disabled without a token
+    with TestClient(get_api_by_index(lambda: None)) as client:
+        r = client.post("/reload", headers=ADMIN_HEADERS)
+        assert r.status_code == 403, r.text
+
+
+@pytest.mark.skipif(not hasattr(signal, "SIGHUP"), reason="Unix only")
+def test_api_reload_several_workers(sql_file: Path):
+    loads, signals = [], []
+    selector = IndexVoucherSelector(
+        lambda: loads.append(1) or VoucherIndex.from_file(sql_file)
+    )
+    # this process plays the supervisor of the workers
+    api = get_api_by_selector(
+        selector, supervisor_pid=os.getpid(), admin_token=ADMIN_TOKEN
+    )
+    previous = signal.signal(signal.SIGHUP, lambda *args: signals.append(args[0]))
+    try:
+        with TestClient(api) as client:
+            r = client.post("/reload", headers=ADMIN_HEADERS)
+            assert r.status_code == 202, r.text
+            assert r.json() == {"reloaded": False, "restarting": True}
+    finally:
+        signal.signal(signal.SIGHUP, previous)
+    assert signals == [signal.SIGHUP]
+    # not reloaded by this worker, restarted instead
+    assert loads == [1]
+
+
+def test_api_reload_async_after_table_replaced(
+    async_client: TestClient, postgresql: Connection, sql_file: Path
+):
+    r = async_client.post("/voucher", json={"country_code": "Latvia"})
+    assert r.json() == {"voucher_amount": 5940}
+
+    lines = sql_file.read_text().splitlines()
+    sql_file.write_text("\n".join([lines[0], *(ln for ln in lines if "China" in ln)]))
+    with get_db_by_connection(postgresql) as db:
+        db.replace_from_file(sql_file)
+        r = async_client.post("/reload", headers=ADMIN_HEADERS)
+        assert r.status_code == 200, r.text
+
+        r = async_client.post("/voucher", json={"country_code": "Latvia"})
+        assert r.status_code == 204, r.text
+
+
+def test_api_metrics(client: TestClient):
+    client.post("/voucher", json={"country_code": "Latvia"})
+    client.post("/unknown/path")
+    r = client.get("/metrics")
+    assert r.status_code == 200, r.text
+    assert r.headers["content-type"].startswith("text/plain; version=0.0.4")
+    lines = r.text.splitlines()
+    assert "# TYPE voucher_http_request_duration_seconds histogram" in lines
+    for prefix in [
+        'voucher_http_request_duration_seconds_count{method="POST",route="/voucher"',
+        'voucher_http_request_duration_seconds_count{method="POST",route="other",'
+        'status="404"}',
+        'voucher_db_query_duration_seconds_count{query="voucher_amount"}',
+        "voucher_db_pool_wait_seconds_count",
+        'voucher_rows_matched_count{source="db"}',
+    ]:
+        assert any(line.startswith(prefix) for line in lines), prefix
+    assert "voucher_cache_hit_ratio" not in r.text
+    assert "voucher_coalesced_queries_total 1" in lines
+    assert "voucher_coalesced_requests_total 0" in lines
+
+
+def test_api_metrics_cache_hit_ratio(cached_client: TestClient):
+    for _ in range(4):
+        cached_client.post("/voucher", json={"country_code": "Latvia"})
+    lines = cached_client.get("/metrics").text.splitlines()
+    assert "voucher_cache_hits_total 3" in lines
+    assert "voucher_cache_misses_total 1" in lines
+    assert "voucher_cache_hit_ratio 0.75" in lines
+
+
+def test_api_timing_headers(postgresql: Connection, sql_file: Path):
+    with get_db_by_connection(postgresql) as db:
+        db.insert_from_csv(sql_file)
+        pool = ConnectionPool(lambda: postgresql, min_size=1, max_size=1)
+        selector = PoolVoucherSelector(lambda: pool)
+        api = get_api_by_selector(selector, timing_headers=True)
+        with TestClient(api) as client:
+            r = client.post("/voucher", json={"country_code": "Latvia"})
+            assert r.status_code == 200, r.text
+            timings = r.headers["Server-Timing"].split(", ")
+            names = [timing.split(";")[0] for timing in timings]
+            assert names == ["pool", "db", "total"]
+            assert all(";dur=" in timing for timing in timings)
+
+    r = TestClient(get_api_by_index(lambda: None)).get("/ping")
+    assert "Server-Timing" not in r.headers
+
+
+def test_api_cache_disabled(client: TestClient):
+    r = client.get("/cache")
+    assert r.status_code == 404, r.text
+
+
+BATCH_INPUTS = [
+    {"customer_id": 1, "country_code": "Latvia"},
+    {"customer_id": 2, "country_code": "InVaLiD"},
+    {"customer_id": 3, "country_code": "Latvia", "frequency_segment": "1-3"},
+    {"customer_id": 4, "frequency_segment": "1-3"},
+    {"customer_id": 5, "country_code": "Latvia"},
+]
+BATCH_OUTPUTS = [
+    {"customer_id": 1, "voucher_amount": 5940},
+    {"customer_id": 2, "voucher_amount": None},
+    {"customer_id": 3, "voucher_amount": 8800},
+    {"customer_id": 4, "voucher_amount": 5720},
+    {"customer_id": 5, "voucher_amount": 5940},
+]
+
+
+@pytest.mark.parametrize("client_name", ["client", "async_client", "memory_client"])
+def test_api_vouchers_batch_ok_json(request, client_name: str):
+    client = request.getfixturevalue(client_name)
+    r = client.post("/vouchers/batch", json=BATCH_INPUTS)
+    assert r.status_code == 200, r.text
+    assert r.headers["content-type"] == "application/json"
+    assert r.json() == BATCH_OUTPUTS
+
+
+def test_api_vouchers_batch_ok_ndjson(client: TestClient):
+    data = "\n".join(json.dumps(input) for input in BATCH_INPUTS)
+    r = client.post(
+        "/vouchers/batch",
+        data=data,
+        headers={"content-type": "application/x-ndjson"},
+    )
+    assert r.status_code == 200, r.text
+    assert r.headers["content-type"] == "application/x-ndjson"
+    assert [json.loads(line) for line in r.text.splitlines()] == BATCH_OUTPUTS
+
+
+def test_api_vouchers_batch_ok_empty(client: TestClient):
+    r = client.post("/vouchers/batch", json=[])
+    assert r.status_code == 200, r.text
+    assert r.json() == []
+
+
+def test_api_vouchers_batch_ok_cached(cached_client: TestClient):
+    r = cached_client.post("/vouchers/batch", json=BATCH_INPUTS)
+    assert r.json() == BATCH_OUTPUTS
+    stats = cached_client.get("/cache").json()
+    assert stats["misses"] == 4  # distinct parameter sets
+    assert stats["evictions"] == 2
+
+    r = cached_client.post("/vouchers/batch", json=BATCH_INPUTS[2:4])
+    assert r.json() == BATCH_OUTPUTS[2:4]
+    assert cached_client.get("/cache").json()["hits"] == 2
+
+
+@pytest.mark.parametrize(
+    "data", ["{}", "[1, 2]", '[{"frequency_segment": "invalid"}]', "invalid"]
+)
+def test_api_vouchers_batch_invalid_input(client: TestClient, data: str):
+    r = client.post("/vouchers/batch", data=data)
+    assert r.status_code == 422, r.text
+    assert "Invalid input" in r.json()["detail"]
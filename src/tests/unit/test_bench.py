@@ -0,0 +1,132 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import numpy as np
+import pytest
+from psycopg2.extensions import connection as Connection
+
+from voucher_selection.bench import (
+    BENCH_TABLE,
+    bench_data,
+    compare_results,
+    generate_orders,
+    generate_requests,
+    replay,
+    save_results,
+)
+from voucher_selection.data_cleaning import DATA_COLUMNS, clean_orders_raw
+from voucher_selection.server.api import CustomerInput
+from voucher_selection.server.db import DBManager
+
+
+@pytest.fixture
+def server() -> str:
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+            status = 200 if json.loads(body)["customer_id"] % 2 == 0 else 500
+            self.send_response(status)
+            self.send_header("Content-Length", "2")
+            self.end_headers()
+            self.wfile.write(b"{}")
+
+        def log_message(self, *args):
+            pass
+
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}/voucher"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_generate_orders_raw_schema():
+    raw = generate_orders(1000, seed=1)
+    assert list(raw.columns) == DATA_COLUMNS
+    assert len(raw) == 1000
+    for col in ["timestamp", "last_order_ts", "first_order_ts"]:
+        assert str(raw[col].dtype) == "datetime64[ns, UTC]"
+    assert raw["total_orders"].dtype == object
+    assert raw["voucher_amount"].dtype == np.float64
+    assert (raw["total_orders"] == "").any()
+    assert raw["voucher_amount"].isna().any()
+    assert (raw["last_order_ts"] >= raw["first_order_ts"]).all()
+
+    df = clean_orders_raw(raw)
+    assert df["total_orders"].min() >= 0
+    assert (df["voucher_amount"] % 440 == 0).all()
+
+
+def test_generate_orders_seed():
+    assert generate_orders(100, seed=1).equals(generate_orders(100, seed=1))
+    assert not generate_orders(100, seed=1).equals(generate_orders(100, seed=2))
+
+
+def test_generate_requests_valid():
+    requests = generate_requests(100)
+    assert [r["customer_id"] for r in requests] == list(range(100))
+    for request in requests:
+        CustomerInput(**request)
+
+
+def test_bench_data(tmp_path: Path, postgresql: Connection):
+    db = DBManager(postgresql, table=BENCH_TABLE)
+    results = bench_data(generate_orders(100), tmp_path, db=db, repeat=2)
+    assert set(results) == {"clean_orders_raw", "load_csv", "insert_from_csv"}
+    for result in results.values():
+        assert result["rows"] == 100
+        assert result["repeat"] == 2
+        assert 0 < result["best_seconds"] <= result["median_seconds"]
+        assert result["rows_per_second"] > 0
+
+    with postgresql.cursor() as cur:
+        cur.execute("SELECT to_regclass(%s)", (BENCH_TABLE,))
+        assert cur.fetchone()[0] is None
+
+
+def test_replay(server: str):
+    requests = [{"customer_id": i} for i in range(4)]
+    result = replay(server, requests, rps=200, duration=0.1, concurrency=4)
+    assert result["requests"] == 20
+    assert result["errors"] == 10
+    assert result["errors_HTTP 500"] == 10
+    assert 0 < result["p50_ms"] <= result["p95_ms"] <= result["p99_ms"]
+    assert result["p99_ms"] <= result["max_ms"]
+
+
+def test_replay_connection_errors():
+    requests = [{"customer_id": 0}]
+    result = replay("http://127.0.0.1:1/voucher", requests, rps=100, duration=0.05)
+    assert result["errors"] == 5
+    assert "p50_ms" not in result
+
+
+def test_replay_invalid():
+    with pytest.raises(ValueError, match="No requests"):
+        replay("http://127.0.0.1:1/voucher", [], rps=100, duration=1)
+    with pytest.raises(ValueError, match="Invalid rate"):
+        replay("http://127.0.0.1:1/voucher", [{}], rps=0, duration=1)
+
+
+def test_save_results_merges(tmp_path: Path):
+    path = tmp_path / "results.json"
+    save_results(path, {"a": {"rows": 1}, "b": {"rows": 2}})
+    save_results(path, {"b": {"rows": 3}})
+    results = json.loads(path.read_text())
+    assert results["benchmarks"] == {"a": {"rows": 1}, "b": {"rows": 3}}
+    assert "created" in results
+
+
+def test_compare_results():
+    base = {"benchmarks": {"a": {"p99_ms": 10.0, "rows": 5}, "b": {"p99_ms": 1}}}
+    new = {"benchmarks": {"a": {"p99_ms": 15.0, "rows": 5}, "c": {"p99_ms": 1}}}
+    lines = list(compare_results(base, new))
+    assert len(lines) == 2
+    assert lines[0].split()[:2] == ["a", "p99_ms"]
+    assert lines[0].endswith("+50.0%")
+    assert lines[1].endswith("+0.0%")
@@ -0,0 +1,90 @@
+import pytest
+
+from voucher_selection.server.cache import SECONDS_PER_DAY, VoucherCache
+
+
+class FakeClock:
+    def __init__(self, now: float = 10 * SECONDS_PER_DAY):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_cache_invalid_size():
+    with pytest.raises(ValueError, match="Invalid cache size"):
+        VoucherCache(maxsize=0)
+
+
+def test_cache_ok_hit_and_miss():
+    cache = VoucherCache(maxsize=2)
+    with pytest.raises(KeyError):
+        cache.get("a")
+    cache.set("a", 1)
+    cache.set("b", None)
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+    assert cache.stats() == {
+        "size": 2,
+        "maxsize": 2,
+        "hits": 2,
+        "misses": 1,
+        "evictions": 0,
+        "expirations": 0,
+    }
+
+
+def test_cache_evicts_least_recently_used():
+    cache = VoucherCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    with pytest.raises(KeyError):
+        cache.get("b")
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.evictions == 1
+
+
+def test_cache_expires_at_day_boundary():
+    clock = FakeClock()
+    cache = VoucherCache(maxsize=2, clock=clock)
+    clock.now += SECONDS_PER_DAY - 1
+    cache.set("a", 1)
+    clock.now += 0.5
+    assert cache.get("a") == 1
+    clock.now += 0.5
+    with pytest.raises(KeyError):
+        cache.get("a")
+    assert cache.expirations == 1
+
+
+def test_cache_expires_after_ttl():
+    clock = FakeClock()
+    cache = VoucherCache(maxsize=2, ttl=60, clock=clock)
+    cache.set("a", 1)
+    clock.now += 59
+    assert cache.get("a") == 1
+    clock.now += 1
+    with pytest.raises(KeyError):
+        cache.get("a")
+
+
+def test_cache_invalidate():
+    cache = VoucherCache(maxsize=2)
+    cache.set("a", 1)
+    cache.invalidate()
+    assert len(cache) == 0
+    with pytest.raises(KeyError):
+        cache.get("a")
+
+
+def test_cache_set_ignores_values_computed_before_invalidate():
+    cache = VoucherCache(maxsize=2)
+    generation = cache.generation
+    cache.invalidate()
+    cache.set("a", 1, generation=generation)
+    assert len(cache) == 0
+    cache.set("a", 2, generation=cache.generation)
+    assert cache.get("a") == 2
@@ -40,6 +40,11 @@ def test_create_db_config_ok_overload():
         "APP_DB_USERNAME": "db-username",
         "APP_DB_DATABASE": "db-database",
         "APP_DB_TABLE": "db-table",
+        "APP_DB_POOL_MIN_SIZE": "2",
+        "APP_DB_POOL_MAX_SIZE": "50",
+        "APP_DB_POOL_TIMEOUT": "1.5",
+        "APP_DB_POOL_MAX_USES": "1000",
+        "APP_DB_DRIVER": "asyncpg",
     }
     db = create_db_config(env)
     assert db == DBConfig(
@@ -49,19 +54,92 @@ def test_create_db_config_ok_overload():
         username="db-username",
         database="db-database",
         table="db-table",
+        pool_min_size=2,
+        pool_max_size=50,
+        pool_timeout=1.5,
+        pool_max_uses=1000,
+        driver="asyncpg",
     )
 
 
+def test_create_db_config_error_unknown_driver():
+    env = {
+        "APP_DB_HOST": "db-host",
+        "APP_DB_USERNAME": "db-username",
+        "APP_DB_PASSWORD": "db-password",
+        "APP_DB_DRIVER": "invalid",
+    }
+    with pytest.raises(ValueError, match="Unknown DB driver"):
+        create_db_config(env)
+
+
+@pytest.mark.parametrize("backend", ["duckdb", "sqlite"])
+def test_create_db_config_ok_embedded(backend: str):
+    env = {"APP_DB_BACKEND": backend, "APP_DB_PATH": "/tmp/db"}
+    db = create_db_config(env)
+    assert db == DBConfig(backend=backend, path="/tmp/db")
+
+
+def test_create_db_config_error_embedded_require_path():
+    with pytest.raises(ValueError, match="APP_DB_PATH"):
+        create_db_config(env={"APP_DB_BACKEND": "sqlite"})
+
+
+def test_create_db_config_error_unknown_backend():
+    with pytest.raises(ValueError, match="Unknown DB backend"):
+        create_db_config(env={"APP_DB_BACKEND": "invalid"})
+
+
 def test_create_server_config_ok_defaults():
     env = {}
     server = create_server_config(env)
-    assert server == ServerConfig(host="0.0.0.0", port=8080)
+    assert server == ServerConfig(
+        host="0.0.0.0", port=8080, mode="sql", dataset=None, cache_size=0, cache_ttl=0
+    )
 
 
 def test_create_server_config_ok_overload():
     env = {
         "APP_SERVER_HOST": "server.localhost",
         "APP_SERVER_PORT": 80,
+        "APP_SERVER_MODE": "memory",
+        "APP_SERVER_DATASET": "/data/data_clean.csv",
+        "APP_SERVER_COMPACT": "1",
+        "APP_SERVER_CACHE_SIZE": "1000",
+        "APP_SERVER_CACHE_TTL": "60",
+        "APP_SERVER_WORKERS": "8",
+        "APP_SERVER_KEEP_ALIVE": "75",
+        "APP_SERVER_BACKLOG": "4096",
+        "APP_SERVER_GRACEFUL_TIMEOUT": "10",
+        "APP_SERVER_TIMING_HEADERS": "true",
+        "APP_SERVER_COALESCE": "false",
+        "APP_SERVER_ADMIN_TOKEN": "s3cr3t",
     }
     server = create_server_config(env)
-    assert server == ServerConfig(host="server.localhost", port=80)
+    assert server == ServerConfig(
+        host="server.localhost",
+        port=80,
+        mode="memory",
+        dataset="/data/data_clean.csv",
+        compact=True,
+        cache_size=1000,
+        cache_ttl=60.0,
+        workers=8,
+        keep_alive=75,
+        backlog=4096,
+        graceful_timeout=10,
+        timing_headers=True,
+        coalesce=False,
+        admin_token="s3cr3t",
+    )
+    assert "s3cr3t" not in repr(server)
+
+
+def test_create_server_config_error_unknown_mode():
+    with pytest.raises(ValueError, match="Unknown server mode"):
+        create_server_config({"APP_SERVER_MODE": "invalid"})
+
+
+def test_create_server_config_error_invalid_workers():
+    with pytest.raises(ValueError, match="Invalid number of workers"):
+        create_server_config({"APP_SERVER_WORKERS": "0"})
@@ -1,14 +1,22 @@
 import io
+from pathlib import Path
 
+import fastparquet
 import pandas as pd
 import pandas.api.types as ptypes
 import pytest
 
+from voucher_selection.bench import generate_orders
 from voucher_selection.data_cleaning import (
     DATA_COLUMNS,
+    clean_file,
     clean_orders_raw,
+    compact_dtypes,
     convert_str_to_int,
+    convert_to_int,
     load_csv,
+    load_dataset,
+    load_parquet,
 )
 
 
@@ -83,3 +91,97 @@ def test_clean_orders_raw_correct_dtypes(orders_raw: pd.DataFrame):
     assert ptypes.is_datetime64_any_dtype(df["first_order_ts"])
     assert ptypes.is_integer_dtype(df["total_orders"])
     assert ptypes.is_integer_dtype(df["voucher_amount"])
+
+
+def test_convert_to_int_same_as_convert_str_to_int():
+    values = pd.Series(["", None, "0.0", "10.0", "3", float("nan"), 7.0, 2])
+    expected = [convert_str_to_int(v if v == v else 0) for v in values]
+    assert convert_to_int(values).tolist() == expected
+    assert convert_to_int(pd.Series([None, ""], dtype=object)).tolist() == [0, 0]
+
+
+@pytest.mark.parametrize("value", ["10.1", "10,1", "10e-14", "invalid", "inf"])
+def test_convert_to_int_invalid_string(value: str):
+    values = pd.Series(["1.0", value, "", value], name="total_orders")
+    with pytest.raises(ValueError, match=r"column `total_orders` of rows \[1, 3\]"):
+        convert_to_int(values)
+
+
+def test_clean_orders_raw_does_not_modify_input(orders_raw: pd.DataFrame):
+    expected = orders_raw.copy(deep=True)
+    df = clean_orders_raw(orders_raw)
+    pd.testing.assert_frame_equal(orders_raw, expected)
+    assert df["total_orders"].tolist() == [0, 1, 0, 0, 3]
+    assert df["voucher_amount"].tolist() == [5720, 0, 1760, 1762, 0]
+
+
+def test_clean_orders_raw_inplace(orders_raw: pd.DataFrame):
+    df = clean_orders_raw(orders_raw, inplace=True)
+    assert df is orders_raw
+    assert ptypes.is_integer_dtype(orders_raw["total_orders"])
+
+
+@pytest.mark.parametrize("compact", [False, True])
+@pytest.mark.parametrize("suffix", [".csv", ".parquet"])
+@pytest.mark.parametrize("workers", [1, 2])
+def test_clean_file_by_row_groups(
+    orders_raw: pd.DataFrame, tmp_path: Path, workers: int, suffix: str, compact: bool
+):
+    orders_raw["total_orders"] = ["0.0", "1.0", "", None, "3.0"]
+    input_path = tmp_path / "raw.parquet"
+    fastparquet.write(str(input_path), orders_raw, row_group_offsets=2)
+    assert len(fastparquet.ParquetFile(str(input_path)).row_groups) == 3
+    output_path = tmp_path / f"clean{suffix}"
+
+    assert clean_file(input_path, output_path, workers=workers, compact=compact) == 5
+    expected = clean_orders_raw(orders_raw)
+    df = load_dataset(output_path)
+    assert list(df.columns) == DATA_COLUMNS
+    assert ptypes.is_datetime64_any_dtype(df["last_order_ts"])
+    assert ptypes.is_integer_dtype(df["total_orders"])
+    assert df["country_code"].tolist() == expected["country_code"].tolist()
+    assert df["total_orders"].tolist() == expected["total_orders"].tolist()
+    assert df["voucher_amount"].tolist() == expected["voucher_amount"].tolist()
+
+
+def test_compact_dtypes(orders_raw: pd.DataFrame):
+    expected = clean_orders_raw(orders_raw)
+    df = compact_dtypes(expected)
+    assert df is not expected
+    assert ptypes.is_categorical_dtype(df["country_code"])
+    assert ptypes.is_categorical_dtype(df["last_order_ts"])
+    assert df["total_orders"].dtype == "int8"
+    assert df["voucher_amount"].dtype == "int16"
+    assert ptypes.is_datetime64_any_dtype(df["timestamp"])
+    for col in DATA_COLUMNS:
+        assert df[col].tolist() == expected[col].tolist(), col
+    # dates are truncated to the day
+    dates = pd.to_datetime(df["first_order_ts"], utc=True)
+    assert (dates == dates.dt.normalize()).all()
+
+
+def test_compact_dtypes_smaller():
+    df = clean_orders_raw(generate_orders(10000))
+    for col in ["timestamp", "last_order_ts", "first_order_ts"]:
+        df[col] = pd.to_datetime(df[col])
+    before = df.memory_usage(deep=True).sum()
+    assert compact_dtypes(df).memory_usage(deep=True).sum() < before / 4
+
+
+@pytest.mark.parametrize("suffix", [".csv", ".parquet"])
+def test_load_dataset_compact(orders_raw: pd.DataFrame, tmp_path: Path, suffix: str):
+    expected = clean_orders_raw(orders_raw)
+    path = tmp_path / f"clean{suffix}"
+    if suffix == ".parquet":
+        # categories of each row group are merged
+        fastparquet.write(str(path), expected, row_group_offsets=2)
+    else:
+        expected.to_csv(path, index=False)
+    df = load_dataset(path, compact=True)
+    assert ptypes.is_categorical_dtype(df["country_code"])
+    assert ptypes.is_categorical_dtype(df["last_order_ts"])
+    for col in DATA_COLUMNS:
+        assert df[col].tolist() == expected[col].tolist(), col
+    if suffix == ".parquet":
+        df = load_parquet(path, columns=["country_code"], compact=True)
+        assert list(df.columns) == ["country_code"]
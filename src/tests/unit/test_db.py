@@ -1,9 +1,46 @@
+import itertools
+from datetime import timedelta
 from pathlib import Path
 
+import fastparquet
+import pandas as pd
+import psycopg2
 import psycopg2.errors
 import pytest
+from psycopg2.extensions import connection as Connection
 
-from voucher_selection.server.db import DBManager, VoucherSelectionParameters
+from voucher_selection.data_cleaning import load_csv
+from voucher_selection.server.db import (
+    DB_INDEXES,
+    ConnectionPool,
+    DBManager,
+    PreparingConnection,
+    SingleConnectionPool,
+    UpsertResult,
+    VoucherSelectionParameters,
+    build_voucher_amount_query,
+    build_voucher_amounts_query,
+    get_db_by_pool,
+    to_partition_name,
+)
+
+from .test_index import recent_csv_file  # noqa: F401 (fixture)
+from .test_index import (
+    COUNTRY_CODES,
+    FREQUENCY_SEGMENTS,
+    RECENCY_SEGMENTS,
+    RECENT_CSV_DATA,
+    set_timezone,
+)
+
+
+@pytest.fixture
+def pool(postgresql: Connection) -> ConnectionPool:
+    pool = ConnectionPool(
+        lambda: psycopg2.connect(postgresql.dsn), min_size=1, max_size=2, timeout=0.1
+    )
+    yield pool
+    pool.close()
 
 
 def test_create_table_twice(db: DBManager):
@@ -27,6 +64,60 @@ def test_insert_from_csv(db: DBManager, sql_file: Path):
         assert count == 8
 
 
+@pytest.mark.parametrize("suffix", [".csv", ".parquet"])
+def test_insert_from_file_by_batches(
+    db: DBManager, sql_file: Path, tmp_path: Path, suffix: str
+):
+    path = tmp_path / f"data{suffix}"
+    if suffix == ".parquet":
+        fastparquet.write(str(path), load_csv(sql_file))
+    else:
+        path.write_text(sql_file.read_text())
+    assert db.insert_from_file(path, batch_size=3) == 8
+    with db.get_cursor() as cur:
+        cur.execute(
+            f"SELECT country_code, last_order_ts::TEXT, total_orders, voucher_amount "
+            f"FROM {db.table} ORDER BY id"
+        )
+        rows = cur.fetchall()
+    expected = pd.read_csv(sql_file)
+    assert [row[0] for row in rows] == expected["country_code"].tolist()
+    assert {row[1] for row in rows} == {"2020-04-19"}
+    assert [row[2] for row in rows] == expected["total_orders"].tolist()
+    assert [row[3] for row in rows] == expected["voucher_amount"].tolist()
+
+
+@pytest.mark.parametrize("cluster", [False, True])
+def test_insert_from_file_creates_indexes(db: DBManager, sql_file: Path, cluster: bool):
+    db.insert_from_file(sql_file, cluster=cluster)
+    usage = db.get_index_usage()
+    assert [u["name"] for u in usage] == sorted(
+        [db.table, f"{db.table}_pkey", *(f"{db.table}_{name}" for name in DB_INDEXES)]
+    )
+    with db.get_cursor() as cur:
+        cur.execute("SET enable_seqscan = off")
+        params = VoucherSelectionParameters("China", 1, 4)
+        sql, args = build_voucher_amount_query(db.table, params)
+        cur.execute("EXPLAIN " + sql, args)
+        plan = "\n".join(row[0] for row in cur.fetchall())
+    assert f"{db.table}_country_idx" in plan
+
+
+def test_insert_from_file_invalid_rolls_back(db: DBManager, tmp_path: Path):
+    path = tmp_path / "data.csv"
+    path.write_text(
+        "timestamp,country_code,last_order_ts,first_order_ts,total_orders,"
+        "voucher_amount\n"
+        "2020-05-20,Peru,2020-04-19,2020-04-18,1,2640\n"
+        "2020-05-20,Peru,2020-04-19,2020-04-18,1.5,2640\n"
+    )
+    with pytest.raises(psycopg2.errors.InvalidTextRepresentation):
+        db.insert_from_file(path, batch_size=1)
+    with db.get_cursor() as cur:
+        cur.execute(f"SELECT COUNT(*) FROM {db.table}")
+        assert cur.fetchone()[0] == 0
+
+
 def test_get_voucher_amount_ok_country_code(db: DBManager, sql_file: Path):
     db.create_table()
     db.insert_from_csv(sql_file)
@@ -67,6 +158,101 @@ def test_get_voucher_amount_invalid_recency_segment_out_of_range(
         db.get_voucher_amount(params)
 
 
+def test_to_where_clause_binds_values():
+    params = VoucherSelectionParameters("Peru' OR '1'='1", 1, 4, 30, 60)
+    where_clause, args = params.to_where_clause()
+    assert "Peru" not in where_clause
+    assert where_clause.count("%s") == len(args) == 5
+    assert args == ["Peru' OR '1'='1", 30, 60, 1, 4]
+    assert VoucherSelectionParameters().to_where_clause() == ("", [])
+
+
+def test_get_voucher_amount_prepared_once_per_connection(
+    postgresql: Connection, sql_file: Path
+):
+    conn = psycopg2.connect(postgresql.dsn, connection_factory=PreparingConnection)
+    db = DBManager(conn)
+    db.insert_from_file(sql_file)
+    for country_code, expected in [("China", 2493), ("Latvia", 5940), ("X'", None)]:
+        params = VoucherSelectionParameters(country_code=country_code)
+        assert db.get_voucher_amount(params) == expected
+    assert db.get_voucher_amount(VoucherSelectionParameters()) is not None
+    with db.get_cursor() as cur:
+        cur.execute("SELECT COUNT(*) FROM pg_prepared_statements")
+        assert cur.fetchone()[0] == len(conn.prepared) == 2
+    conn.close()
+
+
+# recency segments are in UTC days, whatever the DB session's time zone: in
+# Pacific/Kiritimati (UTC+14) and Pacific/Niue (UTC-11), the local date differs
+# from the UTC date for part of the day, which shifts the boundary by a day
+@pytest.mark.parametrize("timezone", ["UTC", "Pacific/Kiritimati", "Pacific/Niue"])
+def test_get_voucher_amount_recency_boundary_in_utc_days(
+    db: DBManager, tmp_path: Path, timezone: str
+):
+    set_timezone(db, timezone)
+    with db.get_cursor() as cur:
+        cur.execute("SELECT (NOW() AT TIME ZONE 'UTC')::DATE")
+        today = cur.fetchone()[0]
+    # orders at midnight (UTC) of both sides of the boundaries of "30-60"
+    days_ago = {"China": 30, "Latvia": 29, "Peru": 59, "Australia": 60}
+    rows = [
+        f"2020-05-20 15:43:38+00:00,{country_code},"
+        f"{today - timedelta(days=days)} 00:00:00+00:00,"
+        f"2019-01-01 00:00:00+00:00,1,{days * 100}"
+        for country_code, days in days_ago.items()
+    ]
+    csv_file = tmp_path / "data.csv"
+    csv_file.write_text("\n".join([RECENT_CSV_DATA.splitlines()[0], *rows, ""]))
+    db.create_table()
+    db.insert_from_csv(csv_file)
+
+    params_list = [
+        VoucherSelectionParameters(country_code, None, None, 60, 30)
+        for country_code in days_ago
+    ]
+    expected = [3000, None, 5900, None]
+    assert [db.get_voucher_amount(params) for params in params_list] == expected
+    assert db.get_voucher_amounts(params_list) == expected
+
+
+def test_get_voucher_amounts_same_as_single(db: DBManager, sql_file: Path):
+    db.insert_from_csv(sql_file)
+    params_list = [
+        VoucherSelectionParameters(country_code="China"),
+        VoucherSelectionParameters(country_code="InVaLiD"),
+        VoucherSelectionParameters(total_orders_from=1, total_orders_to=1),
+        VoucherSelectionParameters(last_order_from=20000, last_order_to=1),
+        VoucherSelectionParameters(last_order_from=1, last_order_to=2),
+        VoucherSelectionParameters("Latvia", 1, 2, 0, 100000),
+        VoucherSelectionParameters(),
+        VoucherSelectionParameters("Peru", 1, 50, 20000, 1),
+        VoucherSelectionParameters(None, 1, 4, 20000, 1),
+        VoucherSelectionParameters(country_code="China"),
+    ]
+    expected = [db.get_voucher_amount(params) for params in params_list]
+    assert db.get_voucher_amounts(params_list) == expected
+    assert db.get_voucher_amounts([]) == []
+
+
+def test_get_voucher_amounts_uses_indexes(db: DBManager, sql_file: Path):
+    db.insert_from_csv(sql_file)
+    params_list = [
+        VoucherSelectionParameters("China", 1, 4),
+        VoucherSelectionParameters("Peru", 1, 50),
+        VoucherSelectionParameters(total_orders_from=1, total_orders_to=2),
+    ]
+    with db.get_cursor() as cur:
+        cur.execute("SET enable_seqscan = off")
+        sql, args = build_voucher_amounts_query(db.table, params_list)
+        cur.execute("EXPLAIN " + sql, args)
+        plan = "\n".join(row[0] for row in cur.fetchall())
+    # each parameter set is answered by an index scan, none scans the table
+    assert f"{db.table}_country_idx" in plan
+    assert f"{db.table}_total_orders_idx" in plan
+    assert "Seq Scan" not in plan
+
+
 def test_get_voucher_amount_ok_multiple_params(db: DBManager, sql_file: Path):
     db.create_table()
     db.insert_from_csv(sql_file)
@@ -80,3 +266,365 @@ def test_get_voucher_amount_ok_multiple_params(db: DBManager, sql_file: Path):
     )
     voucher = db.get_voucher_amount(params)
     assert voucher == 8800
+
+
+def test_pool_invalid_size():
+    with pytest.raises(ValueError, match="Invalid pool size"):
+        ConnectionPool(lambda: None, min_size=2, max_size=1)
+
+
+def test_pool_reuses_connection(pool: ConnectionPool):
+    with pool.connection() as conn1:
+        pass
+    with pool.connection() as conn2:
+        assert conn2 is conn1
+    assert pool.size == 1
+    assert pool.idle == 1
+
+
+def test_pool_grows_up_to_max_size_then_times_out(pool: ConnectionPool):
+    with pool.connection() as conn1, pool.connection() as conn2:
+        assert conn1 is not conn2
+        assert pool.size == 2
+        with pytest.raises(TimeoutError, match="No free connection"):
+            pool.acquire()
+    assert pool.idle == 2
+
+
+def test_pool_recycles_connection_after_max_uses(postgresql: Connection):
+    pool = ConnectionPool(lambda: psycopg2.connect(postgresql.dsn), max_uses=2)
+    with pool.connection() as conn1:
+        pass
+    with pool.connection() as conn2:
+        assert conn2 is conn1
+    assert conn1.closed
+    with pool.connection() as conn3:
+        assert conn3 is not conn1
+    pool.close()
+
+
+def test_pool_replaces_broken_connection(postgresql: Connection):
+    pool = ConnectionPool(lambda: psycopg2.connect(postgresql.dsn), ping_after=0)
+    with pool.connection() as conn1:
+        pass
+    conn1.close()
+    with pool.connection() as conn2:
+        assert conn2 is not conn1
+        assert not conn2.closed
+    pool.close()
+
+
+def test_pool_rolls_back_on_release(pool: ConnectionPool):
+    with get_db_by_pool(pool) as db:
+        db.create_table()
+        with db.get_cursor() as cur:
+            cur.execute(f"INSERT INTO {db.table} (country_code) VALUES ('Peru')")
+    with get_db_by_pool(pool) as db:
+        with db.get_cursor() as cur:
+            cur.execute(f"SELECT COUNT(*) FROM {db.table}")
+            assert cur.fetchone()[0] == 0
+
+
+def test_get_db_by_pool_keeps_connection_open(pool: ConnectionPool, sql_file: Path):
+    with get_db_by_pool(pool) as db:
+        db.insert_from_csv(sql_file)
+    with get_db_by_pool(pool) as db:
+        params = VoucherSelectionParameters(country_code="China")
+        assert db.get_voucher_amount(params) == 2493
+
+
+def test_single_connection_pool_never_closes_connection(postgresql: Connection):
+    conn = psycopg2.connect(postgresql.dsn)
+    pool = SingleConnectionPool(conn, timeout=0.1)
+    with pool.connection() as conn1:
+        with pytest.raises(TimeoutError, match="No free connection"):
+            pool.acquire()
+    assert conn1 is conn
+    # broken by its owner: not replaced by the same closed connection
+    conn.close()
+    with pytest.raises(psycopg2.InterfaceError, match="connection is closed"):
+        pool.acquire()
+    assert pool.size == 0
+
+    pool = SingleConnectionPool(postgresql)
+    with pool.connection():
+        pass
+    pool.close()
+    assert not postgresql.closed
+
+
+def test_precompute_segments_same_as_query(db: DBManager, sql_file: Path):
+    db.insert_from_csv(sql_file)
+    count = db.precompute_segments([(1, 3), (0, 4)], [(20000, 10)])
+    # countries (4) and all countries, times frequencies (2) and recencies (2)
+    assert count == 5 * 2 * 2
+
+    for country_code in [None, "China", "Latvia", "Peru", "Australia"]:
+        for tof, tot in [(None, None), (1, 3), (0, 4)]:
+            for lof, lot in [(None, None), (20000, 10)]:
+                params = VoucherSelectionParameters(country_code, tof, tot, lof, lot)
+                expected = db.get_voucher_amount(params)
+                assert db.get_precomputed_voucher_amount(params) == expected, params
+
+
+def test_precompute_segments_refresh(db: DBManager, sql_file: Path):
+    db.insert_from_csv(sql_file)
+    db.precompute_segments([(1, 3)], [(20000, 10)])
+    assert db.get_segments() == ([(None, None), (1, 3)], [(None, None), (20000, 10)])
+    db.precompute_segments(*db.get_segments())
+    params = VoucherSelectionParameters(total_orders_from=1, total_orders_to=3)
+    assert db.get_precomputed_voucher_amount(params) == 5720
+
+
+def test_get_precomputed_voucher_amount_not_precomputed(db: DBManager, sql_file: Path):
+    params = VoucherSelectionParameters(total_orders_from=1, total_orders_to=3)
+    with pytest.raises(KeyError, match="not precomputed"):
+        db.get_precomputed_voucher_amount(params)
+
+    db.insert_from_csv(sql_file)
+    db.precompute_segments([], [])
+    with pytest.raises(KeyError, match="not precomputed"):
+        db.get_precomputed_voucher_amount(params)
+
+
+def test_get_precomputed_voucher_amount_outdated(db: DBManager, sql_file: Path):
+    db.insert_from_csv(sql_file)
+    db.precompute_segments([], [])
+    params = VoucherSelectionParameters(country_code="China")
+    assert db.get_precomputed_voucher_amount(params) == 2493
+
+    with db.get_cursor() as cur:
+        sql = f"UPDATE {db.segments_table} SET computed_on = CURRENT_DATE - 1"
+        cur.execute(sql)
+    with pytest.raises(KeyError, match="not precomputed"):
+        db.get_precomputed_voucher_amount(params)
+
+
+def test_replace_from_file_swaps_table(
+    postgresql: Connection, db: DBManager, sql_file: Path, tmp_path: Path
+):
+    db.insert_from_file(sql_file)
+    db.precompute_segments([(1, 3)], [])
+    # another connection which already prepared the query on the old table
+    conn = psycopg2.connect(postgresql.dsn, connection_factory=PreparingConnection)
+    serving = DBManager(conn)
+    params = VoucherSelectionParameters(country_code="China")
+    assert serving.get_voucher_amount(params) == 2493
+    conn.rollback()
+
+    china_only = tmp_path / "china.csv"
+    lines = sql_file.read_text().splitlines()
+    china_only.write_text("\n".join([lines[0], *(ln for ln in lines if "China" in ln)]))
+    for _ in range(2):
+        assert db.replace_from_file(china_only) == 3
+
+    with db.get_cursor() as cur:
+        cur.execute(f"SELECT COUNT(*) FROM {db.table}")
+        assert cur.fetchone()[0] == 3
+    assert [u["name"] for u in db.get_index_usage()] == sorted(
+        [db.table, f"{db.table}_pkey", *(f"{db.table}_{name}" for name in DB_INDEXES)]
+    )
+    assert serving.get_voucher_amount(params) == 2493
+    assert serving.get_voucher_amount(VoucherSelectionParameters()) == 2493
+    segment = VoucherSelectionParameters(total_orders_from=1, total_orders_to=3)
+    assert db.get_precomputed_voucher_amount(segment) is None
+    assert db.get_voucher_amount(segment) is None
+    conn.close()
+
+
+def write_delta_file(sql_file: Path, path: Path) -> Path:
+    """Writes a dataset changing the first row, adding a row, keeping the last
+    row, and repeating the first row (the last value wins).
+    """
+    lines = sql_file.read_text().splitlines()
+    changed = lines[1].replace(",5720", ",880")
+    added = lines[1].replace("15:43:38", "16:00:00").replace(",5720", ",440")
+    path.write_text("\n".join([lines[0], lines[1], added, lines[-1], changed]) + "\n")
+    return path
+
+
+def test_upsert_from_file(db: DBManager, sql_file: Path, tmp_path: Path):
+    assert db.upsert_from_file(sql_file, batch_size=3) == UpsertResult(8, 8, 0)
+    assert db.upsert_from_file(sql_file) == UpsertResult(skipped=True)
+
+    # the same rows read from parquet have the same keys
+    path = tmp_path / "data.parquet"
+    fastparquet.write(str(path), load_csv(sql_file))
+    assert db.upsert_from_file(path) == UpsertResult(8, 0, 0)
+
+    delta = write_delta_file(sql_file, tmp_path / "delta.csv")
+    assert db.upsert_from_file(delta) == UpsertResult(3, 1, 1)
+    with db.get_cursor() as cur:
+        cur.execute(
+            f"SELECT voucher_amount FROM {db.table} "
+            "WHERE country_code = 'China' AND total_orders = 0 ORDER BY id"
+        )
+        assert [row[0] for row in cur.fetchall()] == [880, 0, 440]
+    files = db.get_loaded_files()
+    assert [f["path"] for f in files] == [str(sql_file), str(path), str(delta)]
+    assert [f["inserted"] for f in files] == [8, 0, 1]
+
+
+def test_upsert_from_file_recomputes_segments(
+    db: DBManager, sql_file: Path, tmp_path: Path
+):
+    db.upsert_from_file(sql_file)
+    db.precompute_segments([], [])
+    params = VoucherSelectionParameters(country_code="China")
+    assert db.get_precomputed_voucher_amount(params) == 2493
+
+    db.upsert_from_file(write_delta_file(sql_file, tmp_path / "delta.csv"))
+    assert db.get_precomputed_voucher_amount(params) == 770
+    assert db.get_voucher_amount(params) == 770
+
+
+def test_upsert_from_file_duplicates(db: DBManager, sql_file: Path, tmp_path: Path):
+    db.insert_from_file(sql_file)
+    db.insert_from_file(sql_file)
+    with pytest.raises(ValueError, match="duplicate rows"):
+        db.upsert_from_file(write_delta_file(sql_file, tmp_path / "delta.csv"))
+
+    # replacing records the file, which is then skipped
+    db.replace_from_file(sql_file)
+    assert db.upsert_from_file(sql_file).skipped
+    assert db.upsert_from_file(tmp_path / "delta.csv") == UpsertResult(3, 1, 1)
+
+
+def _assert_rollup_same_as_sql(db: DBManager):
+    non_empty = 0
+    for country_code, (fs_from, fs_to), (rs_from, rs_to) in itertools.product(
+        COUNTRY_CODES, FREQUENCY_SEGMENTS, RECENCY_SEGMENTS
+    ):
+        params = VoucherSelectionParameters(
+            country_code, fs_from, fs_to, rs_from, rs_to
+        )
+        expected = db.get_voucher_amount(params)
+        non_empty += expected is not None
+        assert db.get_rollup_voucher_amount(params) == expected, params
+    assert non_empty > 50
+
+
+def test_rollup_same_as_sql(db: DBManager, recent_csv_file: Path):  # noqa: F811
+    db.insert_from_file(recent_csv_file)
+    with pytest.raises(KeyError, match="Rollup not built"):
+        db.get_rollup_voucher_amount(VoucherSelectionParameters())
+    db.build_rollup()
+    _assert_rollup_same_as_sql(db)
+    with db.get_cursor() as cur:
+        cur.execute(f"SELECT COUNT(*), SUM(orders) FROM {db.rollup_table}")
+        assert cur.fetchone() == (9, 9)
+
+
+def test_rollup_kept_up_to_date(
+    db: DBManager, sql_file: Path, recent_csv_file: Path, tmp_path: Path  # noqa: F811
+):
+    db.insert_from_file(sql_file, rollup=True)
+    _assert_rollup_same_as_sql(db)
+    # appended
+    db.insert_from_file(recent_csv_file)
+    _assert_rollup_same_as_sql(db)
+    # swapped with the table
+    db.replace_from_file(recent_csv_file)
+    _assert_rollup_same_as_sql(db)
+    assert db.has_rollup()
+    # upserted
+    db.upsert_from_file(write_delta_file(sql_file, tmp_path / "delta.csv"))
+    _assert_rollup_same_as_sql(db)
+    db.build_rollup()
+    _assert_rollup_same_as_sql(db)
+
+
+def test_partitioned_same_as_sql(
+    db: DBManager, recent_csv_file: Path, tmp_path: Path  # noqa: F811
+):
+    path = tmp_path / "data.csv"
+    # rows without country are kept in the default partition
+    path.write_text(recent_csv_file.read_text() + "2020-05-20,,2020-04-19,,1,440\n")
+    db.insert_from_file(path)
+    partitioned = DBManager(db._conn, table="voucher_selection_partitioned")
+    assert partitioned.insert_from_file(path, batch_size=4, partitioned=True) == 10
+    assert partitioned.is_partitioned() and not db.is_partitioned()
+    assert partitioned.get_partitions() == {
+        country: to_partition_name(partitioned.table, country)
+        for country in ["Australia", "China", "Latvia", "Peru", None]
+    }
+    for country_code, (fs_from, fs_to), (rs_from, rs_to) in itertools.product(
+        COUNTRY_CODES, FREQUENCY_SEGMENTS, RECENCY_SEGMENTS
+    ):
+        params = VoucherSelectionParameters(
+            country_code, fs_from, fs_to, rs_from, rs_to
+        )
+        expected = db.get_voucher_amount(params)
+        assert partitioned.get_voucher_amount(params) == expected, params
+
+    # queries by country only scan the partition of the country
+    with db.get_cursor() as cur:
+        params = VoucherSelectionParameters("Peru", 1, 4)
+        sql, args = build_voucher_amount_query(partitioned.table, params)
+        cur.execute("EXPLAIN " + sql, args)
+        plan = "\n".join(row[0] for row in cur.fetchall())
+    assert to_partition_name(partitioned.table, "Peru") in plan
+    assert to_partition_name(partitioned.table, "China") not in plan
+
+
+def test_partition_name():
+    assert to_partition_name("t", "Peru") == to_partition_name("t", "Peru")
+    assert to_partition_name("t", "Peru").startswith("t_p_peru_")
+    assert to_partition_name("t", "peru") != to_partition_name("t", "Peru")
+    assert to_partition_name("t", None) == "t_p_default"
+    assert len(to_partition_name("t", "x" * 100)) < 40
+
+
+def test_replace_partitions_from_file(db: DBManager, sql_file: Path, tmp_path: Path):
+    db.insert_from_file(sql_file, partitioned=True, rollup=True)
+    china = VoucherSelectionParameters(country_code="China")
+    peru = VoucherSelectionParameters(country_code="Peru")
+    assert db.get_voucher_amount(peru) == 2640
+
+    path = tmp_path / "peru.csv"
+    path.write_text(
+        "timestamp,country_code,last_order_ts,first_order_ts,total_orders,"
+        "voucher_amount\n"
+        "2020-05-20,Peru,2020-04-19,2020-04-18,1,440\n"
+        "2020-05-20,Peru,2020-04-19,2020-04-18,2,440\n"
+        "2020-05-20,Vietnam,2020-04-19,2020-04-18,2,880\n"
+    )
+    with db.get_cursor() as cur:
+        cur.execute(
+            "SELECT to_regclass(%s)::oid", (to_partition_name(db.table, "China"),)
+        )
+        china_oid = cur.fetchone()[0]
+    assert db.replace_partitions_from_file(path) == 3
+
+    with db.get_cursor() as cur:
+        cur.execute(f"SELECT country_code, COUNT(*) FROM {db.table} GROUP BY 1")
+        counts = dict(cur.fetchall())
+        cur.execute(
+            "SELECT to_regclass(%s)::oid", (to_partition_name(db.table, "China"),)
+        )
+        assert cur.fetchone()[0] == china_oid
+        cur.execute("SELECT to_regclass(%s)", (f"{db.table}_staging",))
+        assert cur.fetchone()[0] is None
+    assert counts == {"Australia": 1, "China": 3, "Latvia": 2, "Peru": 2, "Vietnam": 1}
+    assert db.get_voucher_amount(china) == 2493
+    assert db.get_voucher_amount(peru) == 440
+    _assert_rollup_same_as_sql(db)
+
+    # stays partitioned when replaced entirely
+    db.replace_from_file(sql_file)
+    assert db.is_partitioned()
+    assert set(db.get_partitions()) == {"Australia", "China", "Latvia", "Peru"}
+    assert db.get_voucher_amount(peru) == 2640
+    _assert_rollup_same_as_sql(db)
+
+
+def test_partitioned_unsupported(db: DBManager, sql_file: Path):
+    db.insert_from_file(sql_file)
+    with pytest.raises(ValueError, match="not partitioned"):
+        db.replace_partitions_from_file(sql_file)
+    with pytest.raises(ValueError, match="not partitioned"):
+        db.insert_from_file(sql_file, partitioned=True)
+
+    db.replace_from_file(sql_file, partitioned=True)
+    with pytest.raises(ValueError, match="is partitioned"):
+        db.upsert_from_file(sql_file)
@@ -0,0 +1,201 @@
+import itertools
+from pathlib import Path
+from typing import Iterator
+
+import fastparquet
+import pytest
+from fastapi.testclient import TestClient
+
+from voucher_selection.data_cleaning import load_csv
+from voucher_selection.server.api import get_api
+from voucher_selection.server.config import DBConfig, ServerConfig
+from voucher_selection.server.db import (
+    DBManager,
+    UpsertResult,
+    VoucherSelectionParameters,
+    open_db,
+)
+from voucher_selection.server.db_embedded import EmbeddedDBManager
+
+from .test_api import ADMIN_HEADERS, ADMIN_TOKEN
+from .test_db import write_delta_file
+from .test_index import recent_csv_file  # noqa: F401 (fixture)
+from .test_index import (
+    COUNTRY_CODES,
+    FREQUENCY_SEGMENTS,
+    RECENCY_SEGMENTS,
+    set_timezone,
+)
+
+
+BACKENDS = ["duckdb", "sqlite"]
+
+
+def _db_config(tmp_path: Path, backend: str) -> DBConfig:
+    return DBConfig(backend=backend, path=str(tmp_path / f"db.{backend}"))
+
+
+@pytest.fixture(params=BACKENDS)
+def embedded_db(tmp_path: Path, request) -> Iterator[EmbeddedDBManager]:
+    with open_db(_db_config(tmp_path, request.param)) as db:
+        yield db
+
+
+def _all_params() -> Iterator[VoucherSelectionParameters]:
+    for country_code, (fs_from, fs_to), (rs_from, rs_to) in itertools.product(
+        COUNTRY_CODES, FREQUENCY_SEGMENTS, RECENCY_SEGMENTS
+    ):
+        yield VoucherSelectionParameters(
+            country_code=country_code,
+            total_orders_from=fs_from,
+            total_orders_to=fs_to,
+            last_order_from=rs_from,
+            last_order_to=rs_to,
+        )
+
+
+def _assert_same_as_sql(db: DBManager, embedded_db: EmbeddedDBManager):
+    params_list = list(_all_params())
+    expected = [db.get_voucher_amount(params) for params in params_list]
+    assert sum(value is not None for value in expected) > 50
+    for params, value in zip(params_list, expected):
+        assert embedded_db.get_voucher_amount(params) == value, params
+    assert embedded_db.get_voucher_amounts(params_list) == expected
+
+
+@pytest.mark.parametrize("timezone", ["UTC", "Pacific/Kiritimati"])
+def test_embedded_same_as_sql(
+    db: DBManager,
+    embedded_db: EmbeddedDBManager,
+    recent_csv_file: Path,  # noqa: F811
+    timezone: str,
+):
+    set_timezone(db, timezone)
+    db.insert_from_csv(recent_csv_file)
+    assert embedded_db.insert_from_file(recent_csv_file, batch_size=4) == 9
+    _assert_same_as_sql(db, embedded_db)
+
+
+def test_embedded_parquet_same_as_sql(
+    tmp_path: Path,
+    db: DBManager,
+    embedded_db: EmbeddedDBManager,
+    recent_csv_file: Path,  # noqa: F811
+):
+    path = tmp_path / "data.parquet"
+    fastparquet.write(str(path), load_csv(recent_csv_file), write_index=False)
+    db.insert_from_csv(recent_csv_file)
+    assert embedded_db.insert_from_file(path) == 9
+    _assert_same_as_sql(db, embedded_db)
+
+
+@pytest.mark.parametrize("suffix", [".parquet", ".csv"])
+def test_duckdb_attach_file_same_as_sql(
+    tmp_path: Path, db: DBManager, recent_csv_file: Path, suffix: str  # noqa: F811
+):
+    path = tmp_path / f"data{suffix}"
+    if suffix == ".parquet":
+        fastparquet.write(str(path), load_csv(recent_csv_file), write_index=False)
+    else:
+        path.write_text(recent_csv_file.read_text())
+    db.insert_from_csv(recent_csv_file)
+    with open_db(_db_config(tmp_path, "duckdb")) as embedded_db:
+        embedded_db.insert_from_csv(recent_csv_file)
+        # replaces the table
+        embedded_db.attach_file(path)
+        _assert_same_as_sql(db, embedded_db)
+
+
+def test_sqlite_attach_file_unsupported(tmp_path: Path, sql_file: Path):
+    with open_db(_db_config(tmp_path, "sqlite")) as embedded_db:
+        with pytest.raises(ValueError, match="requires the duckdb backend"):
+            embedded_db.attach_file(sql_file)
+
+
+def test_embedded_replace(embedded_db: EmbeddedDBManager, sql_file: Path):
+    params = VoucherSelectionParameters(country_code="Peru")
+    embedded_db.insert_from_file(sql_file)
+    embedded_db.insert_from_file(sql_file)
+    with embedded_db.get_cursor() as cur:
+        cur.execute(f"SELECT COUNT(*) FROM {embedded_db.table}")
+        assert cur.fetchone()[0] == 16
+
+    assert embedded_db.replace_from_file(sql_file) == 8
+    with embedded_db.get_cursor() as cur:
+        cur.execute(f"SELECT COUNT(*) FROM {embedded_db.table}")
+        assert cur.fetchone()[0] == 8
+    assert embedded_db.get_voucher_amount(params) == 2640
+
+
+def test_embedded_rollback_invalid_file(
+    embedded_db: EmbeddedDBManager, sql_file: Path, tmp_path: Path
+):
+    embedded_db.insert_from_file(sql_file)
+    invalid = tmp_path / "invalid.csv"
+    invalid.write_text(sql_file.read_text() + "2020-05-20,Peru,,,x,1\n")
+    with pytest.raises(ValueError):
+        embedded_db.replace_from_file(invalid, batch_size=2)
+    with embedded_db.get_cursor() as cur:
+        cur.execute(f"SELECT COUNT(*) FROM {embedded_db.table}")
+        assert cur.fetchone()[0] == 8
+
+
+def test_embedded_upsert_same_as_sql(
+    db: DBManager, embedded_db: EmbeddedDBManager, sql_file: Path, tmp_path: Path
+):
+    delta = write_delta_file(sql_file, tmp_path / "delta.csv")
+    for path in [sql_file, delta]:
+        expected = db.upsert_from_file(path)
+        assert embedded_db.upsert_from_file(path) == expected
+    assert embedded_db.upsert_from_file(delta) == UpsertResult(skipped=True)
+    assert [f["inserted"] for f in embedded_db.get_loaded_files()] == [8, 1]
+    _assert_same_as_sql(db, embedded_db)
+
+
+def test_embedded_upsert_duplicates(embedded_db: EmbeddedDBManager, sql_file: Path):
+    embedded_db.insert_from_file(sql_file)
+    embedded_db.insert_from_file(sql_file)
+    with pytest.raises(ValueError, match="duplicate rows"):
+        embedded_db.upsert_from_file(sql_file)
+
+    embedded_db.replace_from_file(sql_file)
+    assert embedded_db.upsert_from_file(sql_file).skipped
+
+
+def test_duckdb_upsert_attached_file_unsupported(tmp_path: Path, sql_file: Path):
+    with open_db(_db_config(tmp_path, "duckdb")) as embedded_db:
+        embedded_db.attach_file(sql_file)
+        with pytest.raises(ValueError, match="in place"):
+            embedded_db.upsert_from_file(sql_file)
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+@pytest.mark.parametrize("mode", ["sql", "memory"])
+def test_api_embedded(tmp_path: Path, sql_file: Path, backend: str, mode: str):
+    db_config = _db_config(tmp_path, backend)
+    with open_db(db_config) as db:
+        db.insert_from_file(sql_file)
+
+    api = get_api(db_config, ServerConfig(mode=mode, admin_token=ADMIN_TOKEN))
+    with TestClient(api) as client:
+        r = client.post("/voucher", json={"country_code": "Peru"})
+        assert r.json() == {"voucher_amount": 2640}
+        r = client.post("/vouchers/batch", json=[{"country_code": "China"}, {}])
+        assert [v["voucher_amount"] for v in r.json()] == [2493, 3457]
+        r = client.post("/voucher", json={"country_code": "InVaLiD"})
+        assert r.status_code == 204, r.text
+
+        if backend == "sqlite":
+            # readers are not blocked by the writer
+            with open_db(db_config) as db:
+                db.replace_from_file(sql_file)
+            r = client.post("/reload", headers=ADMIN_HEADERS)
+            assert r.status_code == 200, r.text
+            r = client.post("/voucher", json={"country_code": "Peru"})
+            assert r.json() == {"voucher_amount": 2640}
+
+
+def test_api_embedded_precomputed_unsupported(tmp_path: Path):
+    db_config = _db_config(tmp_path, "sqlite")
+    with pytest.raises(ValueError, match="requires the postgres backend"):
+        get_api(db_config, ServerConfig(mode="precomputed"))
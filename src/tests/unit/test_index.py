@@ -0,0 +1,91 @@
+import itertools
+from datetime import date, timedelta
+from pathlib import Path
+
+import pytest
+
+from voucher_selection.server.db import DBManager, VoucherSelectionParameters
+from voucher_selection.server.index import VoucherIndex
+
+
+def _days_ago(days: int) -> str:
+    return f"{date.today() - timedelta(days=days)} 00:00:00+00:00"
+
+
+RECENT_CSV_DATA = f"""\
+timestamp,country_code,last_order_ts,first_order_ts,total_orders,voucher_amount
+2020-05-20 15:43:38+00:00,China,{_days_ago(3)},2020-04-18 00:00:00+00:00,0,5720
+2020-05-20 15:43:47+00:00,Latvia,{_days_ago(5)},2020-04-13 00:00:00+00:00,1,8800
+2020-05-20 15:45:45+00:00,Latvia,{_days_ago(40)},2019-12-29 00:00:00+00:00,0,3080
+2020-05-20 15:24:04+00:00,Peru,{_days_ago(12)},2017-07-24 00:00:00+00:00,2,2640
+2020-05-20 14:32:03+00:00,China,{_days_ago(0)},2019-07-25 00:00:00+00:00,0,0
+2020-05-20 15:02:29+00:00,Peru,{_days_ago(1)},2019-03-04 00:00:00+00:00,47,2640
+2020-05-20 15:36:42+00:00,China,{_days_ago(20)},2020-01-15 00:00:00+00:00,4,1760
+2020-05-20 15:00:51+00:00,Australia,{_days_ago(7)},2020-01-25 00:00:00+00:00,82,2200
+2020-05-20 15:00:52+00:00,China,{_days_ago(7)},2020-01-25 00:00:00+00:00,4,1761
+"""
+
+COUNTRY_CODES = [None, "", "China", "Latvia", "Peru", "InVaLiD"]
+FREQUENCY_SEGMENTS = [(None, None), (0, 4), (1, 3), (2, 47), (4, 4), (50, 100)]
+RECENCY_SEGMENTS = [(None, None), (0, 5), (1, 2), (5, 0), (7, 3), (30, 1), (50, 12)]
+
+
+@pytest.fixture
+def recent_csv_file(tmp_path: Path) -> Path:
+    path = tmp_path / "data.csv"
+    path.write_text(RECENT_CSV_DATA)
+    return path
+
+
+def test_index_from_file_ok(sql_file: Path):
+    index = VoucherIndex.from_file(sql_file)
+    assert index.size == 8
+    params = VoucherSelectionParameters(country_code="China")
+    assert index.get_voucher_amount(params) == 2493
+
+
+def test_index_empty_for_unknown_country(sql_file: Path):
+    index = VoucherIndex.from_file(sql_file)
+    params = VoucherSelectionParameters(country_code="InVaLiD")
+    assert index.get_voucher_amount(params) is None
+
+
+def test_index_invalid_recency_segment_out_of_range(sql_file: Path):
+    index = VoucherIndex.from_file(sql_file)
+    params = VoucherSelectionParameters(last_order_from=1, last_order_to=100000000)
+    with pytest.raises(ValueError, match="timestamp out of range"):
+        index.get_voucher_amount(params)
+
+
+def set_timezone(db: DBManager, timezone: str):
+    with db.get_cursor() as cur:
+        cur.execute("SET TimeZone = %s", (timezone,))
+    db._conn.commit()
+
+
+# the index computes recency segments in UTC days, whatever the DB session's
+@pytest.mark.parametrize("timezone", ["UTC", "Pacific/Kiritimati", "Pacific/Niue"])
+def test_index_same_as_sql(db: DBManager, recent_csv_file: Path, timezone: str):
+    set_timezone(db, timezone)
+    db.insert_from_csv(recent_csv_file)
+    indexes = {
+        "file": VoucherIndex.from_file(recent_csv_file),
+        "file_compact": VoucherIndex.from_file(recent_csv_file, compact=True),
+        "db": VoucherIndex.from_db(db),
+    }
+    non_empty = 0
+    for country_code, (fs_from, fs_to), (rs_from, rs_to) in itertools.product(
+        COUNTRY_CODES, FREQUENCY_SEGMENTS, RECENCY_SEGMENTS
+    ):
+        params = VoucherSelectionParameters(
+            country_code=country_code,
+            total_orders_from=fs_from,
+            total_orders_to=fs_to,
+            last_order_from=rs_from,
+            last_order_to=rs_to,
+        )
+        expected = db.get_voucher_amount(params)
+        non_empty += expected is not None
+        for source, index in indexes.items():
+            assert index.get_voucher_amount(params) == expected, (source, params)
+    assert non_empty > 0
@@ -0,0 +1,59 @@
+import pytest
+
+from voucher_selection.server.metrics import (
+    Histogram,
+    add_request_timing,
+    format_metric,
+    request_timings,
+)
+
+
+def test_histogram_expose_cumulative_buckets():
+    histogram = Histogram("latency_seconds", "Latency", labels=("route",))
+    histogram.observe(0.05, route="/voucher")
+    histogram.observe(0.5, route="/voucher")
+    histogram.observe(50, route="/voucher")
+    histogram.observe(0.05, route='/a"b')
+    assert histogram.count(route="/voucher") == 3
+    assert histogram.count(route="/unknown") == 0
+
+    lines = histogram.expose().splitlines()
+    assert lines[:2] == [
+        "# HELP latency_seconds Latency",
+        "# TYPE latency_seconds histogram",
+    ]
+    assert 'latency_seconds_bucket{route="/a\\"b",le="0.05"} 1' in lines
+    assert 'latency_seconds_bucket{route="/voucher",le="0.025"} 0' in lines
+    assert 'latency_seconds_bucket{route="/voucher",le="0.05"} 1' in lines
+    assert 'latency_seconds_bucket{route="/voucher",le="0.5"} 2' in lines
+    assert 'latency_seconds_bucket{route="/voucher",le="10.0"} 2' in lines
+    assert 'latency_seconds_bucket{route="/voucher",le="+Inf"} 3' in lines
+    assert 'latency_seconds_sum{route="/voucher"} 50.55' in lines
+    assert 'latency_seconds_count{route="/voucher"} 3' in lines
+
+
+def test_histogram_time_adds_request_timing():
+    histogram = Histogram("query_seconds", "Query")
+    with request_timings() as timings:
+        for _ in range(2):
+            with histogram.time(timing="db"):
+                pass
+    assert histogram.count() == 2
+    assert list(timings) == ["db"]
+    # outside of a request: not tracked
+    add_request_timing("db", 1.0)
+    assert timings["db"] < 1.0
+
+
+def test_histogram_time_observes_on_error():
+    histogram = Histogram("query_seconds", "Query")
+    with pytest.raises(ValueError):
+        with histogram.time():
+            raise ValueError("failed")
+    assert histogram.count() == 1
+
+
+def test_format_metric():
+    assert format_metric("hit_ratio", "gauge", "Hit ratio", 0.5) == (
+        "# HELP hit_ratio Hit ratio\n# TYPE hit_ratio gauge\nhit_ratio 0.5\n"
+    )
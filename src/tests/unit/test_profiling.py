@@ -0,0 +1,78 @@
+import pstats
+from contextlib import nullcontext
+from pathlib import Path
+
+import fastparquet
+import pytest
+from typer.testing import CliRunner
+
+from voucher_selection.bench import generate_orders
+from voucher_selection.cli import app
+from voucher_selection.data_cleaning import clean_file
+from voucher_selection.profiling import get_peak_memory, iter_stage, profile, stage
+
+
+def test_get_peak_memory():
+    assert get_peak_memory() > 2**20
+
+
+def test_stages_without_profile():
+    assert isinstance(stage("read", 1), nullcontext)
+    chunks = [[1, 2], [3]]
+    assert list(iter_stage("read", chunks)) == chunks
+
+
+def test_profile_stages(tmp_path: Path):
+    path = tmp_path / "profile.pstats"
+    with profile(path) as profiler:
+        assert list(iter_stage("read", [[1, 2], [3]])) == [[1, 2], [3]]
+        for _ in range(2):
+            with stage("execute", 10):
+                sum(range(1000))
+        with pytest.raises(ValueError, match="Already profiling"):
+            with profile(path):
+                pass
+    # stopped
+    assert isinstance(stage("read", 1), nullcontext)
+
+    assert profiler.stages["read"].calls == 2
+    assert profiler.stages["read"].rows == 3
+    execute = profiler.stages["execute"]
+    assert (execute.calls, execute.rows) == (2, 20)
+    assert execute.rows_per_second > 0
+    assert execute.peak_memory > 2**20
+    lines = profiler.summary()
+    assert [line.split()[0] for line in lines] == ["stage", "read", "execute"]
+    assert pstats.Stats(str(path)).total_calls > 0
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_clean_file_stages(tmp_path: Path, workers: int):
+    input_path = tmp_path / "raw.parquet"
+    fastparquet.write(str(input_path), generate_orders(100), row_group_offsets=40)
+    with profile(tmp_path / "profile.pstats") as profiler:
+        clean_file(input_path, tmp_path / "clean.csv", workers=workers)
+    # read by the workers, if any
+    expected = ["read", "clean", "write"] if workers == 1 else ["clean", "write"]
+    assert list(profiler.stages) == expected
+    for stats in profiler.stages.values():
+        assert (stats.calls, stats.rows) == (3, 100)
+
+
+def test_cli_profile(tmp_path: Path):
+    input_path = tmp_path / "raw.parquet"
+    fastparquet.write(str(input_path), generate_orders(100), write_index=False)
+    path = tmp_path / "profile.pstats"
+    args = ["data", "clean", "--input-parquet", str(input_path)]
+    args += ["--output-file", str(tmp_path / "clean.parquet")]
+    result = CliRunner().invoke(app, ["--profile", str(path), *args])
+    assert result.exit_code == 0, result.output
+    assert f"Saved profile to: {path}" in result.stderr
+    assert [line.split()[0] for line in result.stderr.splitlines()[:4]] == [
+        "stage",
+        "read",
+        "clean",
+        "write",
+    ]
+    stats = pstats.Stats(str(path))
+    assert any(func[2] == "clean_orders_raw" for func in stats.stats)
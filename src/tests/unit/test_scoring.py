@@ -0,0 +1,109 @@
+import json
+from pathlib import Path
+
+import fastparquet
+import pandas as pd
+import pytest
+from psycopg2.extensions import connection as Connection
+
+from voucher_selection.scoring import score_file, to_parameter_keys
+from voucher_selection.server.config import DBConfig
+from voucher_selection.server.db import get_db_by_connection
+
+
+REQUESTS = [
+    {"customer_id": 1, "country_code": "Latvia"},
+    {"customer_id": 2, "country_code": "InVaLiD"},
+    {"customer_id": 3, "country_code": "Latvia", "frequency_segment": "1-3"},
+    {"customer_id": 4, "frequency_segment": "1-3", "recency_segment": ""},
+    {"customer_id": 5, "country_code": "Latvia", "frequency_segment": "0-3"},
+]
+EXPECTED = pd.DataFrame(
+    {
+        "customer_id": [1, 2, 3, 4, 5],
+        "voucher_amount": pd.array([5940, None, 8800, 5720, 5940], dtype="Int64"),
+    }
+)
+
+
+@pytest.fixture
+def requests_jsonl(tmp_path: Path) -> Path:
+    path = tmp_path / "requests.jsonl"
+    path.write_text("\n".join(json.dumps(r) for r in REQUESTS))
+    return path
+
+
+def _read_output(path: Path) -> pd.DataFrame:
+    if path.suffix == ".parquet":
+        df = pd.read_parquet(path, engine="fastparquet")
+    else:
+        df = pd.read_csv(path)
+    df["voucher_amount"] = df["voucher_amount"].astype("Int64")
+    return df
+
+
+def test_to_parameter_keys_normalized():
+    inputs = pd.DataFrame(REQUESTS).reindex(
+        columns=["country_code", "frequency_segment", "recency_segment"]
+    )
+    keys = to_parameter_keys(inputs)
+    assert keys.drop_duplicates().shape[0] == 4
+    assert keys.iloc[3].tolist() == ["", 1, 3, 0, 0]
+
+
+def test_to_parameter_keys_invalid_segment():
+    inputs = pd.DataFrame(
+        {
+            "country_code": ["Peru", "Peru"],
+            "frequency_segment": ["1-3", "1+3"],
+            "recency_segment": [None, None],
+        }
+    )
+    with pytest.raises(ValueError, match=r"Invalid frequency_segment in rows \[1\]"):
+        to_parameter_keys(inputs)
+
+
+@pytest.mark.parametrize("suffix", [".csv", ".parquet"])
+@pytest.mark.parametrize("workers", [1, 2])
+def test_score_file_ok_dataset(
+    tmp_path: Path, requests_jsonl: Path, sql_file: Path, suffix: str, workers: int
+):
+    output = tmp_path / f"output{suffix}"
+    count = score_file(
+        requests_jsonl, output, dataset=sql_file, chunksize=2, workers=workers
+    )
+    assert count == len(REQUESTS)
+    pd.testing.assert_frame_equal(_read_output(output), EXPECTED)
+
+
+def test_score_file_ok_parquet_input(
+    tmp_path: Path, requests_jsonl: Path, sql_file: Path
+):
+    input = tmp_path / "requests.parquet"
+    fastparquet.write(str(input), pd.read_json(requests_jsonl, lines=True))
+    output = tmp_path / "output.csv"
+    score_file(input, output, dataset=sql_file)
+    pd.testing.assert_frame_equal(_read_output(output), EXPECTED)
+
+
+def test_score_file_ok_db(
+    tmp_path: Path, requests_jsonl: Path, sql_file: Path, postgresql: Connection
+):
+    with get_db_by_connection(postgresql) as db:
+        db.insert_from_csv(sql_file)
+        info = postgresql.info
+        db_config = DBConfig(
+            username=info.user,
+            password=info.password or "",
+            host=info.host,
+            port=info.port,
+            database=info.dbname,
+        )
+        output = tmp_path / "output.csv"
+        score_file(requests_jsonl, output, db_config=db_config, chunksize=2)
+    pd.testing.assert_frame_equal(_read_output(output), EXPECTED)
+
+
+def test_score_file_invalid_source(tmp_path: Path, requests_jsonl: Path):
+    with pytest.raises(ValueError, match="Expected exactly one of"):
+        score_file(requests_jsonl, tmp_path / "output.csv")
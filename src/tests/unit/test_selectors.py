@@ -0,0 +1,123 @@
+import asyncio
+from typing import List, Optional
+
+import pytest
+
+from voucher_selection.server.db import VoucherSelectionParameters
+from voucher_selection.server.selectors import CoalescingVoucherSelector
+
+
+class SlowSelector:
+    """Answers after `delay` seconds, the amount being the number of the query"""
+
+    def __init__(self, delay: float = 0.01, error: Optional[Exception] = None):
+        self.delay = delay
+        self.error = error
+        self.queries: List[VoucherSelectionParameters] = []
+        self.reloads = 0
+
+    async def startup(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def reload(self):
+        self.reloads += 1
+
+    async def get_voucher_amount(
+        self, params: VoucherSelectionParameters
+    ) -> Optional[int]:
+        self.queries.append(params)
+        value = len(self.queries)
+        await asyncio.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return value
+
+    async def get_voucher_amounts(
+        self, params_list: List[VoucherSelectionParameters]
+    ) -> List[Optional[int]]:
+        return [await self.get_voucher_amount(params) for params in params_list]
+
+
+def _run(coroutine):
+    # unlike `asyncio.run`, leaves the current event loop of the thread as is
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def test_coalescing_selector_shares_queries():
+    selector = SlowSelector()
+    coalescer = CoalescingVoucherSelector(selector)
+
+    async def run():
+        china = VoucherSelectionParameters(country_code="China")
+        # same query once normalized
+        china_all = VoucherSelectionParameters("China", 0, 4)
+        peru = VoucherSelectionParameters(country_code="Peru")
+        requests = [china] * 5 + [china_all, peru]
+        first = await asyncio.gather(*map(coalescer.get_voucher_amount, requests))
+        # not in flight anymore
+        second = await coalescer.get_voucher_amount(china)
+        return first, second
+
+    first, second = _run(run())
+    assert first == [1] * 6 + [2]
+    assert second == 3
+    assert len(selector.queries) == 3
+    assert coalescer.stats() == {"queries": 3, "coalesced": 5, "inflight": 0}
+
+
+def test_coalescing_selector_shares_errors():
+    coalescer = CoalescingVoucherSelector(SlowSelector(error=ValueError("failed")))
+
+    async def run():
+        params = VoucherSelectionParameters()
+        return await asyncio.gather(
+            *(coalescer.get_voucher_amount(params) for _ in range(3)),
+            return_exceptions=True,
+        )
+
+    results = _run(run())
+    assert [str(e) for e in results] == ["failed"] * 3
+    assert coalescer.stats()["queries"] == 1
+
+
+def test_coalescing_selector_cancelled_request():
+    selector = SlowSelector(delay=0.05)
+    coalescer = CoalescingVoucherSelector(selector)
+
+    async def run():
+        params = VoucherSelectionParameters()
+        first = asyncio.ensure_future(coalescer.get_voucher_amount(params))
+        await asyncio.sleep(0)
+        second = asyncio.ensure_future(coalescer.get_voucher_amount(params))
+        await asyncio.sleep(0)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert _run(run()) == 1
+    assert len(selector.queries) == 1
+
+
+def test_coalescing_selector_reload():
+    selector = SlowSelector()
+    coalescer = CoalescingVoucherSelector(selector)
+
+    async def run():
+        params = VoucherSelectionParameters()
+        before = asyncio.ensure_future(coalescer.get_voucher_amount(params))
+        await asyncio.sleep(0)
+        await coalescer.reload()
+        after = await coalescer.get_voucher_amount(params)
+        return await before, after
+
+    assert _run(run()) == (1, 2)
+    assert selector.reloads == 1
+    assert coalescer.stats()["coalesced"] == 0
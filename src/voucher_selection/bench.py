@@ -0,0 +1,300 @@
+"""Benchmarks of the data pipeline and of the HTTP API on synthetic or real
+data. Results are saved as JSON, so that they can be compared between commits.
+"""
+import http.client
+import json
+import logging
+import os
+import platform
+import subprocess
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Union
+
+import numpy as np
+import pandas as pd
+
+from .data_cleaning import DATA_COLUMNS, clean_orders_raw, load_csv
+from .server.db import DBManager
+from .server.db_embedded import EmbeddedDBManager
+
+
+logger = logging.getLogger()
+
+# Shares of the countries and voucher amounts of the real dataset
+COUNTRIES = {"China": 0.33, "Australia": 0.25, "Peru": 0.25, "Latvia": 0.17}
+VOUCHER_AMOUNT_STEP = 440
+FREQUENCY_SEGMENTS = ["0-4", "5-13", "14-37"]
+RECENCY_SEGMENTS = ["30-60", "61-90", "91-120", "121-180", "181-10000"]
+# Benchmarks of the DB are loaded into their own table
+BENCH_TABLE = "voucher_selection_bench"
+
+Benchmark = Dict[str, Union[int, float]]
+
+
+def generate_orders(
+    rows: int, seed: int = 0, now: Optional[datetime] = None
+) -> pd.DataFrame:
+    """Generates a raw dataset of `rows` orders with columns `DATA_COLUMNS` and
+    the schema and quirks of the real one (see `clean_orders_raw`): UTC
+    timestamps, `total_orders` as float strings with some empty ones, and
+    `voucher_amount` as floats with some missing ones.
+    """
+    rng = np.random.default_rng(seed)
+    now = pd.Timestamp(now or datetime(2020, 5, 20, tzinfo=timezone.utc))
+    first_order_days = rng.integers(0, 3 * 365, rows)
+    last_order_days = (first_order_days * rng.random(rows)).astype(np.int64)
+    today = now.normalize()
+
+    total_orders = rng.geometric(0.15, rows) - 1
+    total_orders = pd.Series(total_orders.astype(np.float64)).astype(str)
+    total_orders[rng.random(rows) < 0.08] = ""
+
+    voucher_amount = rng.integers(0, 30, rows) * float(VOUCHER_AMOUNT_STEP)
+    voucher_amount[rng.random(rows) < 0.06] = np.nan
+
+    df = pd.DataFrame(
+        {
+            "timestamp": now - pd.to_timedelta(rng.integers(0, 86400, rows), "s"),
+            "country_code": rng.choice(
+                list(COUNTRIES), rows, p=list(COUNTRIES.values())
+            ),
+            "last_order_ts": today - pd.to_timedelta(last_order_days, "D"),
+            "first_order_ts": today - pd.to_timedelta(first_order_days, "D"),
+            "total_orders": total_orders,
+            "voucher_amount": voucher_amount,
+        }
+    )
+    return df[DATA_COLUMNS]
+
+
+def generate_requests(count: int, seed: int = 0) -> List[dict]:
+    """Generates bodies of `POST /voucher` requests, mostly with segments"""
+    rng = np.random.default_rng(seed)
+    requests = []
+    for customer_id in range(count):
+        request = {"customer_id": customer_id}
+        if rng.random() < 0.9:
+            request["country_code"] = str(rng.choice(list(COUNTRIES)))
+        if rng.random() < 0.8:
+            request["frequency_segment"] = str(rng.choice(FREQUENCY_SEGMENTS))
+        if rng.random() < 0.8:
+            request["recency_segment"] = str(rng.choice(RECENCY_SEGMENTS))
+        requests.append(request)
+    return requests
+
+
+def load_requests(path: Union[str, Path]) -> List[dict]:
+    """Loads bodies of requests from a file in JSON lines format"""
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def save_requests(requests: List[dict], path: Union[str, Path]):
+    with open(path, "w") as f:
+        for request in requests:
+            f.write(json.dumps(request) + "\n")
+
+
+def measure(func: Callable[[], int], repeat: int = 3) -> Benchmark:
+    """Runs `func` (returning the number of processed rows) `repeat` times.
+    The throughput is computed from the fastest run, the least disturbed one.
+    """
+    durations = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        rows = func()
+        durations.append(time.perf_counter() - started)
+    best = min(durations)
+    return {
+        "rows": rows,
+        "repeat": repeat,
+        "best_seconds": best,
+        "median_seconds": float(np.median(durations)),
+        "rows_per_second": rows / best if best > 0 else 0.0,
+    }
+
+
+def bench_data(
+    raw: pd.DataFrame,
+    tmp_dir: Union[str, Path],
+    db: Optional[Union[DBManager, EmbeddedDBManager]] = None,
+    repeat: int = 3,
+) -> Dict[str, Benchmark]:
+    """Measures the throughput of cleaning the `raw` dataset, loading it from
+    a csv file, and inserting it to `db` if set (a DB manager of a table of its
+    own, e.g. `BENCH_TABLE`, which is dropped after each run).
+    """
+    results = {}
+    logger.info(f"Benchmarking clean_orders_raw on {len(raw)} rows")
+    results["clean_orders_raw"] = measure(
+        lambda: len(clean_orders_raw(raw)), repeat=repeat
+    )
+
+    path = Path(tmp_dir) / "bench_clean.csv"
+    clean_orders_raw(raw).to_csv(path, index=False)
+    logger.info(f"Benchmarking load_csv on {len(raw)} rows")
+    results["load_csv"] = measure(lambda: len(load_csv(path)), repeat=repeat)
+
+    if db is not None:
+
+        def insert() -> int:
+            db.drop_table()
+            try:
+                return db.insert_from_csv(path)
+            finally:
+                db.drop_table()
+
+        logger.info(f"Benchmarking insert_from_csv on {len(raw)} rows")
+        results["insert_from_csv"] = measure(insert, repeat=repeat)
+    return results
+
+
+def _percentiles(latencies: Sequence[float]) -> Dict[str, float]:
+    if not latencies:
+        return {}
+    values = np.percentile(latencies, [50, 95, 99]) * 1000
+    return {
+        "p50_ms": float(values[0]),
+        "p95_ms": float(values[1]),
+        "p99_ms": float(values[2]),
+        "max_ms": float(max(latencies)) * 1000,
+    }
+
+
+def replay(
+    url: str,
+    requests: List[dict],
+    rps: float,
+    duration: float,
+    concurrency: int = 32,
+    timeout: float = 10.0,
+) -> Benchmark:
+    """Sends `requests` (cycling over them) as JSON bodies to the endpoint
+    `url` at a rate of `rps` requests per second for `duration` seconds, from
+    `concurrency` persistent connections.
+
+    Requests are sent on schedule whether or not previous ones are answered,
+    and latencies are measured from the scheduled time: when the server (or
+    the client) falls behind, the time spent waiting counts in the latency,
+    as it does for real clients.
+    """
+    if rps <= 0 or duration <= 0:
+        raise ValueError(f"Invalid rate {rps} or duration {duration}")
+    if not requests:
+        raise ValueError("No requests to send")
+    parsed = urllib.parse.urlsplit(url)
+    path = parsed.path or "/"
+    local = threading.local()
+    lock = threading.Lock()
+    latencies: List[float] = []
+    errors: Dict[str, int] = {}
+    connections: List[http.client.HTTPConnection] = []
+
+    def send(body: bytes, scheduled: float):
+        try:
+            if not hasattr(local, "conn"):
+                local.conn = http.client.HTTPConnection(parsed.netloc, timeout=timeout)
+                with lock:
+                    connections.append(local.conn)
+            try:
+                local.conn.request(
+                    "POST", path, body, {"Content-Type": "application/json"}
+                )
+                response = local.conn.getresponse()
+                response.read()
+            except Exception:
+                # reconnect on the next request
+                local.conn.close()
+                del local.conn
+                raise
+            error = None if response.status < 300 else f"HTTP {response.status}"
+        except Exception as e:
+            error = type(e).__name__
+        latency = time.perf_counter() - scheduled
+        with lock:
+            if error is None:
+                latencies.append(latency)
+            else:
+                errors[error] = errors.get(error, 0) + 1
+
+    bodies = [json.dumps(request).encode() for request in requests]
+    total = int(rps * duration)
+    logger.info(f"Sending {total} requests to {url} at {rps} requests/s")
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        started = time.perf_counter()
+        for i in range(total):
+            scheduled = started + i / rps
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(send, bodies[i % len(bodies)], scheduled)
+    elapsed = time.perf_counter() - started
+    for conn in connections:
+        conn.close()
+
+    return {
+        "requests": total,
+        "target_rps": rps,
+        "achieved_rps": len(latencies) / elapsed,
+        "errors": sum(errors.values()),
+        **{f"errors_{name}": count for name, count in sorted(errors.items())},
+        **_percentiles(latencies),
+    }
+
+
+def _get_commit() -> Optional[str]:
+    try:
+        output = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=Path(__file__).parent,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.stdout.strip()
+
+
+def save_results(path: Union[str, Path], benchmarks: Dict[str, Benchmark]) -> dict:
+    """Adds `benchmarks` to the results file `path` (created if needed),
+    replacing previous results of the same benchmarks.
+    """
+    path = Path(path)
+    results = json.loads(path.read_text()) if path.exists() else {}
+    results.update(
+        {
+            "commit": _get_commit(),
+            "created": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+        }
+    )
+    results.setdefault("benchmarks", {}).update(benchmarks)
+    path.write_text(json.dumps(results, indent=2, sort_keys=True) + "\n")
+    return results
+
+
+def compare_results(base: dict, new: dict) -> Iterator[str]:
+    """Yields a line per metric of the benchmarks in both results, with its
+    relative change from `base` to `new`.
+    """
+    for name, metrics in sorted(new.get("benchmarks", {}).items()):
+        base_metrics = base.get("benchmarks", {}).get(name)
+        if base_metrics is None:
+            continue
+        for metric, value in sorted(metrics.items()):
+            base_value = base_metrics.get(metric)
+            if not isinstance(base_value, (int, float)):
+                continue
+            change = (value - base_value) / base_value * 100 if base_value else 0.0
+            yield (
+                f"{name:<20} {metric:<20} {base_value:>14.3f} "
+                f"{value:>14.3f} {change:>+8.1f}%"
+            )
@@ -1,25 +1,35 @@
+import json
 import logging
+import os
+import tempfile
+from contextlib import ExitStack, contextmanager
 from pathlib import Path
+from typing import List, Optional
 
-import pandas as pd
 import typer
-import uvicorn
 
-from .data_cleaning import clean_orders_raw
-from .server.api import get_api
-from .server.config import create_db_config, create_server_config
-from .server.db import get_db
+# Only lightweight modules are imported here: each command imports the modules
+# it uses (pandas, the DB drivers, the web stack), so that starting the CLI
+# does not load them all.
+from .server.config import (
+    SEED_BATCH_SIZE,
+    DBConfig,
+    create_db_config,
+    create_server_config,
+)
 
 
 app = typer.Typer()
 data_app = typer.Typer()
 db_app = typer.Typer()
 api_app = typer.Typer()
+bench_app = typer.Typer()
 
 
 app.add_typer(data_app, name="data")
 app.add_typer(db_app, name="db")
 app.add_typer(api_app, name="api")
+app.add_typer(bench_app, name="bench")
 
 
 def _setup_logger(level=logging.INFO):
@@ -29,10 +39,66 @@ def _setup_logger(level=logging.INFO):
 
 
 @app.callback()
-def app_callback(verbose: bool = False):
+def app_callback(
+    ctx: typer.Context,
+    verbose: bool = False,
+    profile: Optional[Path] = typer.Option(
+        None,
+        help="Profile the command: save its cProfile stats to this file (e.g. "
+        "for flameprof or snakeviz), and print a summary of its stages",
+    ),
+):
     """Voucher selection app"""
     level = logging.DEBUG if verbose else logging.INFO
     _setup_logger(level)
+    if profile is not None:
+        ctx.with_resource(_profile(profile))
+
+
+@contextmanager
+def _profile(path: Path):
+    from .profiling import profile
+
+    with profile(path) as profiler:
+        try:
+            yield
+        finally:
+            for line in profiler.summary():
+                typer.echo(line, err=True)
+    typer.echo(f"Saved profile to: {path}", err=True)
+
+
+@app.command("score")
+def score(
+    input: Path = typer.Option(
+        ..., help="Path to the requests in JSON lines or parquet format"
+    ),
+    output: Path = typer.Option(
+        ..., help="Path to the output file in csv or parquet format"
+    ),
+    dataset: Optional[Path] = typer.Option(
+        None, help="Cleaned dataset (csv or parquet) to score against instead of DB"
+    ),
+    chunksize: int = typer.Option(100000, help="Number of requests per chunk"),
+    workers: int = typer.Option(os.cpu_count() or 1, help="Number of processes"),
+):
+    """Compute voucher amounts of requests (same inputs as `POST /voucher`)"""
+    from .scoring import score_file
+
+    if not input.is_file():
+        raise ValueError(f"Input requests not found: {input}")
+    if output.exists():
+        raise ValueError(f"Output file already exists: {output}")
+    db_config = None
+    if dataset is None:
+        db_config = create_db_config()
+        typer.echo(f"Database config: {db_config}")
+    elif not dataset.is_file():
+        raise ValueError(f"Input dataset not found: {dataset}")
+
+    typer.echo(f"Scoring requests from: {input}")
+    count = score_file(input, output, dataset, db_config, chunksize, workers)
+    typer.echo(f"Saved {count} voucher amounts to: {output}")
 
 
 @data_app.command("clean")
@@ -40,42 +106,365 @@ def data_clean(
     input_parquet: Path = typer.Option(
         ..., help="Path to the input file in parquet format"
     ),
-    output_csv: Path = typer.Option(..., help="Path to the output file in csv format"),
+    output_file: Path = typer.Option(
+        ...,
+        "--output-file",
+        "--output-csv",
+        help="Path to the output file in csv or (typed, compressed) parquet format",
+    ),
+    workers: int = typer.Option(
+        1, help="Number of processes cleaning row groups in parallel"
+    ),
+    compact: bool = typer.Option(
+        False, help="Clean with compact dtypes (categories, small integers, dates)"
+    ),
 ):
     """Clean input raw dataset"""
+    from .data_cleaning import clean_file
+    from .profiling import get_peak_memory
+
     typer.echo(f"Reading input dataset from: {input_parquet}")
     if not input_parquet.exists():
         raise ValueError(f"Input dataset not found: {input_parquet}")
-    if output_csv.exists():
-        raise ValueError(f"Output dataset already exists: {output_csv}")
-    df = pd.read_parquet(input_parquet, engine="fastparquet")
-    df = clean_orders_raw(df)
-    typer.echo(f"Saving output dataset to: {output_csv}")
-    df.to_csv(output_csv, index=False)
+    if output_file.exists():
+        raise ValueError(f"Output dataset already exists: {output_file}")
+    typer.echo(f"Saving output dataset to: {output_file}")
+    count = clean_file(input_parquet, output_file, workers=workers, compact=compact)
+    typer.echo(f"Saved {count} rows to: {output_file}")
+    typer.echo(f"Peak memory: {get_peak_memory() / 2**20:.1f} MiB")
 
 
 @db_app.command("seed")
 def db_seed(
-    input_csv: Path = typer.Option(..., help="Path to the dataset in csv format")
+    input_file: Path = typer.Option(
+        ...,
+        "--input-file",
+        "--input-csv",
+        help="Path to the dataset in csv or parquet format",
+    ),
+    batch_size: int = typer.Option(
+        SEED_BATCH_SIZE, help="Number of rows sent to the DB at once"
+    ),
+    cluster: bool = typer.Option(
+        False, help="Physically order the table by country after loading"
+    ),
+    replace: bool = typer.Option(
+        False,
+        help="Replace the rows of the table (loaded into a new table, then swapped)",
+    ),
+    api_url: Optional[str] = typer.Option(
+        None, help="URL of a running API to reload its data and cache after loading"
+    ),
+    in_place: bool = typer.Option(
+        False, help="Backend duckdb: query the dataset file in place, not a copy"
+    ),
+    incremental: bool = typer.Option(
+        False,
+        help="Insert new rows and update changed ones (by order), skip loaded files",
+    ),
+    rollup: bool = typer.Option(
+        False,
+        help="Also build the rollup for the API mode `rollup` (then kept up to date)",
+    ),
+    partitioned: bool = typer.Option(
+        False, help="Create the table with a partition per country"
+    ),
+    replace_partitions: bool = typer.Option(
+        False,
+        help="Replace only the partitions of the countries of the file",
+    ),
 ):
-    if not input_csv.is_file():
-        raise ValueError(f"Input dataset not found: {input_csv}")
+    from .server.db import get_db
+
+    if not input_file.is_file():
+        raise ValueError(f"Input dataset not found: {input_file}")
 
     db_config = create_db_config()
     typer.echo(f"Database config: {db_config}")
+    if rollup or partitioned or replace_partitions:
+        _require_postgres(db_config)
+    # options of the PostgreSQL backend only
+    load_options, table_options = {}, {}
+    if db_config.backend == "postgres":
+        load_options = {"rollup": rollup}
+        table_options = {**load_options, "partitioned": partitioned}
 
     with get_db(db_config) as db:
-        typer.echo(f"Loading values to DB from file: {input_csv}")
-        db.insert_from_csv(input_csv)
+        typer.echo(f"Loading values to DB from file: {input_file}")
+        if in_place:
+            if db_config.backend != "duckdb":
+                raise ValueError("Option --in-place requires the duckdb backend")
+            db.attach_file(input_file)
+        elif replace_partitions:
+            if replace or incremental or rollup:
+                raise ValueError(
+                    "Option --replace-partitions excludes "
+                    "--replace, --incremental, --rollup"
+                )
+            db.replace_partitions_from_file(input_file, batch_size=batch_size)
+        elif incremental:
+            if replace or cluster or partitioned:
+                raise ValueError(
+                    "Option --incremental excludes --replace, --cluster, --partitioned"
+                )
+            result = db.upsert_from_file(
+                input_file, batch_size=batch_size, **load_options
+            )
+            if result.skipped:
+                typer.echo(f"File already loaded, skipped: {input_file}")
+                return
+            typer.echo(
+                f"Loaded {result.rows} rows: "
+                f"{result.inserted} inserted, {result.updated} updated"
+            )
+        elif replace:
+            db.replace_from_file(
+                input_file,
+                batch_size=batch_size,
+                cluster=cluster,
+                **table_options,
+            )
+        else:
+            db.insert_from_file(
+                input_file,
+                batch_size=batch_size,
+                cluster=cluster,
+                **table_options,
+            )
+
+    if api_url:
+        _reload_api(api_url, create_server_config().admin_token)
+
+
+def _reload_api(api_url: str, admin_token: Optional[str]):
+    import urllib.request
+
+    url = f"{api_url.rstrip('/')}/reload"
+    typer.echo(f"Reloading the API: {url}")
+    headers = {"Authorization": f"Bearer {admin_token}"} if admin_token else {}
+    request = urllib.request.Request(url, method="POST", headers=headers)
+    # the API may load the whole dataset to memory
+    with urllib.request.urlopen(request, timeout=600) as response:
+        # 202: several workers, restarted in the background
+        typer.echo(f"Reload ({response.status}): {response.read().decode()}")
+
+
+def _require_postgres(db_config: DBConfig):
+    if db_config.backend != "postgres":
+        raise ValueError(f"Not supported by the DB backend '{db_config.backend}'")
+
+
+@db_app.command("precompute")
+def db_precompute(
+    frequency_segment: List[str] = typer.Option(
+        [], help="Frequency segment like `0-4`, can be repeated"
+    ),
+    recency_segment: List[str] = typer.Option(
+        [], help="Recency segment like `30-60`, can be repeated"
+    ),
+    input_jsonl: Optional[Path] = typer.Option(
+        None, help="Also use segments of requests from a file in JSON lines format"
+    ),
+):
+    """Precompute voucher amounts of segments for the API mode `precomputed`.
+    Recency segments are relative to the current date, so this command needs
+    to be run daily. Without segments, re-computes the ones already precomputed.
+    """
+    from .server.api import parse_segment_interval
+    from .server.db import get_db
+
+    frequency_segments = set(frequency_segment)
+    recency_segments = set(recency_segment)
+    if input_jsonl is not None:
+        if not input_jsonl.is_file():
+            raise ValueError(f"Input requests not found: {input_jsonl}")
+        with input_jsonl.open() as f:
+            for line in f:
+                if line.strip():
+                    request = json.loads(line)
+                    frequency_segments.add(request.get("frequency_segment"))
+                    recency_segments.add(request.get("recency_segment"))
+
+    db_config = create_db_config()
+    typer.echo(f"Database config: {db_config}")
+    _require_postgres(db_config)
+
+    with get_db(db_config) as db:
+        if frequency_segments or recency_segments:
+            frequencies = [parse_segment_interval(s) for s in frequency_segments if s]
+            recencies = [parse_segment_interval(s) for s in recency_segments if s]
+        else:
+            frequencies, recencies = db.get_segments()
+        typer.echo(
+            f"Precomputing {len(frequencies)} frequency segments "
+            f"and {len(recencies)} recency segments"
+        )
+        db.precompute_segments(frequencies, recencies)
+
+
+@db_app.command("indexes")
+def db_indexes():
+    """Report the number of scans of the table (sequential) and its indexes"""
+    from .server.db import get_db
+
+    db_config = create_db_config()
+    typer.echo(f"Database config: {db_config}")
+    _require_postgres(db_config)
+
+    with get_db(db_config) as db:
+        for usage in db.get_index_usage():
+            typer.echo(
+                f"{usage['name']:<40} scans: {usage['scans']:>12} "
+                f"size: {usage['size'] // 1024:>10} kB"
+            )
 
 
 @api_app.command("run")
-def api_run():
+def api_run(
+    workers: Optional[int] = typer.Option(
+        None, help="Number of server processes (default: APP_SERVER_WORKERS)"
+    ),
+):
+    import uvicorn
+
     db_config = create_db_config()
     typer.echo(f"Database config: {db_config}")
 
-    server_config = create_server_config()
+    env = dict(os.environ)
+    if workers is not None:
+        env["APP_SERVER_WORKERS"] = str(workers)
+    server_config = create_server_config(env)
     typer.echo(f"Server config: {server_config}")
 
-    api = get_api(db_config)
-    uvicorn.run(api, host=server_config.host, port=server_config.port)
+    # each process creates the API (and connects to the DB) from the env vars,
+    # the number of workers only matters to this one, which supervises them
+    factory = "create_worker_api" if server_config.workers > 1 else "create_api"
+    uvicorn.run(
+        f"voucher_selection.server.api:{factory}",
+        factory=True,
+        host=server_config.host,
+        port=server_config.port,
+        workers=server_config.workers,
+        timeout_keep_alive=server_config.keep_alive,
+        backlog=server_config.backlog,
+        timeout_graceful_shutdown=server_config.graceful_timeout or None,
+    )
+
+
+@bench_app.command("generate")
+def bench_generate(
+    output_parquet: Optional[Path] = typer.Option(
+        None, help="Path to the raw dataset to generate, in parquet format"
+    ),
+    rows: int = typer.Option(1000000, help="Number of orders of the dataset"),
+    output_jsonl: Optional[Path] = typer.Option(
+        None, help="Path to the requests to generate, in JSON lines format"
+    ),
+    requests: int = typer.Option(10000, help="Number of requests"),
+    seed: int = typer.Option(0, help="Seed of the random generator"),
+):
+    """Generate a synthetic raw dataset (input of `data clean`) and/or requests
+    (input of `bench http` and `score`)
+    """
+    from . import bench
+
+    if output_parquet is not None:
+        if output_parquet.exists():
+            raise ValueError(f"Output dataset already exists: {output_parquet}")
+        raw = bench.generate_orders(rows, seed=seed)
+        raw.to_parquet(output_parquet, engine="fastparquet", index=False)
+        typer.echo(f"Saved {len(raw)} rows to: {output_parquet}")
+    if output_jsonl is not None:
+        if output_jsonl.exists():
+            raise ValueError(f"Output requests already exist: {output_jsonl}")
+        bench.save_requests(bench.generate_requests(requests, seed=seed), output_jsonl)
+        typer.echo(f"Saved {requests} requests to: {output_jsonl}")
+
+
+@bench_app.command("data")
+def bench_data(
+    output: Path = typer.Option(..., help="Path to the results file in JSON format"),
+    input_parquet: Optional[Path] = typer.Option(
+        None, help="Raw dataset in parquet format (default: synthetic dataset)"
+    ),
+    rows: int = typer.Option(1000000, help="Number of orders of a synthetic dataset"),
+    repeat: int = typer.Option(3, help="Number of runs of each benchmark"),
+    db: bool = typer.Option(
+        False, help="Also benchmark loading the dataset to the DB (own table)"
+    ),
+):
+    """Measure the throughput of cleaning, loading and seeding a dataset"""
+    from . import bench
+    from .data_cleaning import load_parquet
+    from .server.db import open_db
+
+    if input_parquet is not None:
+        if not input_parquet.is_file():
+            raise ValueError(f"Input dataset not found: {input_parquet}")
+        raw = load_parquet(input_parquet)
+    else:
+        raw = bench.generate_orders(rows)
+
+    with ExitStack() as stack:
+        bench_db = None
+        if db:
+            db_config = create_db_config()
+            typer.echo(f"Database config: {db_config}")
+            bench_db = stack.enter_context(open_db(db_config, table=bench.BENCH_TABLE))
+        tmp_dir = stack.enter_context(tempfile.TemporaryDirectory())
+        results = bench.bench_data(raw, tmp_dir, db=bench_db, repeat=repeat)
+    _save_bench_results(output, results)
+
+
+@bench_app.command("http")
+def bench_http(
+    output: Path = typer.Option(..., help="Path to the results file in JSON format"),
+    url: str = typer.Option("http://0.0.0.0:8080/voucher", help="Endpoint to call"),
+    input_jsonl: Optional[Path] = typer.Option(
+        None, help="Requests in JSON lines format (default: synthetic requests)"
+    ),
+    rps: float = typer.Option(100, help="Target number of requests per second"),
+    duration: float = typer.Option(10, help="Duration of the benchmark in seconds"),
+    concurrency: int = typer.Option(32, help="Maximal number of pending requests"),
+    name: str = typer.Option("http_voucher", help="Name of the benchmark"),
+):
+    """Replay requests against a running API at a target rate, and measure
+    latency percentiles
+    """
+    from . import bench
+
+    if input_jsonl is not None:
+        if not input_jsonl.is_file():
+            raise ValueError(f"Input requests not found: {input_jsonl}")
+        requests = bench.load_requests(input_jsonl)
+    else:
+        requests = bench.generate_requests(10000)
+    result = bench.replay(url, requests, rps, duration, concurrency=concurrency)
+    _save_bench_results(output, {name: result})
+
+
+def _save_bench_results(output: Path, results: dict):
+    from . import bench
+
+    for name, metrics in results.items():
+        typer.echo(f"{name}: " + ", ".join(f"{k}={v:.6g}" for k, v in metrics.items()))
+    bench.save_results(output, results)
+    typer.echo(f"Saved results to: {output}")
+
+
+@bench_app.command("compare")
+def bench_compare(
+    base: Path = typer.Argument(..., help="Results of the reference commit"),
+    new: Path = typer.Argument(..., help="Results to compare"),
+):
+    """Compare the results of two benchmark runs (e.g. of two commits)"""
+    from . import bench
+
+    for path in [base, new]:
+        if not path.is_file():
+            raise ValueError(f"Results not found: {path}")
+    base_results = json.loads(base.read_text())
+    new_results = json.loads(new.read_text())
+    typer.echo(f"Base: {base_results.get('commit')}, new: {new_results.get('commit')}")
+    for line in bench.compare_results(base_results, new_results):
+        typer.echo(line)
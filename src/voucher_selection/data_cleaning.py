@@ -1,8 +1,18 @@
 import logging
+import mmap
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Optional, Union
+from typing import Deque, Iterator, List, Optional, Union
 
+import fastparquet
+import numpy as np
 import pandas as pd
+import pandas.api.types as ptypes
+from pandas.api.types import union_categoricals
+
+from .profiling import iter_stage, stage
 
 
 logger = logging.getLogger()
@@ -16,6 +26,13 @@ DATA_COLUMNS = [
     "voucher_amount",
 ]
 
+# Columns of timestamps at midnight, stored as dates by the DB
+DATE_COLUMNS = ["last_order_ts", "first_order_ts"]
+INT_COLUMNS = ["total_orders", "voucher_amount"]
+
+# Per-process state of the workers of `clean_file`, set by `_init_worker`
+_parquet_file: Optional[fastparquet.ParquetFile] = None
+
 
 def convert_str_to_int(value: Optional[str]) -> int:
     value_str = value or "0.0"
@@ -26,20 +43,169 @@ def convert_str_to_int(value: Optional[str]) -> int:
     return value_int
 
 
-def load_csv(path: Union[str, Path], **kwargs) -> pd.DataFrame:
+def compact_dtypes(df: pd.DataFrame, inplace: bool = False) -> pd.DataFrame:
+    """
+    Returns the dataframe with a compact schema, several times smaller than
+    the default one on large datasets:
+
+    - `country_code` and the dates (`DATE_COLUMNS`, truncated to the day like
+      in the DB) as categoricals: they have few distinct values
+    - integers (`INT_COLUMNS`) with the smallest width that fits their values
+
+    Values read from the dataframe are the same (up to the time of the dates),
+    and it is written to csv and parquet files the same way. The copy is
+    shallow (see `clean_orders_raw`).
+    """
+    before = df.memory_usage(deep=True).sum()
+    df = df if inplace else df.copy(deep=False)
+    for col in ["country_code", *DATE_COLUMNS]:
+        if col not in df.columns:
+            continue
+        values = df[col]
+        if col in DATE_COLUMNS:
+            values = pd.to_datetime(values).dt.normalize()
+        df[col] = values.astype("category")
+    for col in INT_COLUMNS:
+        if col in df.columns and ptypes.is_integer_dtype(df[col].dtype):
+            df[col] = pd.to_numeric(df[col], downcast="integer")
+    after = df.memory_usage(deep=True).sum()
+    logger.info(
+        f"Compacted dataset of {len(df)} rows from {before / 2**20:.1f} MiB "
+        f"to {after / 2**20:.1f} MiB"
+    )
+    return df
+
+
+def expand_dtypes(df: pd.DataFrame) -> pd.DataFrame:
+    """Reverts the dtypes of `compact_dtypes` (dates stay truncated), so that
+    chunks compacted separately have the same schema: `fastparquet` appends
+    row groups as if they had the categories of the first one.
+    """
+    df = df.copy(deep=False)
+    for col in df.columns:
+        dtype = df[col].dtype
+        if ptypes.is_categorical_dtype(dtype):
+            df[col] = df[col].astype(dtype.categories.dtype)
+        elif ptypes.is_integer_dtype(dtype) and col in INT_COLUMNS:
+            df[col] = df[col].astype(np.int64)
+    return df
+
+
+def load_csv(path: Union[str, Path], compact: bool = False, **kwargs) -> pd.DataFrame:
     """
     Loads the dataset from a csv file, ensures that it contains only columns
-    we need (see `DATA_COLUMNS`), converts timestamps to `datetime`.
+    we need (see `DATA_COLUMNS`), converts timestamps to `datetime`. With
+    `compact`, the dataframe has a compact schema (see `compact_dtypes`),
+    and country codes are parsed as categoricals from the start.
     """
     logger.info(f"Loading dataset from csv file: {path}")
+    if compact:
+        kwargs.setdefault("dtype", {"country_code": "category"})
     df = pd.read_csv(path, **kwargs)
     df = df[DATA_COLUMNS]
     for col in ["timestamp", "first_order_ts", "last_order_ts"]:
         df[col] = pd.to_datetime(df[col])
-    return df
+    return compact_dtypes(df, inplace=True) if compact else df
+
+
+@contextmanager
+def open_parquet(path: Union[str, Path]) -> Iterator[fastparquet.ParquetFile]:
+    """
+    Opens a parquet file memory-mapped, so that only the pages of the columns
+    read are loaded, and they are shared by all processes reading the file.
+    """
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            yield fastparquet.ParquetFile(mapped)
+
+
+def load_parquet(
+    path: Union[str, Path], columns: List[str] = DATA_COLUMNS, compact: bool = False
+) -> pd.DataFrame:
+    """
+    Loads only `columns` of the dataset from a parquet file, with the types
+    stored in the file (no parsing of values). With `compact`, row groups are
+    compacted (see `compact_dtypes`) one at a time, as they are read.
+    """
+    logger.info(f"Loading dataset from parquet file: {path}")
+    with open_parquet(path) as pf:
+        if not compact or len(pf.row_groups) == 0:
+            df = pf.to_pandas(columns=columns)
+            return compact_dtypes(df, inplace=True) if compact else df
+        chunks = [
+            compact_dtypes(chunk, inplace=True)
+            for chunk in pf.iter_row_groups(columns=columns)
+        ]
+    return pd.DataFrame({col: _concat([c[col] for c in chunks]) for col in columns})
+
+
+def _concat(chunks: List[pd.Series]) -> pd.Series:
+    if ptypes.is_categorical_dtype(chunks[0].dtype):
+        # categories differ between chunks: `concat` would make objects
+        return pd.Series(union_categoricals(chunks), name=chunks[0].name)
+    return pd.concat(chunks, ignore_index=True)
+
 
+def load_dataset(path: Union[str, Path], **kwargs) -> pd.DataFrame:
+    """Loads the dataset from a csv (see `load_csv`) or parquet file"""
+    if Path(path).suffix == ".parquet":
+        return load_parquet(path, **kwargs)
+    return load_csv(path, **kwargs)
 
-def clean_orders_raw(data: pd.DataFrame) -> pd.DataFrame:
+
+def iter_dataset(path: Union[str, Path], chunksize: int) -> Iterator[pd.DataFrame]:
+    """
+    Reads the dataset from a csv or parquet file by chunks of up to `chunksize`
+    rows, with only columns `DATA_COLUMNS` (in this order). Values of csv files
+    are kept as strings, so that they can be loaded as is.
+    """
+    path = Path(path)
+    if path.suffix == ".parquet":
+        logger.info(f"Streaming dataset from parquet file: {path}")
+        with open_parquet(path) as pf:
+            for row_group in pf.iter_row_groups(columns=DATA_COLUMNS):
+                for start in range(0, len(row_group), chunksize):
+                    stop = start + chunksize
+                    yield row_group[DATA_COLUMNS].iloc[start:stop]
+    else:
+        logger.info(f"Streaming dataset from csv file: {path}")
+        reader = pd.read_csv(path, usecols=DATA_COLUMNS, dtype=str, chunksize=chunksize)
+        with reader:
+            for chunk in reader:
+                yield chunk[DATA_COLUMNS]
+
+
+def convert_to_int(values: pd.Series) -> pd.Series:
+    """
+    Vectorized `convert_str_to_int`: missing values and empty strings become `0`,
+    other values are parsed as numbers and must be integers. Raises `ValueError`
+    listing (the first of) the invalid rows.
+    """
+    if ptypes.is_integer_dtype(values.dtype) and not values.hasnans:
+        return values.astype(np.int64)
+    if values.dtype == object:
+        # raw values are mostly repeated strings: parse each distinct one once
+        codes, uniques = pd.factorize(values)
+        uniques = pd.Series(uniques).mask(lambda u: u == "", 0)
+        parsed = pd.to_numeric(uniques, errors="coerce").to_numpy(np.float64)
+        # missing values have code `-1`: the appended `0`
+        numbers = np.append(parsed, 0)[codes]
+    else:
+        numbers = values.fillna(0).to_numpy(np.float64)
+    with np.errstate(invalid="ignore"):
+        invalid = ~np.isfinite(numbers) | (np.floor(numbers) != numbers)
+    if invalid.any():
+        rows = values.index[invalid][:10].tolist()
+        raise ValueError(
+            f"Not an integer in column `{values.name}` of rows {rows}: "
+            f"{values[invalid][:10].tolist()}"
+        )
+    return pd.Series(numbers.astype(np.int64), index=values.index, name=values.name)
+
+
+def clean_orders_raw(
+    data: pd.DataFrame, inplace: bool = False, compact: bool = False
+) -> pd.DataFrame:
     """
     Returns the cleaned copy of the dataframe with the following transformations:
 
@@ -50,12 +216,103 @@ def clean_orders_raw(data: pd.DataFrame) -> pd.DataFrame:
         - use value `0` instead of NaN
         - convert all values to `int`
 
+    The copy is shallow: unchanged columns share memory with `data`. With
+    `inplace`, `data` itself is modified and returned. With `compact`, the
+    result has a compact schema (see `compact_dtypes`).
+
     For more details, see jupyter notebooks `<project>/notebooks`.
     """
     logger.info(f"Cleaning raw dataset of size: {data.size}")
-    df = data.copy(deep=True)
+    df = data if inplace else data.copy(deep=False)
 
-    df["total_orders"] = df["total_orders"].fillna(0).apply(convert_str_to_int)
-    df["voucher_amount"] = df["voucher_amount"].fillna(0).apply(convert_str_to_int)
+    df["total_orders"] = convert_to_int(df["total_orders"])
+    df["voucher_amount"] = convert_to_int(df["voucher_amount"])
 
-    return df
+    return compact_dtypes(df, inplace=True) if compact else df
+
+
+class ChunkWriter:
+    """Appends chunks of a dataframe to a csv or parquet file"""
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self.rows = 0
+
+    def write(self, df: pd.DataFrame):
+        with stage("write", len(df)):
+            if self.path.suffix == ".parquet":
+                df = expand_dtypes(df)
+                fastparquet.write(
+                    str(self.path),
+                    df,
+                    compression="SNAPPY",
+                    write_index=False,
+                    append=self.rows > 0,
+                )
+            else:
+                df.to_csv(self.path, mode="a", header=self.rows == 0, index=False)
+        self.rows += len(df)
+
+
+def _init_worker(path: Path):
+    global _parquet_file
+    # kept open for the lifetime of the worker process
+    with open(path, "rb") as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    _parquet_file = fastparquet.ParquetFile(mapped)
+
+
+def _clean_row_group(index: int, compact: bool = False) -> pd.DataFrame:
+    chunk = _parquet_file[index].to_pandas()
+    return clean_orders_raw(chunk, inplace=True, compact=compact)
+
+
+def _iter_cleaned(
+    executor: ProcessPoolExecutor, row_groups: int, workers: int, compact: bool
+) -> Iterator[pd.DataFrame]:
+    # keep a bounded number of row groups in flight, so that memory stays flat
+    pending: Deque[Future] = deque()
+    for index in range(row_groups):
+        pending.append(executor.submit(_clean_row_group, index, compact))
+        if len(pending) >= 2 * workers:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def clean_file(
+    input_path: Union[str, Path],
+    output_path: Union[str, Path],
+    workers: int = 1,
+    compact: bool = False,
+) -> int:
+    """
+    Cleans a raw dataset in parquet format row group by row group (see
+    `clean_orders_raw`) and writes it to `output_path` (csv or parquet) in the
+    same order, so that memory is bounded by the size of row groups. With
+    `workers > 1`, row groups are read and cleaned by a pool of processes.
+    With `compact`, row groups are compacted (see `compact_dtypes`), which
+    also makes the chunks sent back by the workers smaller. Returns the
+    number of cleaned rows.
+    """
+    writer = ChunkWriter(output_path)
+    with open_parquet(input_path) as pf:
+        row_groups = len(pf.row_groups)
+        logger.info(f"Cleaning {row_groups} row groups of: {input_path}")
+        if workers <= 1:
+            for chunk in iter_stage("read", pf.iter_row_groups()):
+                with stage("clean", len(chunk)):
+                    chunk = clean_orders_raw(chunk, inplace=True, compact=compact)
+                writer.write(chunk)
+                logger.info(f"Cleaned {writer.rows} rows")
+            return writer.rows
+
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=_init_worker, initargs=(input_path,)
+    ) as executor:
+        # row groups are read and cleaned by the workers meanwhile
+        cleaned = _iter_cleaned(executor, row_groups, workers, compact)
+        for chunk in iter_stage("clean", cleaned):
+            writer.write(chunk)
+            logger.info(f"Cleaned {writer.rows} rows")
+    return writer.rows
@@ -0,0 +1,152 @@
+"""Profiling of CLI commands (see the option `--profile`): the command runs
+under cProfile, and the time, rows and peak memory of its stages (e.g. reading,
+cleaning and writing chunks, building and executing queries) are summed up.
+Stages are no-ops unless a profile is running, so that they can stay in code
+paths of the API.
+"""
+import cProfile
+import sys
+import time
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Sized, TypeVar, Union
+
+
+try:
+    import resource
+except ImportError:  # not Unix
+    resource = None
+
+
+# Stages of the data pipeline and of queries, in the order of the summary
+STAGES = ["read", "clean", "write", "build query", "execute"]
+
+T = TypeVar("T", bound=Sized)
+
+
+def get_peak_memory() -> int:
+    """Returns the peak resident memory (bytes) of this process or of any of
+    its finished child processes (e.g. workers of `clean_file`), or `0` if
+    unknown (not Unix).
+    """
+    if resource is None:
+        return 0
+    peak = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+@dataclass
+class StageStats:
+    calls: int = 0
+    seconds: float = 0.0
+    rows: int = 0
+    # peak memory of the process at the end of the stage, which only grows
+    peak_memory: int = 0
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.seconds if self.seconds > 0 else 0.0
+
+
+class Profiler:
+    def __init__(self):
+        self.profile = cProfile.Profile()
+        self.stages: Dict[str, StageStats] = {}
+
+    def record(self, name: str, seconds: float, rows: int):
+        stats = self.stages.setdefault(name, StageStats())
+        stats.calls += 1
+        stats.seconds += seconds
+        stats.rows += rows
+        stats.peak_memory = max(stats.peak_memory, get_peak_memory())
+
+    def summary(self) -> List[str]:
+        """Returns the lines of a table of the stages, known ones first"""
+        names = sorted(
+            self.stages, key=lambda n: (STAGES.index(n) if n in STAGES else 99, n)
+        )
+        lines = [
+            f"{'stage':<12} {'calls':>8} {'seconds':>10} {'rows':>12} "
+            f"{'rows/s':>12} {'peak MiB':>10}"
+        ]
+        for name in names:
+            stats = self.stages[name]
+            lines.append(
+                f"{name:<12} {stats.calls:>8} {stats.seconds:>10.3f} "
+                f"{stats.rows:>12} {stats.rows_per_second:>12.0f} "
+                f"{stats.peak_memory / 2**20:>10.1f}"
+            )
+        return lines
+
+
+# Profiler of the running command, if profiled
+_profiler: Optional[Profiler] = None
+
+
+@contextmanager
+def profile(path: Union[str, Path]) -> Iterator[Profiler]:
+    """Profiles the code run in this context with cProfile, and saves the
+    stats to `path` when done (to be read with `pstats`, or rendered as a
+    flame graph with e.g. `flameprof` or `snakeviz`). Stages (see `stage`)
+    are recorded meanwhile.
+    """
+    global _profiler
+    if _profiler is not None:
+        raise ValueError("Already profiling")
+    profiler = Profiler()
+    _profiler = profiler
+    profiler.profile.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.profile.disable()
+        _profiler = None
+        profiler.profile.dump_stats(str(path))
+
+
+class _Stage:
+    def __init__(self, profiler: Profiler, name: str, rows: int):
+        self._profiler = profiler
+        self._name = name
+        self._rows = rows
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self._started
+        self._profiler.record(self._name, elapsed, self._rows)
+
+
+def stage(name: str, rows: int = 0):
+    """Returns a context manager recording its duration as the stage `name`
+    processing `rows` rows, if profiling.
+    """
+    if _profiler is None:
+        return nullcontext()
+    return _Stage(_profiler, name, rows)
+
+
+def iter_stage(name: str, chunks: Iterable[T]) -> Iterator[T]:
+    """Returns an iterator over `chunks` recording the time taken to get each
+    chunk (e.g. to read it) as the stage `name`, if profiling.
+    """
+    if _profiler is None:
+        return iter(chunks)
+    return _iter_stage(_profiler, name, iter(chunks))
+
+
+def _iter_stage(profiler: Profiler, name: str, chunks: Iterator[T]) -> Iterator[T]:
+    while True:
+        started = time.perf_counter()
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            return
+        profiler.record(name, time.perf_counter() - started, len(chunk))
+        yield chunk
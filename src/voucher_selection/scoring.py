@@ -0,0 +1,168 @@
+"""Offline scoring of many voucher requests, without running the HTTP API."""
+import logging
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from pathlib import Path
+from typing import Deque, Iterator, Optional, Union
+
+import pandas as pd
+
+from .data_cleaning import ChunkWriter, open_parquet
+from .profiling import iter_stage
+from .server.api import PATTERN_SEGMENT_INTERVAL
+from .server.config import DBConfig
+from .server.db import DBManager, VoucherSelectionParameters, get_db, open_db
+from .server.db_embedded import EmbeddedDBManager
+from .server.index import VoucherIndex
+
+
+logger = logging.getLogger()
+
+INPUT_COLUMNS = [
+    "customer_id",
+    "country_code",
+    "frequency_segment",
+    "recency_segment",
+]
+KEY_COLUMNS = [
+    "country_code",
+    "total_orders_from",
+    "total_orders_to",
+    "last_order_from",
+    "last_order_to",
+]
+
+VoucherSource = Union[VoucherIndex, DBManager, EmbeddedDBManager]
+
+# Per-process state of the workers, set by `_init_worker`
+_source: Optional[VoucherSource] = None
+
+
+def iter_inputs(path: Union[str, Path], chunksize: int) -> Iterator[pd.DataFrame]:
+    """Reads inputs of `/voucher` from a file in parquet (by row groups)
+    or JSON lines format (by `chunksize` rows) with columns `INPUT_COLUMNS`.
+    """
+    path = Path(path)
+    if path.suffix == ".parquet":
+        with open_parquet(path) as pf:
+            columns = [col for col in INPUT_COLUMNS if col in pf.columns]
+            for chunk in pf.iter_row_groups(columns=columns):
+                yield chunk.reindex(columns=INPUT_COLUMNS)
+    else:
+        with pd.read_json(path, lines=True, chunksize=chunksize, dtype=False) as f:
+            for chunk in f:
+                yield chunk.reindex(columns=INPUT_COLUMNS)
+
+
+def _parse_segments(values: pd.Series, name: str) -> pd.DataFrame:
+    """Vectorized `parse_segment_interval`, ignoring empty values"""
+    present = values.notna() & (values.astype(str) != "")
+    parsed = values[present].astype(str).str.extract(PATTERN_SEGMENT_INTERVAL)
+    invalid = parsed[0].isna()
+    if invalid.any():
+        rows = list(parsed.index[invalid][:10])
+        raise ValueError(f"Invalid {name} in rows {rows}: {values[rows].tolist()}")
+    return parsed.astype("int64").reindex(values.index, fill_value=0)
+
+
+def to_parameter_keys(inputs: pd.DataFrame) -> pd.DataFrame:
+    """Returns `VoucherSelectionParameters.to_segment_key` of each input, as
+    columns `KEY_COLUMNS`, so that identical parameter sets compare equal.
+    """
+    keys = pd.DataFrame(index=inputs.index)
+    country_code = inputs["country_code"]
+    keys["country_code"] = country_code.where(country_code.astype(bool), "")
+    keys["country_code"] = keys["country_code"].fillna("").astype(str)
+    for prefix, column in [
+        ("total_orders", "frequency_segment"),
+        ("last_order", "recency_segment"),
+    ]:
+        segments = _parse_segments(inputs[column], column)
+        applied = (segments[0] != 0) & (segments[1] != 0)
+        keys[f"{prefix}_from"] = segments[0].where(applied, 0)
+        keys[f"{prefix}_to"] = segments[1].where(applied, 0)
+    return keys
+
+
+def _init_worker(dataset: Optional[Union[str, Path]], db_config: Optional[DBConfig]):
+    global _source
+    if dataset is not None:
+        _source = VoucherIndex.from_file(dataset)
+    else:
+        _source = open_db(db_config)
+
+
+def score_chunk(
+    inputs: pd.DataFrame, source: Optional[VoucherSource] = None
+) -> pd.DataFrame:
+    """Returns `customer_id` and `voucher_amount` of each input. Identical
+    parameter sets are computed once for the whole chunk.
+    """
+    source = source or _source
+    keys = to_parameter_keys(inputs)
+    unique = keys.drop_duplicates().reset_index(drop=True)
+    params_list = [
+        VoucherSelectionParameters(row[0] or None, *(int(v) or None for v in row[1:]))
+        for row in unique.itertuples(index=False)
+    ]
+    unique["voucher_amount"] = pd.array(
+        source.get_voucher_amounts(params_list), dtype="Int64"
+    )
+    scores = keys.merge(unique, on=KEY_COLUMNS, how="left")
+    return pd.DataFrame(
+        {
+            "customer_id": inputs["customer_id"].to_numpy(),
+            "voucher_amount": scores["voucher_amount"].to_numpy(),
+        }
+    )
+
+
+def _score_chunks(
+    chunks: Iterator[pd.DataFrame], writer: ChunkWriter, source: VoucherSource
+):
+    for chunk in chunks:
+        writer.write(score_chunk(chunk, source))
+        logger.info(f"Scored {writer.rows} inputs")
+
+
+def score_file(
+    input_path: Union[str, Path],
+    output_path: Union[str, Path],
+    dataset: Optional[Union[str, Path]] = None,
+    db_config: Optional[DBConfig] = None,
+    chunksize: int = 100000,
+    workers: int = 1,
+) -> int:
+    """Scores inputs of `input_path` chunk by chunk against a cleaned `dataset`
+    file or the DB (see `iter_inputs`), and writes them to `output_path` (csv or
+    parquet) in the same order. With `workers > 1`, chunks are scored by a pool
+    of processes, each loading the dataset (or connecting to the DB) once.
+    Returns the number of scored inputs.
+    """
+    if (dataset is None) == (db_config is None):
+        raise ValueError("Expected exactly one of: dataset, db_config")
+    writer = ChunkWriter(output_path)
+    chunks = iter_stage("read", iter_inputs(input_path, chunksize))
+
+    if workers <= 1:
+        if dataset is not None:
+            _score_chunks(chunks, writer, VoucherIndex.from_file(dataset))
+        else:
+            with get_db(db_config) as db:
+                _score_chunks(chunks, writer, db)
+        return writer.rows
+
+    # keep a bounded number of chunks in flight, so that memory stays flat
+    pending: Deque[Future] = deque()
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=_init_worker, initargs=(dataset, db_config)
+    ) as executor:
+        for chunk in chunks:
+            pending.append(executor.submit(score_chunk, chunk))
+            if len(pending) >= 2 * workers:
+                writer.write(pending.popleft().result())
+                logger.info(f"Scored {writer.rows} inputs")
+        while pending:
+            writer.write(pending.popleft().result())
+            logger.info(f"Scored {writer.rows} inputs")
+    return writer.rows
@@ -1,24 +1,46 @@
+import asyncio
+import hmac
+import json
 import logging
+import os
 import re
-from typing import Optional, Tuple
+import signal
+import time
+from typing import Callable, Iterator, List, Optional, Set, Tuple
 
 import pydantic
-from fastapi import Depends, FastAPI, HTTPException, status
-from fastapi.responses import JSONResponse
+from fastapi import Depends, FastAPI, Header, HTTPException, Request, Response, status
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from psycopg2.extensions import connection as Connection
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
-from .config import DBConfig
+from .cache import VoucherCache
+from .config import DBConfig, ServerConfig, create_db_config, create_server_config
 from .db import (
-    DBManager,
+    ConnectionPool,
+    SingleConnectionPool,
     VoucherSelectionParameters,
-    get_connection,
-    get_db_by_connection,
+    create_pool,
+    open_db,
+)
+from .index import VoucherIndex
+from .metrics import REQUEST_DURATION, expose_metrics, format_metric, request_timings
+from .selectors import (
+    AsyncPoolVoucherSelector,
+    CachedVoucherSelector,
+    CoalescingVoucherSelector,
+    EmbeddedVoucherSelector,
+    IndexVoucherSelector,
+    PoolVoucherSelector,
+    VoucherSelector,
 )
 
 
 logger = logging.getLogger("api")
 
 PATTERN_SEGMENT_INTERVAL = re.compile(r"^(\d+)-(\d+)$")
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+METRICS_MEDIA_TYPE = "text/plain; version=0.0.4"
 
 
 class CustomerInput(pydantic.BaseModel):
@@ -70,34 +92,313 @@ def _build_voucher_selection_params(input: CustomerInput) -> VoucherSelectionPar
     )
 
 
-def get_api(db_config: DBConfig) -> FastAPI:
+def _parse_batch(body: bytes, ndjson: bool) -> List[CustomerInput]:
+    """Parse a list of inputs: either a JSON array or JSON lines (NDJSON).
+    Raise `ValueError` if failed to parse.
+    """
+    if ndjson:
+        items = [json.loads(line) for line in body.splitlines() if line.strip()]
+    else:
+        items = json.loads(body)
+        if not isinstance(items, list):
+            raise ValueError("Expected a JSON array of inputs")
+    return [CustomerInput.parse_obj(item) for item in items]
+
+
+def _stream_batch(
+    inputs: List[CustomerInput], vouchers: List[Optional[int]], ndjson: bool
+) -> Iterator[str]:
+    if not ndjson:
+        yield "["
+    for i, (input, voucher) in enumerate(zip(inputs, vouchers)):
+        item = json.dumps({"customer_id": input.customer_id, "voucher_amount": voucher})
+        if ndjson:
+            yield f"{item}\n"
+        else:
+            yield f",{item}" if i else item
+    if not ndjson:
+        yield "]"
+
+
+class MeasureRequestsMiddleware:
+    """Observes the duration of HTTP requests by route (`REQUEST_DURATION`),
+    until the response is sent, and with `timing_headers`, tells where the time
+    went in a `Server-Timing` header. A pure ASGI middleware, which only wraps
+    `send`: unlike `@api.middleware("http")`, the app runs in the same task and
+    its response is not streamed through another one.
+    """
+
+    def __init__(self, app: ASGIApp, routes: Set[str], timing_headers: bool = False):
+        self.app = app
+        self.routes = routes
+        self.timing_headers = timing_headers
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status_code = 500
+        with request_timings() as timings:
+            started = time.perf_counter()
+
+            async def send_measured(message: Message):
+                nonlocal status_code
+                if message["type"] == "http.response.start":
+                    status_code = message["status"]
+                    if self.timing_headers:
+                        timings["total"] = time.perf_counter() - started
+                        header = ", ".join(
+                            f"{name};dur={seconds * 1000:.3f}"
+                            for name, seconds in timings.items()
+                        )
+                        headers = [*message.get("headers", [])]
+                        headers.append((b"server-timing", header.encode("latin-1")))
+                        message = {**message, "headers": headers}
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_measured)
+            finally:
+                elapsed = time.perf_counter() - started
+                # unknown paths are grouped, to bound the number of label values
+                route = scope["path"] if scope["path"] in self.routes else "other"
+                REQUEST_DURATION.observe(
+                    elapsed, method=scope["method"], route=route, status=status_code
+                )
+
+
+def get_api(
+    db_config: DBConfig,
+    server_config: Optional[ServerConfig] = None,
+    supervisor_pid: Optional[int] = None,
+) -> FastAPI:
     """Creates a `FastAPI` object which defines an HTTP server then.
     Normally, this object should be implemented as a static singletone
     which then can be imported in other files, but this reduces our flexibility
     to configure the server from CLI (typer, argparse, etc.).
+    See `get_api_by_selector` for `supervisor_pid`.
     """
-    conn = get_connection(db_config)
-    return get_api_by_connection(conn)
+    server_config = server_config or ServerConfig()
+    selector = _create_selector(db_config, server_config)
+    cache = None
+    if server_config.cache_size:
+        cache = VoucherCache(server_config.cache_size, ttl=server_config.cache_ttl)
+    reload_signal = getattr(signal, "SIGHUP", None)
+    return get_api_by_selector(
+        selector,
+        cache=cache,
+        reload_signal=reload_signal,
+        timing_headers=server_config.timing_headers,
+        coalesce=server_config.coalesce,
+        supervisor_pid=supervisor_pid if reload_signal else None,
+        admin_token=server_config.admin_token,
+    )
+
+
+def create_api() -> FastAPI:
+    """Creates the API configured by environment variables (see
+    `create_db_config` and `create_server_config`). Used as the app factory of
+    each server process, which then connects to the DB on startup.
+    """
+    return get_api(create_db_config(), create_server_config())
+
+
+def create_worker_api() -> FastAPI:
+    """Same as `create_api`, for each of the several workers started by
+    `api run`: their parent process is the uvicorn supervisor, which restarts
+    all the workers on `POST /reload`.
+    """
+    return get_api(
+        create_db_config(), create_server_config(), supervisor_pid=os.getppid()
+    )
+
+
+def _create_selector(
+    db_config: DBConfig, server_config: ServerConfig
+) -> VoucherSelector:
+    if server_config.mode == "memory":
+        return IndexVoucherSelector(lambda: _load_index(db_config, server_config))
+    if db_config.backend != "postgres":
+        if server_config.mode in ("precomputed", "rollup"):
+            raise ValueError(
+                f"Mode '{server_config.mode}' requires the postgres backend"
+            )
+        return EmbeddedVoucherSelector(db_config)
+    precomputed = server_config.mode == "precomputed"
+    rollup = server_config.mode == "rollup"
+    if db_config.driver == "asyncpg":
+        return AsyncPoolVoucherSelector(
+            db_config, precomputed=precomputed, rollup=rollup
+        )
+    return PoolVoucherSelector(
+        lambda: create_pool(db_config), precomputed=precomputed, rollup=rollup
+    )
+
+
+def _load_index(db_config: DBConfig, server_config: ServerConfig) -> VoucherIndex:
+    if server_config.dataset:
+        return VoucherIndex.from_file(
+            server_config.dataset, compact=server_config.compact
+        )
+    with open_db(db_config, read_only=True) as db:
+        return VoucherIndex.from_db(db)
+
+
+def get_api_by_index(load: Callable[[], VoucherIndex]) -> FastAPI:
+    """Serves all requests from memory, `load` is called on startup."""
+    return get_api_by_selector(IndexVoucherSelector(load))
 
 
 def get_api_by_connection(db_connection: Connection) -> FastAPI:
-    def _get_db():
-        with get_db_by_connection(db_connection) as db:
-            yield db
+    """Serves all requests one by one using a single connection, which is left
+    open on shutdown.
+    """
+    return get_api_by_pool(SingleConnectionPool(db_connection))
+
+
+def get_api_by_pool(
+    pool: ConnectionPool, precomputed: bool = False, rollup: bool = False
+) -> FastAPI:
+    selector = PoolVoucherSelector(lambda: pool, precomputed=precomputed, rollup=rollup)
+    return get_api_by_selector(selector)
+
+
+def get_api_by_selector(
+    selector: VoucherSelector,
+    cache: Optional[VoucherCache] = None,
+    reload_signal: Optional[int] = None,
+    timing_headers: bool = False,
+    coalesce: bool = True,
+    supervisor_pid: Optional[int] = None,
+    admin_token: Optional[str] = None,
+) -> FastAPI:
+    """Serves requests with `selector`, which is reloaded by `POST /reload`
+    (and on `reload_signal` if set, e.g. `SIGHUP`). With `timing_headers`,
+    responses tell where the time went in a `Server-Timing` header. With
+    `coalesce`, concurrent identical requests (missing the cache) share a
+    single query (see `CoalescingVoucherSelector`).
+
+    If set, `supervisor_pid` is the process supervising several workers, of
+    which this one is: a request only reaches one of them, so `POST /reload`
+    sends `SIGHUP` to the supervisor instead, which restarts all the workers
+    one by one (uvicorn>=0.30), each loading the data anew. Otherwise, this
+    process reloads in place.
+
+    Admin routes (`POST /reload`, `POST /cache/invalidate`) require the header
+    `Authorization: Bearer <admin_token>`, and are disabled without
+    `admin_token` (`403 Forbidden`).
+    """
+    coalescer = None
+    # in-memory lookups never wait: there is nothing to share
+    if coalesce and not isinstance(selector, IndexVoucherSelector):
+        selector = coalescer = CoalescingVoucherSelector(selector)
+    if cache is not None:
+        selector = CachedVoucherSelector(selector, cache)
+    reload_lock: Optional[asyncio.Lock] = None
+
+    async def reload():
+        # requests keep being served by the previous data until it is swapped
+        async with reload_lock:
+            logger.info("Reloading voucher selector")
+            await selector.reload()
+            logger.info("Reloaded voucher selector")
+
+    def on_reload_signal():
+        asyncio.ensure_future(reload())
 
     api = FastAPI()
+    routes = set()
+
+    api.add_middleware(
+        MeasureRequestsMiddleware, routes=routes, timing_headers=timing_headers
+    )
+
+    @api.on_event("startup")
+    async def startup():
+        nonlocal reload_lock
+        reload_lock = asyncio.Lock()
+        await selector.startup()
+        if reload_signal is not None:
+            loop = asyncio.get_event_loop()
+            try:
+                loop.add_signal_handler(reload_signal, on_reload_signal)
+            except (NotImplementedError, RuntimeError, ValueError) as e:
+                logger.warning(f"Cannot reload on signal {reload_signal}: {e}")
+
+    @api.on_event("shutdown")
+    async def shutdown():
+        if reload_signal is not None:
+            asyncio.get_event_loop().remove_signal_handler(reload_signal)
+        await selector.shutdown()
+
+    def require_admin(authorization: Optional[str] = Header(None)):
+        if admin_token is None:
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="Admin routes are disabled: no admin token configured",
+            )
+        expected = f"Bearer {admin_token}".encode()
+        if not hmac.compare_digest((authorization or "").encode(), expected):
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Invalid admin token",
+                headers={"WWW-Authenticate": "Bearer"},
+            )
+
+    @api.post("/reload", dependencies=[Depends(require_admin)])
+    async def post_reload():
+        """Reloads the data of the selector, e.g. once the DB table was replaced
+        by `db seed --replace`, and invalidates the cache. With several
+        workers, restarts them all instead (`202 Accepted`).
+        """
+        if supervisor_pid is not None:
+            logger.info(f"Restarting the workers of process {supervisor_pid}")
+            os.kill(supervisor_pid, signal.SIGHUP)
+            return JSONResponse(
+                {"reloaded": False, "restarting": True},
+                status_code=status.HTTP_202_ACCEPTED,
+            )
+        try:
+            await reload()
+        except BaseException as e:
+            detail = f"Reload failed: {e}"
+            logger.exception(detail)
+            raise HTTPException(status_code=500, detail=detail)
+        return {"reloaded": True}
 
     @api.get("/ping")
     def ping():
         return {"ping": "pong"}
 
+    @api.get("/metrics")
+    def get_metrics():
+        """Metrics of this server process in the Prometheus text format"""
+        content = expose_metrics()
+        if cache is not None:
+            content += _expose_cache_metrics(cache)
+        if coalescer is not None:
+            content += _expose_coalescing_metrics(coalescer)
+        return PlainTextResponse(content, media_type=METRICS_MEDIA_TYPE)
+
+    if cache is not None:
+
+        @api.get("/cache")
+        def get_cache():
+            return cache.stats()
+
+        @api.post("/cache/invalidate", dependencies=[Depends(require_admin)])
+        def post_cache_invalidate():
+            cache.invalidate()
+            return cache.stats()
+
     @api.post("/voucher")
-    async def post_voucher(input: CustomerInput, db: DBManager = Depends(_get_db)):
+    async def post_voucher(input: CustomerInput):
         try:
             params = _build_voucher_selection_params(input)
-            voucher = db.get_voucher_amount(params)
+            voucher = await selector.get_voucher_amount(params)
             if voucher is None:
-                return JSONResponse(status_code=status.HTTP_204_NO_CONTENT)
+                # no body: clients would read it as the next response
+                return Response(status_code=status.HTTP_204_NO_CONTENT)
             return {"voucher_amount": voucher}
 
         except BaseException as e:
@@ -105,4 +406,90 @@ def get_api_by_connection(db_connection: Connection) -> FastAPI:
             logger.exception(detail)
             raise HTTPException(status_code=500, detail=detail)
 
+    @api.post("/vouchers/batch")
+    async def post_vouchers_batch(request: Request):
+        """Accepts a JSON array of inputs of `/voucher`, or JSON lines with
+        content type `application/x-ndjson`, and streams back their voucher
+        amounts (`null` if none found) in the same order and format.
+        """
+        content_type = request.headers.get("content-type", "")
+        ndjson = content_type.startswith(NDJSON_MEDIA_TYPE)
+        try:
+            inputs = _parse_batch(await request.body(), ndjson)
+            params_list = [_build_voucher_selection_params(i) for i in inputs]
+        except ValueError as e:
+            raise HTTPException(status_code=422, detail=f"Invalid input: {e}")
+
+        try:
+            # identical parameter sets are computed once
+            unique = {p.to_segment_key(): p.normalized() for p in params_list}
+            found = await selector.get_voucher_amounts(list(unique.values()))
+            by_key = dict(zip(unique, found))
+            vouchers = [by_key[p.to_segment_key()] for p in params_list]
+        except BaseException as e:
+            detail = f"Unexpected error: {e}"
+            logger.exception(detail)
+            raise HTTPException(status_code=500, detail=detail)
+
+        media_type = NDJSON_MEDIA_TYPE if ndjson else "application/json"
+        content = _stream_batch(inputs, vouchers, ndjson)
+        return StreamingResponse(content, media_type=media_type)
+
+    routes.update(route.path for route in api.routes)
     return api
+
+
+def _expose_cache_metrics(cache: VoucherCache) -> str:
+    stats = cache.stats()
+    lookups = stats["hits"] + stats["misses"]
+    return "".join(
+        [
+            format_metric(
+                "voucher_cache_hits_total", "counter", "Cache hits", stats["hits"]
+            ),
+            format_metric(
+                "voucher_cache_misses_total", "counter", "Cache misses", stats["misses"]
+            ),
+            format_metric(
+                "voucher_cache_hit_ratio",
+                "gauge",
+                "Ratio of cache lookups which were hits",
+                stats["hits"] / lookups if lookups else 0.0,
+            ),
+            format_metric(
+                "voucher_cache_evictions_total",
+                "counter",
+                "Cache entries evicted as the cache was full",
+                stats["evictions"],
+            ),
+            format_metric(
+                "voucher_cache_size", "gauge", "Number of cached entries", stats["size"]
+            ),
+        ]
+    )
+
+
+def _expose_coalescing_metrics(coalescer: CoalescingVoucherSelector) -> str:
+    stats = coalescer.stats()
+    return "".join(
+        [
+            format_metric(
+                "voucher_coalesced_queries_total",
+                "counter",
+                "Queries run for requests, each shared by concurrent identical ones",
+                stats["queries"],
+            ),
+            format_metric(
+                "voucher_coalesced_requests_total",
+                "counter",
+                "Requests answered by the query of a concurrent identical request",
+                stats["coalesced"],
+            ),
+            format_metric(
+                "voucher_coalesced_inflight",
+                "gauge",
+                "Queries in flight which requests can join",
+                stats["inflight"],
+            ),
+        ]
+    )
@@ -0,0 +1,91 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+
+logger = logging.getLogger("api")
+
+SECONDS_PER_DAY = 86400
+
+
+class VoucherCache:
+    """Bounded in-process LRU cache of voucher amounts.
+
+    Recency segments are relative to the current date, so entries expire at
+    the next day boundary (UTC, as the DB's `NOW()`), or earlier after `ttl`
+    seconds if set (`0`: only at the day boundary). `None` values (no voucher
+    found) are cached too, so a miss raises `KeyError`.
+    """
+
+    def __init__(
+        self, maxsize: int, ttl: float = 0, clock: Callable[[], float] = time.time
+    ):
+        if maxsize < 1:
+            raise ValueError(f"Invalid cache size: {maxsize}")
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Hashable, Tuple[Any, float]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        # incremented by `invalidate`
+        self.generation = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _expires_at(self, now: float) -> float:
+        next_day = (now // SECONDS_PER_DAY + 1) * SECONDS_PER_DAY
+        return min(next_day, now + self.ttl) if self.ttl else next_day
+
+    def get(self, key: Hashable) -> Any:
+        now = self._clock()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] <= now:
+                del self._entries[key]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                raise KeyError(key)
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key: Hashable, value: Any, generation: Optional[int] = None):
+        """Caches `value`, unless `generation` (the one `value` was computed
+        with) is given and the cache was invalidated since.
+        """
+        now = self._clock()
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._entries[key] = (value, self._expires_at(now))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self):
+        """Drops all entries, e.g. once the dataset was re-seeded"""
+        with self._lock:
+            size = len(self._entries)
+            self._entries.clear()
+            self.generation += 1
+        logger.info(f"Invalidated {size} cached voucher amounts")
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
@@ -1,6 +1,26 @@
 import os
 from dataclasses import dataclass, field
-from typing import Any, Dict
+from typing import Any, Dict, Optional
+
+
+DB_DRIVERS = ("psycopg2", "asyncpg")
+# postgres: PostgreSQL server,
+# duckdb, sqlite: embedded DB file `path` queried in-process (see `db_embedded`)
+DB_BACKENDS = ("postgres", "duckdb", "sqlite")
+# sql: query the DB on each request,
+# precomputed: look up segments precomputed in the DB, query the DB for others,
+# rollup: OR the voucher bitmaps of the rollup table (built by `db seed --rollup`),
+# memory: load the dataset into memory on startup
+SERVER_MODES = ("sql", "precomputed", "rollup", "memory")
+# Number of rows sent to the DB at once when seeding
+SEED_BATCH_SIZE = 100000
+
+
+def _get_bool(env, name: str, default: bool) -> bool:
+    val = env.get(name)
+    if val is None or val == "":
+        return default
+    return str(val).lower() in ("1", "true", "yes")
 
 
 def _get_required(env, name: str):
@@ -14,16 +34,37 @@ def _get_required(env, name: str):
 class ServerConfig:
     host: str = "0.0.0.0"
     port: int = 8080
+    mode: str = "sql"
+    dataset: Optional[str] = None  # "memory" mode: file to load instead of the DB
+    compact: bool = False  # "memory" mode: load the file with compact dtypes
+    cache_size: int = 0  # max number of cached responses, 0: no cache
+    cache_ttl: float = 0  # seconds, 0: entries expire at the end of the day only
+    workers: int = 1  # number of server processes, each with its own pool and cache
+    keep_alive: int = 5  # seconds to keep idle HTTP connections open
+    backlog: int = 2048  # max number of connections waiting to be accepted
+    graceful_timeout: int = 30  # seconds to finish requests on shutdown, 0: no limit
+    timing_headers: bool = False  # add a `Server-Timing` header to responses
+    coalesce: bool = True  # a single query for concurrent identical requests
+    # required by the admin routes (e.g. `POST /reload`), which are disabled if
+    # not set; hide this field from repr
+    admin_token: Optional[str] = field(default=None, repr=False)
 
 
 @dataclass(frozen=True)
 class DBConfig:
-    username: str
-    password: str = field(repr=False)  # hide this field from repr
-    host: str
+    username: str = ""  # required by the "postgres" backend only
+    password: str = field(default="", repr=False)  # hide this field from repr
+    host: str = ""
     port: int = 5432
     database: str = "voucher_selection"
     table: str = "orders"
+    pool_min_size: int = 1
+    pool_max_size: int = 10
+    pool_timeout: float = 30.0  # seconds to wait for a free connection
+    pool_max_uses: int = 0  # recycle a connection after N checkouts, 0: never
+    driver: str = "psycopg2"  # or "asyncpg" to serve the API fully asynchronously
+    backend: str = "postgres"
+    path: Optional[str] = None  # file of the embedded DB backends
 
     @property
     def url(self) -> str:
@@ -35,12 +76,40 @@ def create_server_config(env: Dict[str, Any] = os.environ) -> ServerConfig:
     config = ServerConfig(
         host=env.get("APP_SERVER_HOST", ServerConfig.host),
         port=int(env.get("APP_SERVER_PORT", ServerConfig.port)),
+        mode=env.get("APP_SERVER_MODE", ServerConfig.mode),
+        dataset=env.get("APP_SERVER_DATASET", ServerConfig.dataset),
+        compact=_get_bool(env, "APP_SERVER_COMPACT", ServerConfig.compact),
+        cache_size=int(env.get("APP_SERVER_CACHE_SIZE", ServerConfig.cache_size)),
+        cache_ttl=float(env.get("APP_SERVER_CACHE_TTL", ServerConfig.cache_ttl)),
+        workers=int(env.get("APP_SERVER_WORKERS", ServerConfig.workers)),
+        keep_alive=int(env.get("APP_SERVER_KEEP_ALIVE", ServerConfig.keep_alive)),
+        backlog=int(env.get("APP_SERVER_BACKLOG", ServerConfig.backlog)),
+        graceful_timeout=int(
+            env.get("APP_SERVER_GRACEFUL_TIMEOUT", ServerConfig.graceful_timeout)
+        ),
+        timing_headers=_get_bool(
+            env, "APP_SERVER_TIMING_HEADERS", ServerConfig.timing_headers
+        ),
+        coalesce=_get_bool(env, "APP_SERVER_COALESCE", ServerConfig.coalesce),
+        admin_token=env.get("APP_SERVER_ADMIN_TOKEN") or ServerConfig.admin_token,
     )
+    if config.mode not in SERVER_MODES:
+        raise ValueError(
+            f"Unknown server mode '{config.mode}', expected: {SERVER_MODES}"
+        )
+    if config.workers < 1:
+        raise ValueError(f"Invalid number of workers: {config.workers}")
 
     return config
 
 
 def create_db_config(env: Dict[str, Any] = os.environ) -> DBConfig:
+    backend = env.get("APP_DB_BACKEND") or DBConfig.backend
+    if backend not in DB_BACKENDS:
+        raise ValueError(f"Unknown DB backend '{backend}', expected: {DB_BACKENDS}")
+    if backend != "postgres":
+        return DBConfig(backend=backend, path=_get_required(env, "APP_DB_PATH"))
+
     config = DBConfig(
         username=_get_required(env, "APP_DB_USERNAME"),
         password=_get_required(env, "APP_DB_PASSWORD"),
@@ -48,5 +117,12 @@ def create_db_config(env: Dict[str, Any] = os.environ) -> DBConfig:
         port=int(env.get("APP_DB_PORT", DBConfig.port)),
         database=env.get("APP_DB_DATABASE", DBConfig.database),
         table=env.get("APP_DB_TABLE", DBConfig.table),
+        pool_min_size=int(env.get("APP_DB_POOL_MIN_SIZE", DBConfig.pool_min_size)),
+        pool_max_size=int(env.get("APP_DB_POOL_MAX_SIZE", DBConfig.pool_max_size)),
+        pool_timeout=float(env.get("APP_DB_POOL_TIMEOUT", DBConfig.pool_timeout)),
+        pool_max_uses=int(env.get("APP_DB_POOL_MAX_USES", DBConfig.pool_max_uses)),
+        driver=env.get("APP_DB_DRIVER", DBConfig.driver),
     )
+    if config.driver not in DB_DRIVERS:
+        raise ValueError(f"Unknown DB driver '{config.driver}', expected: {DB_DRIVERS}")
     return config
@@ -1,15 +1,45 @@
+import hashlib
+import io
+import itertools
 import logging
+import re
+import threading
+import time
+from collections import deque
 from contextlib import contextmanager
 from dataclasses import dataclass
+from datetime import datetime
+from itertools import product
 from pathlib import Path
 from textwrap import dedent
-from typing import Optional, Union
+from typing import (
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 
+import numpy as np
+import pandas as pd
 import psycopg2
-from psycopg2.extensions import connection as Connection
+import psycopg2.errors
+import psycopg2.extras
+from psycopg2.extensions import (
+    TRANSACTION_STATUS_IDLE,
+    TRANSACTION_STATUS_UNKNOWN,
+    connection as Connection,
+)
 
-from ..data_cleaning import load_csv
-from .config import DBConfig
+from ..data_cleaning import iter_dataset
+from ..profiling import iter_stage, stage
+from .config import SEED_BATCH_SIZE, DBConfig
+from .metrics import DB_POOL_WAIT, DB_QUERY_DURATION, ROWS_MATCHED
 
 
 logger = logging.getLogger()
@@ -20,7 +50,58 @@ DB_COLUMNS = {
     "first_order_ts": "DATE",
     "total_orders": "INT",
     "voucher_amount": "INT",
+    "row_key": "BIGINT",  # see `to_row_keys`
 }
+# Natural key of an order, and the values which may change for a given key
+ROW_KEY_COLUMNS = ["timestamp", "country_code", "last_order_ts", "first_order_ts"]
+ROW_VALUE_COLUMNS = ["total_orders", "voucher_amount"]
+# Indexes of the orders table (by name suffix) for the columns of the queries'
+# WHERE clause, including `voucher_amount` to answer them by index-only scans
+DB_INDEXES = {
+    "country_idx": (
+        "(country_code, total_orders, last_order_ts) INCLUDE (voucher_amount)"
+    ),
+    "total_orders_idx": "(total_orders, last_order_ts) INCLUDE (voucher_amount)",
+    "last_order_brin": "USING BRIN (last_order_ts)",
+}
+CLUSTER_INDEX = "country_idx"
+# Precomputed voucher amounts, unused constraints are stored as `''` or `0`
+DB_SEGMENTS_KEY = {
+    "country_code": "VARCHAR",
+    "total_orders_from": "INT",
+    "total_orders_to": "INT",
+    "last_order_from": "INT",
+    "last_order_to": "INT",
+}
+Segment = Tuple[Optional[int], Optional[int]]
+# Files loaded incrementally (see `DBManager.upsert_from_file`), by content
+DB_FILES_COLUMNS = {
+    "checksum": "VARCHAR PRIMARY KEY",
+    "path": "VARCHAR",
+    "rows": "INT",
+    "inserted": "INT",
+    "updated": "INT",
+    "loaded_at": "TIMESTAMP",
+}
+ROW_KEY_INDEX = "row_key_idx"
+# Rollup of the orders by the columns of the constraints, with the distinct
+# voucher amounts of each group as a bitmap of codes (see `build_rollup`)
+DB_ROLLUP_KEY = ["country_code", "total_orders", "last_order_ts"]
+ROLLUP_INDEX = "rollup_idx"
+# Partitioned tables have a list partition per country (see `to_partition_name`)
+DB_PARTITION_KEY = "country_code"
+# Maximal number of parameter sets computed by a single query
+BATCH_QUERY_SIZE = 1000
+
+PATTERN_PLACEHOLDER = re.compile(r"%s")
+
+US_PER_DAY = 86400 * 10**6
+# PostgreSQL fails with "timestamp out of range" before 4714-11-24 BC
+MIN_TIMESTAMP_DAY = -2440588
+# Current time and date in UTC (not in the session's time zone), so that
+# recency segments are the same whatever the DB settings, as in the index
+DB_NOW = "(NOW() AT TIME ZONE 'UTC')"
+DB_TODAY = f"{DB_NOW}::DATE"
 
 
 @dataclass
@@ -37,30 +118,349 @@ class VoucherSelectionParameters:
     last_order_from: Optional[str] = None
     last_order_to: Optional[str] = None
 
-    def to_where_clause(self):
-        # TODO: test
-        constraints = []
+    def to_where_clause(self) -> Tuple[str, List[Union[int, str]]]:
+        """Returns the SQL condition of the applied constraints, with `%s`
+        placeholders, and the values to bind to them.
+        """
+        constraints, args = [], []
         if self.country_code:
-            constraints.append(f"country_code = '{self.country_code}'")
+            constraints.append("country_code = %s")
+            args.append(self.country_code)
         if self.last_order_from and self.last_order_to:
             constraints.append(
-                f"last_order_ts >= (NOW() - INTERVAL '{self.last_order_from} days')"
+                f"last_order_ts >= ({DB_NOW} - %s::INT * INTERVAL '1 day')"
             )
             constraints.append(
-                f"last_order_ts <= (NOW() - INTERVAL '{self.last_order_to} days')"
+                f"last_order_ts <= ({DB_NOW} - %s::INT * INTERVAL '1 day')"
             )
+            args += [int(self.last_order_from), int(self.last_order_to)]
         if self.total_orders_from and self.total_orders_to:
-            constraints.append(f"total_orders >= {self.total_orders_from}")
-            constraints.append(f"total_orders <= {self.total_orders_to}")
-        return " AND ".join(constraints)
+            constraints.append("total_orders >= %s")
+            constraints.append("total_orders <= %s")
+            args += [int(self.total_orders_from), int(self.total_orders_to)]
+        return " AND ".join(constraints), args
+
+    def normalized(self) -> "VoucherSelectionParameters":
+        """Returns equivalent parameters where constraints that are not applied
+        (e.g. empty country code or an interval starting at `0`) are `None`.
+        """
+        frequency = bool(self.total_orders_from and self.total_orders_to)
+        recency = bool(self.last_order_from and self.last_order_to)
+        return VoucherSelectionParameters(
+            country_code=self.country_code or None,
+            total_orders_from=self.total_orders_from if frequency else None,
+            total_orders_to=self.total_orders_to if frequency else None,
+            last_order_from=self.last_order_from if recency else None,
+            last_order_to=self.last_order_to if recency else None,
+        )
+
+    def to_last_order_days(self, now: datetime) -> Optional[Tuple[int, int]]:
+        """Returns the first and last days (since epoch) of `last_order_ts`
+        matching the recency segment relative to `now`, as the SQL condition of
+        `to_where_clause` does, or `None` if the segment is not applied.
+        """
+        if not (self.last_order_from and self.last_order_to):
+            return None
+        now_us = int(now.timestamp() * 10**6)
+        lower_us = now_us - int(self.last_order_from) * US_PER_DAY
+        upper_us = now_us - int(self.last_order_to) * US_PER_DAY
+        if min(lower_us, upper_us) < MIN_TIMESTAMP_DAY * US_PER_DAY:
+            raise ValueError("timestamp out of range")
+        # midnight of `day` >= lower_us <=> day >= ceil(lower_us / US_PER_DAY)
+        return -(-lower_us // US_PER_DAY), upper_us // US_PER_DAY
+
+    def to_segment_key(self) -> Tuple[str, int, int, int, int]:
+        """Returns the key of these parameters in the precomputed segments table"""
+        p = self.normalized()
+        return (
+            p.country_code or "",
+            p.total_orders_from or 0,
+            p.total_orders_to or 0,
+            p.last_order_from or 0,
+            p.last_order_to or 0,
+        )
+
+
+def build_voucher_amount_query(
+    table: str, params: VoucherSelectionParameters
+) -> Tuple[str, List[Union[int, str]]]:
+    """Returns the SQL query computing the number and the mean of distinct
+    voucher amounts matching `params` (and the number of matching rows), shared
+    by all DB drivers, and its arguments. The query only depends on which
+    constraints are applied.
+    """
+    where_clause, args = params.to_where_clause()
+    if where_clause:
+        where_clause = f"WHERE {where_clause}"
+    sql = dedent(
+        f"""\
+        SELECT
+            COUNT(DISTINCT(voucher_amount)), AVG(DISTINCT(voucher_amount)), COUNT(*)
+        FROM {table}
+        {where_clause}
+        """
+    )
+    return sql, args
+
+
+def to_voucher_amount(
+    params: VoucherSelectionParameters,
+    count: int,
+    value,
+    rows: int = 0,
+    source: str = "db",
+) -> Optional[int]:
+    """Converts the result of `build_voucher_amount_query` to the voucher amount"""
+    ROWS_MATCHED.observe(rows, source=source)
+    if count == 0:
+        return None
+    value = int(value)
+    logger.info(f"Found {count} distinct voucher values for `{params}`: mean={value}")
+    return value
+
+
+# Conditions of `build_voucher_amounts_query` on the orders `t` matching the
+# parameter set `p`, by constraint: the columns of `p` and their types, and
+# the condition, the same as `VoucherSelectionParameters.to_where_clause`
+BATCH_CONSTRAINTS = {
+    "country_code": (
+        {"country_code": "VARCHAR"},
+        "t.country_code = p.country_code",
+    ),
+    "last_order": (
+        {"last_order_from": "INT", "last_order_to": "INT"},
+        f"t.last_order_ts >= ({DB_NOW} - p.last_order_from * INTERVAL '1 day') "
+        f"AND t.last_order_ts <= ({DB_NOW} - p.last_order_to * INTERVAL '1 day')",
+    ),
+    "total_orders": (
+        {"total_orders_from": "INT", "total_orders_to": "INT"},
+        "t.total_orders >= p.total_orders_from AND t.total_orders <= p.total_orders_to",
+    ),
+}
+
+
+def _to_applied_constraints(params: VoucherSelectionParameters) -> Tuple[str, ...]:
+    p = params.normalized()
+    return tuple(
+        name
+        for name, (columns, _) in BATCH_CONSTRAINTS.items()
+        if all(getattr(p, column) is not None for column in columns)
+    )
+
+
+def build_voucher_amounts_query(
+    table: str, params_list: List[VoucherSelectionParameters]
+) -> Tuple[str, List[Union[int, str]]]:
+    """Returns the SQL query computing the same as `build_voucher_amount_query`
+    for many parameter sets at once, one row per parameter set in the same
+    order (see `to_voucher_amounts`), and its arguments.
+
+    Parameter sets are grouped by the constraints they apply, and the orders
+    of each set are aggregated by a lateral subquery with only these
+    constraints, so that each set is answered by its own index scan (a single
+    join on conditions such as `p.x IS NULL OR t.x = p.x` cannot use indexes).
+    """
+    groups: Dict[Tuple[str, ...], List[int]] = {}
+    for i, params in enumerate(params_list):
+        groups.setdefault(_to_applied_constraints(params), []).append(i)
+
+    selects, args = [], []
+    for constraints, indexes in groups.items():
+        types = {"i": "INT"}
+        for name in constraints:
+            types.update(BATCH_CONSTRAINTS[name][0])
+        row = ", ".join(f"%s::{type_}" for type_ in types.values())
+        values = ", ".join([f"({row})"] * len(indexes))
+        conditions = [BATCH_CONSTRAINTS[name][1] for name in constraints]
+        where_clause = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        selects.append(
+            dedent(
+                f"""\
+                SELECT p.i, r.*
+                FROM (VALUES {values}) AS p ({", ".join(types)})
+                CROSS JOIN LATERAL (
+                    SELECT
+                        COUNT(DISTINCT(t.voucher_amount)),
+                        AVG(DISTINCT(t.voucher_amount)),
+                        COUNT(*)
+                    FROM {table} AS t
+                    {where_clause}
+                ) AS r
+                """
+            )
+        )
+        for i in indexes:
+            p = params_list[i].normalized()
+            args.append(i)
+            for column, type_ in list(types.items())[1:]:
+                value = getattr(p, column)
+                args.append(int(value) if type_ == "INT" else value)
+    return "UNION ALL\n".join(selects) + "ORDER BY 1\n", args
+
+
+def to_voucher_amounts(rows: Iterable[tuple]) -> List[Optional[int]]:
+    """Converts the result of `build_voucher_amounts_query` to voucher amounts"""
+    values = []
+    for _, count, value, matched in rows:
+        ROWS_MATCHED.observe(matched, source="db")
+        values.append(int(value) if count else None)
+    return values
+
+
+def build_precomputed_voucher_amount_query(segments_table: str) -> str:
+    """Returns the SQL query looking up the voucher amount precomputed today
+    by the segment key (see `VoucherSelectionParameters.to_segment_key`).
+    """
+    key = " AND ".join(f"{column} = %s" for column in DB_SEGMENTS_KEY)
+    return dedent(
+        f"""\
+        SELECT voucher_amount
+        FROM {segments_table}
+        WHERE {key} AND computed_on = {DB_TODAY}
+        """
+    )
+
+
+def build_rollup_voucher_amount_query(
+    rollup_table: str, amounts_table: str, params: VoucherSelectionParameters
+) -> Tuple[str, List[Union[int, str]]]:
+    """Returns the same query as `build_voucher_amount_query` on the rollup
+    (see `DBManager.build_rollup`): the bitmaps of the matching groups are
+    OR'ed, and the amounts of the set bits are counted and averaged. Returns
+    the number of matching orders (with an amount) instead of rows.
+    """
+    where_clause, args = params.to_where_clause()
+    if where_clause:
+        where_clause = f"WHERE {where_clause}"
+    sql = dedent(
+        f"""\
+        SELECT COUNT(a.voucher_amount), AVG(a.voucher_amount), MAX(r.orders)
+        FROM (
+            SELECT BIT_OR(vouchers) AS vouchers, SUM(orders) AS orders
+            FROM {rollup_table}
+            {where_clause}
+        ) AS r
+        JOIN {amounts_table} AS a ON GET_BIT(r.vouchers, a.code) = 1
+        """
+    )
+    return sql, args
+
+
+def to_row_keys(chunk: pd.DataFrame) -> np.ndarray:
+    """Returns 64-bit hashes of the natural keys (`ROW_KEY_COLUMNS`) of the
+    rows of a dataset chunk, with timestamps at full precision (the table only
+    stores their dates). Timestamps are normalized, so that the keys are the
+    same whether the chunk was read from a csv or a parquet file.
+    """
+    key = pd.DataFrame(index=range(len(chunk)))
+    for col in ROW_KEY_COLUMNS:
+        values = chunk[col]
+        if col == "country_code":
+            key[col] = values.fillna("").astype(str).to_numpy()
+        else:
+            key[col] = pd.DatetimeIndex(pd.to_datetime(values, utc=True)).asi8
+    # deterministic: the same rows have the same keys across processes
+    hashes = pd.util.hash_pandas_object(key, index=False).to_numpy()
+    return hashes.view(np.int64)
+
+
+def with_row_keys(chunk: pd.DataFrame) -> pd.DataFrame:
+    """Returns the chunk with columns `DB_COLUMNS`, including its row keys"""
+    return chunk.assign(row_key=to_row_keys(chunk))[list(DB_COLUMNS)]
+
+
+def build_upsert_query(table: str, source: str) -> str:
+    """Returns the SQL query inserting the rows of the table `source` into
+    `table`, or updating the values of the rows already there (by `row_key`)
+    if they changed. Returns the keys of the inserted or updated rows.
+    """
+    columns = ", ".join(DB_COLUMNS)
+    updates = ", ".join(f"{col} = EXCLUDED.{col}" for col in ROW_VALUE_COLUMNS)
+    changed = " OR ".join(
+        f"{table}.{col} IS DISTINCT FROM EXCLUDED.{col}" for col in ROW_VALUE_COLUMNS
+    )
+    # `WHERE true`: SQLite would parse `ON CONFLICT` as a join constraint
+    return dedent(
+        f"""\
+        INSERT INTO {table} ({columns})
+        SELECT {columns} FROM {source} WHERE true
+        ON CONFLICT (row_key) DO UPDATE SET {updates}
+        WHERE {changed}
+        RETURNING row_key
+        """
+    )
+
+
+def to_partition_name(table: str, country_code: Optional[str]) -> str:
+    """Returns the name of the partition of `table` for `country_code`, or of
+    its default partition (for NULL countries) if `None`: a slug of the country
+    made unique by a hash of it, short enough for an identifier.
+    """
+    if country_code is None:
+        return f"{table}_p_default"
+    slug = re.sub(r"[^a-z0-9]+", "_", country_code.lower()).strip("_")[:20]
+    digest = hashlib.md5(country_code.encode()).hexdigest()[:6]
+    return f"{table}_p_{slug}_{digest}"
+
+
+def file_checksum(path: Union[str, Path]) -> str:
+    """Returns the SHA-256 of the content of a file, to recognize files
+    already loaded whatever their name.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+@dataclass(frozen=True)
+class UpsertResult:
+    """Rows of a file loaded incrementally (see `DBManager.upsert_from_file`)"""
+
+    rows: int = 0  # rows of the file, repeated ones counted once per batch
+    inserted: int = 0  # new rows
+    updated: int = 0  # existing rows with changed values
+    skipped: bool = False  # the file was already loaded
+
+
+def to_numbered_placeholders(sql: str) -> str:
+    """Converts `psycopg2` placeholders `%s` to server-side ones: `$1`, `$2`, ..."""
+    counter = itertools.count(1)
+    return PATTERN_PLACEHOLDER.sub(lambda _: f"${next(counter)}", sql)
+
+
+class PreparingConnection(Connection):
+    """Connection which keeps track of the statements prepared in its session
+    (see `DBManager.execute_prepared`): query text => statement name.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared: Dict[str, str] = {}
 
 
 def get_connection(config: DBConfig):
-    return psycopg2.connect(config.url)
+    return psycopg2.connect(config.url, connection_factory=PreparingConnection)
+
+
+def open_db(
+    db_config: DBConfig, table: str = "voucher_selection", read_only: bool = False
+):
+    """Connects to the DB of `db_config`, a PostgreSQL server (`DBManager`)
+    or an embedded DB file (`db_embedded.EmbeddedDBManager`), opened
+    `read_only` so that several processes can read it.
+    """
+    if db_config.backend != "postgres":
+        # imported here, as it builds on this module
+        from .db_embedded import get_embedded_db
+
+        return get_embedded_db(db_config, table=table, read_only=read_only)
+    return DBManager(get_connection(db_config), table=table)
 
 
 def get_db(db_config: DBConfig):
-    return get_db_by_connection(get_connection(db_config))
+    return open_db(db_config)
 
 
 @contextmanager
@@ -69,10 +469,205 @@ def get_db_by_connection(db_connection):
         yield db
 
 
+class ConnectionPool:
+    """Thread-safe bounded pool of database connections.
+
+    - min_size: number of connections opened upfront
+    - max_size: maximal number of connections open at the same time
+    - timeout: seconds `acquire` waits for a free connection before failing
+    - max_uses: a connection is closed and replaced after serving that many
+      checkouts (`0`: never recycle)
+    - ping_after: connections idle for longer than that (seconds) are checked
+      with `SELECT 1` on checkout, broken ones are replaced transparently
+    """
+
+    def __init__(
+        self,
+        connect: Callable[[], Connection],
+        min_size: int = 1,
+        max_size: int = 10,
+        timeout: float = 30.0,
+        max_uses: int = 0,
+        ping_after: float = 5.0,
+    ):
+        if max_size < 1 or not 0 <= min_size <= max_size:
+            raise ValueError(
+                f"Invalid pool size: min_size={min_size}, max_size={max_size}"
+            )
+        self._connect = connect
+        self._max_size = max_size
+        self._timeout = timeout
+        self._max_uses = max_uses
+        self._ping_after = ping_after
+
+        self._cond = threading.Condition()
+        self._idle: Deque[Tuple[Connection, float]] = deque()
+        self._uses: Dict[int, int] = {}
+        self._size = 0
+        self._closed = False
+
+        for _ in range(min_size):
+            self._size += 1
+            self._idle.append((self._open(), time.monotonic()))
+
+    @property
+    def size(self) -> int:
+        """Number of open connections, both idle and checked out"""
+        return self._size
+
+    @property
+    def idle(self) -> int:
+        return len(self._idle)
+
+    def _open(self) -> Connection:
+        conn = self._connect()
+        self._uses[id(conn)] = 0
+        return conn
+
+    def _discard(self, conn: Connection):
+        self._uses.pop(id(conn), None)
+        try:
+            conn.close()
+        except psycopg2.Error:
+            logger.exception("Failed to close a pooled connection")
+
+    def _is_healthy(self, conn: Connection, idle_since: float) -> bool:
+        if conn.closed:
+            return False
+        if time.monotonic() - idle_since < self._ping_after:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            logger.warning("Discarding a broken pooled connection")
+            return False
+
+    def acquire(self) -> Connection:
+        """Check out a connection, waiting at most `timeout` seconds for it.
+        Raise `TimeoutError` if the pool stays exhausted.
+        """
+        deadline = time.monotonic() + self._timeout
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise RuntimeError("Connection pool is closed")
+                if self._idle:
+                    conn, idle_since = self._idle.pop()
+                    break
+                if self._size < self._max_size:
+                    self._size += 1
+                    conn, idle_since = None, 0.0
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(
+                        f"No free connection within {self._timeout}s "
+                        f"(pool max_size={self._max_size})"
+                    )
+                self._cond.wait(remaining)
+
+        try:
+            if conn is not None and not self._is_healthy(conn, idle_since):
+                self._discard(conn)
+                conn = None
+            if conn is None:
+                conn = self._open()
+        except BaseException:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+        self._uses[id(conn)] += 1
+        return conn
+
+    def release(self, conn: Connection):
+        """Return a connection to the pool, rolling back any open transaction."""
+        status = conn.get_transaction_status() if not conn.closed else None
+        broken = status in (None, TRANSACTION_STATUS_UNKNOWN)
+        if not broken and status != TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
+        exhausted = self._max_uses and self._uses[id(conn)] >= self._max_uses
+
+        if broken or exhausted or self._closed:
+            self._discard(conn)
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+        else:
+            with self._cond:
+                self._idle.append((conn, time.monotonic()))
+                self._cond.notify()
+
+    @contextmanager
+    def connection(self) -> Iterator[Connection]:
+        with DB_POOL_WAIT.time(timing="pool"):
+            conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        """Close idle connections, the checked out ones are closed on release."""
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, deque()
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for conn, _ in idle:
+            self._discard(conn)
+
+
+class SingleConnectionPool(ConnectionPool):
+    """Pool of a single connection owned by the caller (e.g. by tests), which
+    it neither closes nor replaces: once the connection is closed, checkouts
+    fail instead of reconnecting.
+    """
+
+    def __init__(self, conn: Connection, timeout: float = 30.0):
+        self._conn = conn
+        super().__init__(self._reuse, min_size=1, max_size=1, timeout=timeout)
+
+    def _reuse(self) -> Connection:
+        if self._conn.closed:
+            raise psycopg2.InterfaceError("The pooled connection is closed")
+        return self._conn
+
+    def _discard(self, conn: Connection):
+        # the connection is closed by its owner
+        self._uses.pop(id(conn), None)
+
+
+def create_pool(config: DBConfig) -> ConnectionPool:
+    return ConnectionPool(
+        lambda: get_connection(config),
+        min_size=config.pool_min_size,
+        max_size=config.pool_max_size,
+        timeout=config.pool_timeout,
+        max_uses=config.pool_max_uses,
+    )
+
+
+@contextmanager
+def get_db_by_pool(pool: ConnectionPool) -> Iterator["DBManager"]:
+    """Yields a `DBManager` on a pooled connection, which is returned
+    to the pool (not closed) afterwards.
+    """
+    with pool.connection() as conn:
+        yield DBManager(conn=conn)
+
+
 class DBManager:
-    def __init__(self, conn: Connection):
+    def __init__(self, conn: Connection, table: str = "voucher_selection"):
         self._conn = conn
-        self._table = "voucher_selection"
+        self._table = table
 
     def __enter__(self):
         return self
@@ -84,15 +679,191 @@ class DBManager:
     def table(self) -> str:
         return self._table
 
+    @property
+    def segments_table(self) -> str:
+        return f"{self._table}_segments"
+
+    @property
+    def files_table(self) -> str:
+        return f"{self._table}_files"
+
+    @property
+    def rollup_table(self) -> str:
+        return f"{self._table}_rollup"
+
+    @property
+    def rollup_amounts_table(self) -> str:
+        return f"{self._table}_rollup_amounts"
+
     def get_cursor(self) -> Connection:
         return self._conn.cursor()
 
-    def create_table(self):
+    def execute_prepared(self, cur, sql: str, args: List[Union[int, str]]):
+        """Executes `sql` with `args` as a server-side prepared statement, which
+        is parsed and planned once per connection rather than on every call.
+        Connections not created by `get_connection` execute it directly.
+        """
+        prepared = getattr(self._conn, "prepared", None)
+        if prepared is None:
+            cur.execute(sql, args)
+            return
+        name = prepared.get(sql)
+        if name is None:
+            name = f"{self.table}_{len(prepared)}"
+            # not transactional: stays prepared even if rolled back
+            cur.execute(f"PREPARE {name} AS {to_numbered_placeholders(sql)}")
+            prepared[sql] = name
+        placeholders = ", ".join(["%s"] * len(args))
+        cur.execute(
+            f"EXECUTE {name} ({placeholders})" if args else f"EXECUTE {name}", args
+        )
+
+    def create_table(self, partitioned: bool = False):
+        """Creates the table if it does not exist, optionally partitioned by
+        country (see `insert_from_file`). The primary key of a partitioned table
+        would have to include the country, so it has none.
+        """
         columns = ", ".join(f"{k} {v}" for k, v in DB_COLUMNS.items())
+        if partitioned:
+            sql = dedent(
+                f"""\
+                CREATE TABLE IF NOT EXISTS {self.table} (
+                    id serial, {columns}
+                ) PARTITION BY LIST ({DB_PARTITION_KEY})
+                """
+            )
+        else:
+            sql = dedent(
+                f"""\
+                CREATE TABLE IF NOT EXISTS {self.table} (
+                    id serial PRIMARY KEY, {columns}
+                )
+                """
+            )
+        with self._conn.cursor() as cur:
+            cur.execute(sql)
+            # tables created before row keys were introduced
+            cur.execute(
+                f"ALTER TABLE {self.table} ADD COLUMN IF NOT EXISTS row_key BIGINT"
+            )
+            self._conn.commit()
+
+    def drop_table(self):
+        with self._conn.cursor() as cur:
+            cur.execute(f"DROP TABLE IF EXISTS {self.table}")
+            self._conn.commit()
+
+    def is_partitioned(self) -> bool:
+        with self._conn.cursor() as cur:
+            cur.execute(
+                "SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass(%s)",
+                (self.table,),
+            )
+            row = cur.fetchone()
+        return row is not None and row[0]
+
+    def _create_partitions(self, cur, countries: Iterable[Optional[str]]):
+        for country in countries:
+            name = to_partition_name(self.table, country)
+            if country is None:
+                cur.execute(
+                    f"CREATE TABLE IF NOT EXISTS {name} "
+                    f"PARTITION OF {self.table} DEFAULT"
+                )
+            else:
+                cur.execute(
+                    f"CREATE TABLE IF NOT EXISTS {name} "
+                    f"PARTITION OF {self.table} FOR VALUES IN (%s)",
+                    (country,),
+                )
+
+    def _get_partition_names(self, cur) -> List[str]:
+        cur.execute(
+            "SELECT inhrelid::regclass::text FROM pg_inherits "
+            "WHERE inhparent = to_regclass(%s) ORDER BY 1",
+            (self.table,),
+        )
+        return [name for name, in cur.fetchall()]
+
+    def get_partitions(self) -> Dict[Optional[str], str]:
+        """Returns the names of the non-empty partitions of the table by country
+        (`None` for the default partition). Partitions are only created for the
+        countries of loaded rows, so each holds a single one.
+        """
+        partitions = {}
+        with self._conn.cursor() as cur:
+            for name in self._get_partition_names(cur):
+                cur.execute(f"SELECT {DB_PARTITION_KEY} FROM {name} LIMIT 1")
+                row = cur.fetchone()
+                if row is not None:
+                    partitions[row[0]] = name
+        return partitions
+
+    def create_indexes(self):
+        with self._conn.cursor() as cur:
+            for name, definition in DB_INDEXES.items():
+                cur.execute(
+                    f"CREATE INDEX IF NOT EXISTS {self.table}_{name} "
+                    f"ON {self.table} {definition}"
+                )
+            self._conn.commit()
+
+    def _execute_autocommit(self, sql: str):
+        """Executes statements which cannot run inside a transaction block"""
+        self._conn.commit()
+        autocommit = self._conn.autocommit
+        self._conn.autocommit = True
+        try:
+            with self._conn.cursor() as cur:
+                cur.execute(sql)
+        finally:
+            self._conn.autocommit = autocommit
+
+    def analyze(self):
+        """Updates the planner statistics and the visibility map of the table,
+        which index-only scans rely on.
+        """
+        logger.info(f"Analyzing table: {self.table}")
+        self._execute_autocommit(f"VACUUM (ANALYZE) {self.table}")
+        if self.has_rollup():
+            self._execute_autocommit(f"VACUUM (ANALYZE) {self.rollup_table}")
+
+    def cluster(self):
+        """Physically orders the table by country (and frequency), so that
+        the rows of a query are read from few pages.
+        """
+        logger.info(f"Clustering table: {self.table}")
+        with self._conn.cursor() as cur:
+            cur.execute(f"CLUSTER {self.table} USING {self.table}_{CLUSTER_INDEX}")
+            self._conn.commit()
+
+    def get_index_usage(self) -> List[Dict[str, Union[str, int]]]:
+        """Returns the number of scans and the size of the table (sequential
+        scans) and of each of its indexes, since the statistics were reset.
+        """
+        sql = dedent(
+            """            SELECT relname, seq_scan, pg_relation_size(relid)
+            FROM pg_stat_user_tables WHERE relname = %(table)s
+            UNION ALL
+            SELECT indexrelname, idx_scan, pg_relation_size(indexrelid)
+            FROM pg_stat_user_indexes WHERE relname = %(table)s
+            ORDER BY 1
+            """
+        )
+        with self._conn.cursor() as cur:
+            cur.execute(sql, {"table": self.table})
+            rows = cur.fetchall()
+        return [
+            {"name": name, "scans": scans, "size": size} for name, scans, size in rows
+        ]
+
+    def create_segments_table(self):
+        columns = ", ".join(f"{k} {v} NOT NULL" for k, v in DB_SEGMENTS_KEY.items())
         sql = dedent(
             f"""\
-            CREATE TABLE IF NOT EXISTS {self.table} (
-                id serial PRIMARY KEY, {columns}
+            CREATE TABLE IF NOT EXISTS {self.segments_table} (
+                {columns}, voucher_amount INT, computed_on DATE NOT NULL,
+                PRIMARY KEY ({", ".join(DB_SEGMENTS_KEY)})
             )
             """
         )
@@ -100,55 +871,548 @@ class DBManager:
             cur.execute(sql)
             self._conn.commit()
 
-    def insert_from_csv(self, csv_path: Union[str, Path]):
-        df = load_csv(csv_path)
-        self.create_table()
-        size = df.shape[0]
-
-        columns = ", ".join(DB_COLUMNS)
+    def create_files_table(self):
+        columns = ", ".join(f"{k} {v}" for k, v in DB_FILES_COLUMNS.items())
         with self._conn.cursor() as cur:
-            logger.info(f"Building the query of {size} rows")
-            values = [tupl[1] for tupl in df.iterrows()]
-            values = [tuple(str(v) for v in row) for row in values]
-            values_template = ",".join(["%s"] * len(values))
-            sql = dedent(
-                f"""\
-                INSERT INTO {self.table} ({columns})
-                VALUES {values_template}
-                """
-            )
-            logger.info(f"Executing the query")
-            cur.execute(sql, values)
+            cur.execute(f"CREATE TABLE IF NOT EXISTS {self.files_table} ({columns})")
             self._conn.commit()
 
-        logger.info(f"Successfully inserted {size} rows from {csv_path}")
+    def get_loaded_files(self) -> List[Dict[str, Union[str, int, datetime]]]:
+        """Returns the files loaded incrementally, oldest first"""
+        self.create_files_table()
+        with self._conn.cursor() as cur:
+            cur.execute(f"SELECT {', '.join(DB_FILES_COLUMNS)} FROM {self.files_table}")
+            rows = cur.fetchall()
+        files = [dict(zip(DB_FILES_COLUMNS, row)) for row in rows]
+        return sorted(files, key=lambda file: file["loaded_at"])
 
-    def get_voucher_amount(
+    def _record_file(self, cur, checksum: str, path: Union[str, Path], result):
+        cur.execute(
+            f"INSERT INTO {self.files_table} ({', '.join(DB_FILES_COLUMNS)}) "
+            "VALUES (%s, %s, %s, %s, %s, CURRENT_TIMESTAMP)",
+            (checksum, str(path), result.rows, result.inserted, result.updated),
+        )
+
+    def get_segments(self) -> Tuple[List[Segment], List[Segment]]:
+        """Returns frequency and recency segments that are precomputed"""
+        self.create_segments_table()
+        segments = []
+        for columns in [
+            "total_orders_from, total_orders_to",
+            "last_order_from, last_order_to",
+        ]:
+            with self._conn.cursor() as cur:
+                sql = f"SELECT DISTINCT {columns} FROM {self.segments_table}"
+                cur.execute(f"{sql} ORDER BY 1, 2")
+                segments.append([(a or None, b or None) for a, b in cur.fetchall()])
+        return segments[0], segments[1]
+
+    def precompute_segments(
         self,
-        params: VoucherSelectionParameters,
-    ):
-        where_clause = params.to_where_clause()
-        if where_clause:
-            where_clause = f"WHERE {where_clause}"
+        frequency_segments: Iterable[Segment],
+        recency_segments: Iterable[Segment],
+    ) -> int:
+        """(Re-)computes voucher amounts of all combinations of the segments,
+        including no segment, for every country and for all countries together.
+        Recency segments are relative to the current date, so that the result
+        is valid only today (see `get_precomputed_voucher_amount`).
+        """
+        self.create_segments_table()
         with self._conn.cursor() as cur:
+            sql = f"SELECT DISTINCT country_code FROM {self.table}"
+            cur.execute(f"{sql} WHERE country_code IS NOT NULL")
+            countries = [""] + [row[0] for row in cur.fetchall()]
+
+        frequencies = {(None, None), *frequency_segments}
+        recencies = {(None, None), *recency_segments}
+        values = {}
+        for (tof, tot), (lof, lot) in product(frequencies, recencies):
+            params = VoucherSelectionParameters(None, tof, tot, lof, lot)
+            key = params.to_segment_key()[1:]
+            if (countries[0], *key) in values:
+                continue  # same as another segment once normalized
+            for country_code in countries:
+                values[(country_code, *key)] = None
+
+            where_clause, args = params.to_where_clause()
+            where_clause = f"WHERE {where_clause}" if where_clause else ""
             sql = dedent(
                 f"""\
                 SELECT
+                    GROUPING(country_code), country_code,
                     COUNT(DISTINCT(voucher_amount)), AVG(DISTINCT(voucher_amount))
                 FROM {self.table}
                 {where_clause}
+                GROUP BY ROLLUP (country_code)
                 """
             )
-            cur.execute(sql)
+            with self._conn.cursor() as cur:
+                cur.execute(sql, args)
+                for total, country_code, count, value in cur.fetchall():
+                    if total:
+                        country_code = ""
+                    elif country_code is None:
+                        continue
+                    values[(country_code, *key)] = int(value) if count else None
+
+        columns = ", ".join([*DB_SEGMENTS_KEY, "voucher_amount", "computed_on"])
+        rows = [(*key, value) for key, value in values.items()]
+        with self._conn.cursor() as cur:
+            cur.execute(f"DELETE FROM {self.segments_table}")
+            psycopg2.extras.execute_values(
+                cur,
+                f"INSERT INTO {self.segments_table} ({columns}) VALUES %s",
+                rows,
+                template=f"(%s, %s, %s, %s, %s, %s, {DB_TODAY})",
+            )
+            self._conn.commit()
+        logger.info(f"Precomputed {len(rows)} segments in {self.segments_table}")
+        return len(rows)
+
+    def has_rollup(self) -> bool:
+        with self._conn.cursor() as cur:
+            cur.execute("SELECT to_regclass(%s)", (self.rollup_table,))
+            return cur.fetchone()[0] is not None
+
+    def _build_rollup(self, cur):
+        """Builds the rollup of the table in new tables, then swaps them in
+        within the transaction of `cur` (see `build_rollup`).
+        """
+        amounts, rollup = (
+            f"{self.rollup_amounts_table}_new",
+            f"{self.rollup_table}_new",
+        )
+        key = ", ".join(DB_ROLLUP_KEY)
+        cur.execute(f"DROP TABLE IF EXISTS {amounts}, {rollup}")
+        cur.execute(
+            dedent(
+                f"""\
+                CREATE TABLE {amounts} AS
+                SELECT
+                    (ROW_NUMBER() OVER (ORDER BY voucher_amount) - 1)::INT AS code,
+                    voucher_amount
+                FROM (
+                    SELECT DISTINCT voucher_amount FROM {self.table}
+                    WHERE voucher_amount IS NOT NULL
+                ) AS v
+                """
+            )
+        )
+        cur.execute(f"SELECT COUNT(*) FROM {amounts}")
+        size = cur.fetchone()[0]
+        cur.execute(
+            dedent(
+                f"""\
+                CREATE TABLE {rollup} AS
+                SELECT
+                    {key},
+                    BIT_OR(SET_BIT(REPEAT('0', %s)::VARBIT, a.code, 1)) AS vouchers,
+                    COUNT(*)::INT AS orders
+                FROM {self.table} AS t JOIN {amounts} AS a USING (voucher_amount)
+                GROUP BY {key}
+                """
+            ),
+            (size,),
+        )
+        cur.execute(
+            f"CREATE INDEX {rollup}_idx ON {rollup} ({key}) INCLUDE (vouchers, orders)"
+        )
+        cur.execute(f"SELECT COUNT(*) FROM {rollup}")
+        groups = cur.fetchone()[0]
+
+        cur.execute(f"DROP TABLE IF EXISTS {self.rollup_amounts_table}")
+        cur.execute(f"DROP TABLE IF EXISTS {self.rollup_table}")
+        cur.execute(f"ALTER TABLE {amounts} RENAME TO {self.rollup_amounts_table}")
+        cur.execute(f"ALTER TABLE {rollup} RENAME TO {self.rollup_table}")
+        cur.execute(f"ALTER INDEX {rollup}_idx RENAME TO {self.table}_{ROLLUP_INDEX}")
+        logger.info(
+            f"Rolled up {self.table} into {groups} groups of {size} voucher amounts"
+        )
+
+    def build_rollup(self):
+        """(Re-)builds the rollup of the table: one row per distinct
+        (`DB_ROLLUP_KEY`) with the set of its voucher amounts as a bitmap over
+        the (few) distinct amounts, so that a query reads a group per country,
+        number of orders and day rather than every order. The previous rollup
+        serves queries until the new one is swapped in.
+        """
+        with self._conn.cursor() as cur:
+            self._build_rollup(cur)
+            self._conn.commit()
+        self._execute_autocommit(f"VACUUM (ANALYZE) {self.rollup_table}")
+
+    def get_rollup_voucher_amount(
+        self, params: VoucherSelectionParameters
+    ) -> Optional[int]:
+        """Same as `get_voucher_amount` from the rollup.
+        Raise `KeyError` if the rollup was not built.
+        """
+        sql, args = build_rollup_voucher_amount_query(
+            self.rollup_table, self.rollup_amounts_table, params
+        )
+        try:
+            with DB_QUERY_DURATION.time(timing="db", query="rollup"):
+                with self._conn.cursor() as cur:
+                    self.execute_prepared(cur, sql, args)
+                    count, value, orders = cur.fetchone()
+        except psycopg2.errors.UndefinedTable:
+            self._conn.rollback()
+            raise KeyError(f"Rollup not built: {self.rollup_table}") from None
+        return to_voucher_amount(params, count, value, orders or 0, source="rollup")
+
+    def get_precomputed_voucher_amount(
+        self, params: VoucherSelectionParameters
+    ) -> Optional[int]:
+        """Looks up the voucher amount precomputed today.
+        Raise `KeyError` if it was not precomputed.
+        """
+        key = params.to_segment_key()
+        sql = build_precomputed_voucher_amount_query(self.segments_table)
+        try:
+            with DB_QUERY_DURATION.time(timing="db", query="precomputed"):
+                with self._conn.cursor() as cur:
+                    self.execute_prepared(cur, sql, list(key))
+                    found = cur.fetchone()
+        except psycopg2.errors.UndefinedTable:
+            self._conn.rollback()
+            found = None
+        if found is None:
+            raise KeyError(f"Segment not precomputed: {key}")
+        return found[0]
+
+    @staticmethod
+    def _copy_chunk(cur, table: str, chunk: pd.DataFrame):
+        with stage("write", len(chunk)):
+            buffer = io.StringIO()
+            chunk.to_csv(buffer, header=False, index=False)
+            buffer.seek(0)
+            cur.copy_expert(
+                f"COPY {table} ({', '.join(chunk.columns)}) FROM STDIN WITH CSV",
+                buffer,
+            )
+
+    def insert_from_file(
+        self,
+        path: Union[str, Path],
+        batch_size: int = SEED_BATCH_SIZE,
+        cluster: bool = False,
+        rollup: bool = False,
+        partitioned: bool = False,
+    ) -> int:
+        """Loads the dataset from a csv or parquet file (see `iter_dataset`) with
+        `COPY`, streaming `batch_size` rows at a time so that memory stays flat.
+        All rows are loaded in a single transaction, with the rollup (see
+        `build_rollup`) if `rollup` or if it was already built. Then creates
+        the indexes (once the rows are loaded, which is faster), optionally
+        clusters the table, and analyzes it. Returns the number of rows.
+
+        If `partitioned` (or if the table already is), the table has a list
+        partition per country, created for the countries of each chunk before
+        it is copied, so that queries by country only scan their partition.
+        """
+        if batch_size < 1:
+            raise ValueError(f"Invalid batch size: {batch_size}")
+        self.create_table(partitioned=partitioned)
+        is_partitioned = self.is_partitioned()
+        if partitioned and not is_partitioned:
+            raise ValueError(f"Table {self.table} is not partitioned, replace it")
+        rollup = rollup or self.has_rollup()
+        partitions: Set[str] = set()
+        size = 0
+        started = time.monotonic()
+        try:
+            with self._conn.cursor() as cur:
+                if is_partitioned:
+                    self._create_partitions(cur, [None])
+                for chunk in iter_stage("read", iter_dataset(path, batch_size)):
+                    if is_partitioned:
+                        countries = set(chunk[DB_PARTITION_KEY].dropna()) - partitions
+                        self._create_partitions(cur, sorted(countries))
+                        partitions |= countries
+                    self._copy_chunk(cur, self.table, with_row_keys(chunk))
+                    size += len(chunk)
+                    elapsed = time.monotonic() - started
+                    logger.info(f"Copied {size} rows in {elapsed:.1f}s")
+                if rollup:
+                    self._build_rollup(cur)
+            self._conn.commit()
+        except Exception:
+            self._conn.rollback()
+            raise
+
+        logger.info(f"Successfully inserted {size} rows from {path}")
+        self.create_indexes()
+        if cluster:
+            self.cluster()
+        self.analyze()
+        return size
+
+    def replace_from_file(
+        self,
+        path: Union[str, Path],
+        batch_size: int = SEED_BATCH_SIZE,
+        cluster: bool = False,
+        rollup: bool = False,
+        partitioned: bool = False,
+    ) -> int:
+        """Loads the dataset into a new staging table (see `insert_from_file`)
+        while the current table keeps serving queries, then swaps it in by
+        renaming it in a single transaction: concurrent queries wait for the
+        swap and read the new table, none fails. The rollup is swapped in the
+        same transaction. Precomputed segments of the old table are dropped in
+        the same transaction, and recomputed from the new one. Returns the
+        number of rows.
+
+        The new table is partitioned if `partitioned` or if the current one is.
+        """
+        staging = DBManager(self._conn, table=f"{self.table}_staging")
+        staging.drop_table()
+        rollup = rollup or self.has_rollup()
+        partitioned = partitioned or self.is_partitioned()
+        size = staging.insert_from_file(
+            path,
+            batch_size=batch_size,
+            cluster=cluster,
+            rollup=rollup,
+            partitioned=partitioned,
+        )
+        frequencies, recencies = self.get_segments()
+        self.create_files_table()
+        checksum = file_checksum(path)
+
+        renames = [
+            f"ALTER INDEX {staging.table}_{name} RENAME TO {self.table}_{name}"
+            for name in [*([] if partitioned else ["pkey"]), *DB_INDEXES]
+        ]
+        with self._conn.cursor() as cur:
+            partitions = staging._get_partition_names(cur)
+            cur.execute(f"DROP TABLE IF EXISTS {self.table}")
+            cur.execute(f"ALTER TABLE {staging.table} RENAME TO {self.table}")
+            for sql in renames:
+                cur.execute(sql)
+            for name in partitions:
+                new_name = name.replace(staging.table, self.table, 1)
+                cur.execute(f"ALTER TABLE {name} RENAME TO {new_name}")
+            cur.execute(
+                f"ALTER SEQUENCE {staging.table}_id_seq RENAME TO {self.table}_id_seq"
+            )
+            if rollup:
+                for name in ["rollup_table", "rollup_amounts_table"]:
+                    cur.execute(f"DROP TABLE IF EXISTS {getattr(self, name)}")
+                    cur.execute(
+                        f"ALTER TABLE {getattr(staging, name)} "
+                        f"RENAME TO {getattr(self, name)}"
+                    )
+                cur.execute(
+                    f"ALTER INDEX {staging.table}_{ROLLUP_INDEX} "
+                    f"RENAME TO {self.table}_{ROLLUP_INDEX}"
+                )
+            cur.execute(f"DELETE FROM {self.segments_table}")
+            # the table now holds the rows of this file only
+            cur.execute(f"DELETE FROM {self.files_table}")
+            self._record_file(cur, checksum, path, UpsertResult(size, size))
+            self._conn.commit()
+        logger.info(f"Swapped table {staging.table} in as {self.table}")
+
+        if frequencies or recencies:
+            self.precompute_segments(frequencies, recencies)
+        return size
+
+    def replace_partitions_from_file(
+        self, path: Union[str, Path], batch_size: int = SEED_BATCH_SIZE
+    ) -> int:
+        """Replaces the rows of the countries of the dataset only, in a
+        partitioned table: loads the dataset into a new partitioned staging
+        table (see `insert_from_file`), then in a single transaction drops the
+        partitions of its countries (and the default one if it has rows without
+        country) and attaches the staging ones instead. Partitions of other
+        countries are kept as is. The rollup is rebuilt in the same transaction,
+        and precomputed segments are recomputed. Returns the number of rows.
+        """
+        if not self.is_partitioned():
+            raise ValueError(f"Table {self.table} is not partitioned")
+        staging = DBManager(self._conn, table=f"{self.table}_staging")
+        staging.drop_table()
+        size = staging.insert_from_file(path, batch_size=batch_size, partitioned=True)
+        partitions = staging.get_partitions()
+        frequencies, recencies = self.get_segments()
+        has_rollup = self.has_rollup()
+
+        try:
+            with self._conn.cursor() as cur:
+                for country, name in partitions.items():
+                    target = to_partition_name(self.table, country)
+                    cur.execute(f"DROP TABLE IF EXISTS {target}")
+                    cur.execute(f"ALTER TABLE {staging.table} DETACH PARTITION {name}")
+                    cur.execute(f"ALTER TABLE {name} RENAME TO {target}")
+                    # instead of the sequence of the staging table, dropped next
+                    cur.execute(
+                        f"ALTER TABLE {target} ALTER COLUMN id "
+                        f"SET DEFAULT nextval('{self.table}_id_seq')"
+                    )
+                    if country is None:
+                        cur.execute(
+                            f"ALTER TABLE {self.table} ATTACH PARTITION {target} "
+                            "DEFAULT"
+                        )
+                    else:
+                        cur.execute(
+                            f"ALTER TABLE {self.table} ATTACH PARTITION {target} "
+                            "FOR VALUES IN (%s)",
+                            (country,),
+                        )
+                if has_rollup:
+                    self._build_rollup(cur)
+                cur.execute(f"DELETE FROM {self.segments_table}")
+                cur.execute(f"DROP TABLE {staging.table}")
+            self._conn.commit()
+        except Exception:
+            self._conn.rollback()
+            raise
+        logger.info(f"Swapped partitions of {len(partitions)} countries in")
+
+        self.analyze()
+        if frequencies or recencies:
+            self.precompute_segments(frequencies, recencies)
+        return size
+
+    def insert_from_csv(
+        self, csv_path: Union[str, Path], batch_size: int = SEED_BATCH_SIZE
+    ) -> int:
+        return self.insert_from_file(csv_path, batch_size=batch_size)
+
+    def _create_row_key_index(self, cur):
+        """Creates the unique index `ON CONFLICT` relies on. Fails if the table
+        has duplicate rows, or rows without keys (seeded before row keys).
+        """
+        cur.execute(f"SELECT 1 FROM {self.table} WHERE row_key IS NULL LIMIT 1")
+        if cur.fetchone() is not None:
+            raise ValueError(
+                f"Table {self.table} has rows without keys, replace it first"
+            )
+        try:
+            cur.execute(
+                f"CREATE UNIQUE INDEX IF NOT EXISTS {self.table}_{ROW_KEY_INDEX} "
+                f"ON {self.table} (row_key)"
+            )
+        except psycopg2.errors.UniqueViolation:
+            raise ValueError(
+                f"Table {self.table} has duplicate rows, replace it first"
+            ) from None
+
+    def upsert_from_file(
+        self,
+        path: Union[str, Path],
+        batch_size: int = SEED_BATCH_SIZE,
+        rollup: bool = False,
+    ) -> UpsertResult:
+        """Loads the dataset from a csv or parquet file incrementally: rows are
+        identified by their natural key (see `to_row_keys`), new ones are
+        inserted, and existing ones updated if their values changed. Files are
+        recorded by checksum in the same transaction, and skipped if already
+        loaded. The rollup is rebuilt in the same transaction (see
+        `insert_from_file`). Then precomputed segments are recomputed.
+        """
+        if batch_size < 1:
+            raise ValueError(f"Invalid batch size: {batch_size}")
+        self.create_table()
+        if self.is_partitioned():
+            # row keys cannot be unique across partitions without the country
+            raise ValueError(
+                f"Table {self.table} is partitioned, "
+                "replace its partitions instead of loading incrementally"
+            )
+        self.create_files_table()
+        has_rollup = self.has_rollup()
+        checksum = file_checksum(path)
+        with self._conn.cursor() as cur:
+            sql = f"SELECT path FROM {self.files_table} WHERE checksum = %s"
+            cur.execute(sql, (checksum,))
             found = cur.fetchone()
-            count, value = found
-            if count == 0:
-                return None
-            value = int(value)
-            logger.info(
-                f"Found {count} distinct voucher values for `{where_clause}`: mean={value}"
-            )
-            return value
+        if found is not None:
+            logger.info(f"Skipping {path}: already loaded from {found[0]}")
+            if rollup and not has_rollup:
+                self.build_rollup()
+            return UpsertResult(skipped=True)
+
+        delta = f"{self.table}_delta"
+        columns = ", ".join(f"{k} {v}" for k, v in DB_COLUMNS.items())
+        upsert = build_upsert_query(self.table, delta)
+        rows = inserted = updated = 0
+        started = time.monotonic()
+        try:
+            with self._conn.cursor() as cur:
+                self._create_row_key_index(cur)
+                cur.execute(f"CREATE TEMP TABLE {delta} ({columns}) ON COMMIT DROP")
+                for chunk in iter_stage("read", iter_dataset(path, batch_size)):
+                    chunk = with_row_keys(chunk)
+                    chunk = chunk.drop_duplicates("row_key", keep="last")
+                    cur.execute(f"TRUNCATE {delta}")
+                    self._copy_chunk(cur, delta, chunk)
+                    cur.execute(
+                        f"SELECT COUNT(*) FROM {delta} JOIN {self.table} USING (row_key)"
+                    )
+                    new = len(chunk) - cur.fetchone()[0]
+                    cur.execute(upsert)
+                    rows += len(chunk)
+                    inserted += new
+                    updated += cur.rowcount - new
+                    elapsed = time.monotonic() - started
+                    logger.info(f"Upserted {rows} rows in {elapsed:.1f}s")
+                result = UpsertResult(rows, inserted, updated)
+                if (has_rollup and (inserted or updated)) or (
+                    rollup and not has_rollup
+                ):
+                    self._build_rollup(cur)
+                self._record_file(cur, checksum, path, result)
+            self._conn.commit()
+        except Exception:
+            self._conn.rollback()
+            raise
+
+        logger.info(
+            f"Successfully loaded {rows} rows from {path}: "
+            f"{inserted} inserted, {updated} updated"
+        )
+        self.create_indexes()
+        self.analyze()
+        frequencies, recencies = self.get_segments()
+        if (inserted or updated) and (frequencies or recencies):
+            self.precompute_segments(frequencies, recencies)
+        return result
+
+    def get_voucher_amounts(
+        self, params_list: List[VoucherSelectionParameters]
+    ) -> List[Optional[int]]:
+        """Same as `get_voucher_amount` for many parameter sets, computed
+        by grouped queries of up to `BATCH_QUERY_SIZE` parameter sets.
+        """
+        values = []
+        for start in range(0, len(params_list), BATCH_QUERY_SIZE):
+            stop = start + BATCH_QUERY_SIZE
+            batch = params_list[start:stop]
+            with stage("build query", len(batch)):
+                sql, args = build_voucher_amounts_query(self.table, batch)
+            with DB_QUERY_DURATION.time(timing="db", query="voucher_amounts"):
+                with self._conn.cursor() as cur, stage("execute", len(batch)):
+                    cur.execute(sql, args)
+                    found = cur.fetchall()
+            values += to_voucher_amounts(found)
+        logger.info(f"Computed voucher amounts of {len(params_list)} parameter sets")
+        return values
+
+    def get_voucher_amount(
+        self,
+        params: VoucherSelectionParameters,
+    ):
+        with self._conn.cursor() as cur:
+            with stage("build query", 1):
+                sql, args = build_voucher_amount_query(self.table, params)
+            with DB_QUERY_DURATION.time(timing="db", query="voucher_amount"):
+                with stage("execute", 1):
+                    self.execute_prepared(cur, sql, args)
+                    found = cur.fetchone()
+            return to_voucher_amount(params, *found)
             # # Or explicitly:
             # logger.debug(f"Result:\n" + "\n".join(str(row) for row in found))
             # vouchers = list({row[-1] for row in found})
@@ -0,0 +1,133 @@
+"""Asynchronous counterpart of `db` based on `asyncpg`, which lets a single
+worker process keep many queries in flight without blocking the event loop.
+"""
+import logging
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, List, Optional
+
+from .config import DBConfig
+from .db import (
+    BATCH_QUERY_SIZE,
+    VoucherSelectionParameters,
+    build_precomputed_voucher_amount_query,
+    build_rollup_voucher_amount_query,
+    build_voucher_amount_query,
+    build_voucher_amounts_query,
+    to_numbered_placeholders,
+    to_voucher_amount,
+    to_voucher_amounts,
+)
+from .metrics import DB_POOL_WAIT, DB_QUERY_DURATION
+
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+
+logger = logging.getLogger()
+
+# `asyncpg` requires a positive number of queries before recycling a connection
+ASYNCPG_DEFAULT_MAX_QUERIES = 50000
+
+
+async def create_async_pool(config: DBConfig) -> "asyncpg.Pool":
+    if asyncpg is None:
+        raise ImportError(
+            "DB driver 'asyncpg' is not installed, "
+            "run: pip install 'voucher_selection[async]'"
+        )
+    return await asyncpg.create_pool(
+        config.url,
+        min_size=config.pool_min_size,
+        max_size=config.pool_max_size,
+        max_queries=config.pool_max_uses or ASYNCPG_DEFAULT_MAX_QUERIES,
+    )
+
+
+@asynccontextmanager
+async def get_async_db_by_pool(
+    pool: "asyncpg.Pool", timeout: Optional[float] = None
+) -> AsyncIterator["AsyncDBManager"]:
+    with DB_POOL_WAIT.time(timing="pool"):
+        conn = await pool.acquire(timeout=timeout)
+    try:
+        yield AsyncDBManager(conn=conn)
+    finally:
+        await pool.release(conn)
+
+
+class AsyncDBManager:
+    def __init__(self, conn: "asyncpg.Connection"):
+        self._conn = conn
+        self._table = "voucher_selection"
+
+    @property
+    def table(self) -> str:
+        return self._table
+
+    @property
+    def segments_table(self) -> str:
+        return f"{self._table}_segments"
+
+    @property
+    def rollup_table(self) -> str:
+        return f"{self._table}_rollup"
+
+    @property
+    def rollup_amounts_table(self) -> str:
+        return f"{self._table}_rollup_amounts"
+
+    async def get_voucher_amount(
+        self, params: VoucherSelectionParameters
+    ) -> Optional[int]:
+        # prepared and cached per connection by `asyncpg`
+        sql, args = build_voucher_amount_query(self.table, params)
+        with DB_QUERY_DURATION.time(timing="db", query="voucher_amount"):
+            found = await self._conn.fetchrow(to_numbered_placeholders(sql), *args)
+        return to_voucher_amount(params, *found)
+
+    async def get_voucher_amounts(
+        self, params_list: List[VoucherSelectionParameters]
+    ) -> List[Optional[int]]:
+        """See `DBManager.get_voucher_amounts`"""
+        values = []
+        for start in range(0, len(params_list), BATCH_QUERY_SIZE):
+            stop = start + BATCH_QUERY_SIZE
+            batch = params_list[start:stop]
+            sql, args = build_voucher_amounts_query(self.table, batch)
+            with DB_QUERY_DURATION.time(timing="db", query="voucher_amounts"):
+                found = await self._conn.fetch(to_numbered_placeholders(sql), *args)
+            values += to_voucher_amounts(found)
+        return values
+
+    async def get_precomputed_voucher_amount(
+        self, params: VoucherSelectionParameters
+    ) -> Optional[int]:
+        """See `DBManager.get_precomputed_voucher_amount`"""
+        key = params.to_segment_key()
+        sql = build_precomputed_voucher_amount_query(self.segments_table)
+        try:
+            with DB_QUERY_DURATION.time(timing="db", query="precomputed"):
+                found = await self._conn.fetchrow(to_numbered_placeholders(sql), *key)
+        except asyncpg.UndefinedTableError:
+            found = None
+        if found is None:
+            raise KeyError(f"Segment not precomputed: {key}")
+        return found[0]
+
+    async def get_rollup_voucher_amount(
+        self, params: VoucherSelectionParameters
+    ) -> Optional[int]:
+        """See `DBManager.get_rollup_voucher_amount`"""
+        sql, args = build_rollup_voucher_amount_query(
+            self.rollup_table, self.rollup_amounts_table, params
+        )
+        try:
+            with DB_QUERY_DURATION.time(timing="db", query="rollup"):
+                found = await self._conn.fetchrow(to_numbered_placeholders(sql), *args)
+        except asyncpg.UndefinedTableError:
+            raise KeyError(f"Rollup not built: {self.rollup_table}") from None
+        count, value, orders = found
+        return to_voucher_amount(params, count, value, orders or 0, source="rollup")
@@ -0,0 +1,427 @@
+"""Embedded counterpart of `db` for single-node deployments and tests: the
+orders table lives in a local DuckDB (columnar) or SQLite file queried
+in-process, so that no DB server is needed and connecting takes milliseconds.
+DuckDB can also query a cleaned parquet (or csv) dataset in place.
+"""
+import logging
+import sqlite3
+import time
+from contextlib import closing, contextmanager
+from datetime import date, datetime, timedelta, timezone
+from pathlib import Path
+from textwrap import dedent
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+import pandas as pd
+
+from ..data_cleaning import iter_dataset
+from ..profiling import iter_stage, stage
+from .config import DBConfig
+from .db import (
+    DB_COLUMNS,
+    DB_FILES_COLUMNS,
+    ROW_KEY_INDEX,
+    SEED_BATCH_SIZE,
+    UpsertResult,
+    VoucherSelectionParameters,
+    build_upsert_query,
+    file_checksum,
+    to_voucher_amount,
+    with_row_keys,
+)
+from .metrics import DB_QUERY_DURATION
+
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+
+logger = logging.getLogger()
+
+EMBEDDED_BACKENDS = ("duckdb", "sqlite")
+# SQLite has no `INCLUDE`: all columns of the queries are in the index keys.
+# DuckDB skips row groups by their min/max values instead of using indexes.
+SQLITE_INDEXES = {
+    "country_idx": "(country_code, total_orders, last_order_ts, voucher_amount)",
+    "total_orders_idx": "(total_orders, last_order_ts, voucher_amount)",
+}
+DATE_COLUMNS = ["timestamp", "last_order_ts", "first_order_ts"]
+EPOCH = date(1970, 1, 1)
+
+Connection = Union["duckdb.DuckDBPyConnection", sqlite3.Connection]
+
+
+def get_embedded_connection(config: DBConfig, read_only: bool = False) -> Connection:
+    """Opens the DB file `config.path`, read-only for the API so that several
+    processes can share it. Transactions are explicit (see `_transaction`).
+    """
+    if config.backend == "duckdb":
+        if duckdb is None:
+            raise ImportError(
+                "DB backend 'duckdb' is not installed, "
+                "run: pip install 'voucher_selection[duckdb]'"
+            )
+        conn = duckdb.connect(config.path, read_only=read_only)
+        # dates of timestamps with time zone, as stored by PostgreSQL
+        conn.execute("SET TimeZone = 'UTC'")
+        return conn
+    if config.backend == "sqlite":
+        if read_only:
+            uri = f"{Path(config.path).resolve().as_uri()}?mode=ro"
+            # may be closed by another thread, see `EmbeddedVoucherSelector`
+            return sqlite3.connect(
+                uri, uri=True, isolation_level=None, check_same_thread=False
+            )
+        conn = sqlite3.connect(config.path, isolation_level=None)
+        # readers keep reading the last committed data while seeding
+        conn.execute("PRAGMA journal_mode = WAL")
+        return conn
+    raise ValueError(f"Not an embedded DB backend: '{config.backend}'")
+
+
+def get_embedded_db(
+    config: DBConfig, table: str = "voucher_selection", read_only: bool = False
+) -> "EmbeddedDBManager":
+    conn = get_embedded_connection(config, read_only=read_only)
+    return EmbeddedDBManager(conn, backend=config.backend, table=table)
+
+
+def _to_dates(values: pd.Series) -> pd.Series:
+    """Dates of timestamps as `YYYY-MM-DD`, like a PostgreSQL `DATE` column"""
+    if pd.api.types.is_datetime64_any_dtype(values.dtype):
+        return values.dt.strftime("%Y-%m-%d")
+    return values.astype(str).str.slice(0, 10)
+
+
+class EmbeddedDBManager:
+    """Same interface as `DBManager` for loading the dataset and querying
+    voucher amounts. Dates are stored as `DATE` (DuckDB) or ISO text (SQLite),
+    and recency segments are bound as dates computed like `VoucherIndex`.
+    """
+
+    def __init__(
+        self, conn: Connection, backend: str, table: str = "voucher_selection"
+    ):
+        self._conn = conn
+        self._backend = backend
+        self._table = table
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.close()
+
+    def close(self):
+        self._conn.close()
+
+    @property
+    def table(self) -> str:
+        return self._table
+
+    @property
+    def files_table(self) -> str:
+        return f"{self._table}_files"
+
+    def get_cursor(self):
+        return closing(self._conn.cursor())
+
+    @contextmanager
+    def _transaction(self) -> Iterator[None]:
+        self._conn.execute("BEGIN")
+        try:
+            yield
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+
+    def create_table(self):
+        columns = ", ".join(f"{k} {v}" for k, v in DB_COLUMNS.items())
+        self._conn.execute(f"CREATE TABLE IF NOT EXISTS {self.table} ({columns})")
+
+    def drop_table(self):
+        # the table may be a view over a file, see `attach_file`
+        kind = self._get_kind()
+        if kind is not None:
+            self._conn.execute(f"DROP {kind} {self.table}")
+
+    def _get_kind(self) -> Optional[str]:
+        if self._backend == "duckdb":
+            sql = (
+                "SELECT table_type FROM information_schema.tables WHERE table_name = ?"
+            )
+        else:
+            sql = "SELECT UPPER(type) FROM sqlite_master WHERE name = ?"
+        found = self._conn.execute(sql, [self.table]).fetchone()
+        if found is None:
+            return None
+        return "VIEW" if found[0] == "VIEW" else "TABLE"
+
+    def create_files_table(self):
+        columns = ", ".join(f"{k} {v}" for k, v in DB_FILES_COLUMNS.items())
+        self._conn.execute(f"CREATE TABLE IF NOT EXISTS {self.files_table} ({columns})")
+
+    def get_loaded_files(self) -> List[Dict[str, Union[str, int, datetime]]]:
+        """Returns the files loaded incrementally, oldest first"""
+        self.create_files_table()
+        sql = f"SELECT {', '.join(DB_FILES_COLUMNS)} FROM {self.files_table}"
+        rows = self._conn.execute(f"{sql} ORDER BY loaded_at").fetchall()
+        return [dict(zip(DB_FILES_COLUMNS, row)) for row in rows]
+
+    def _record_file(self, checksum: str, path: Union[str, Path], result):
+        # SQLite stores timestamps as ISO text
+        loaded_at = datetime.now(timezone.utc).replace(tzinfo=None).isoformat(" ")
+        placeholders = ", ".join(["?"] * len(DB_FILES_COLUMNS))
+        self._conn.execute(
+            f"INSERT INTO {self.files_table} ({', '.join(DB_FILES_COLUMNS)}) "
+            f"VALUES ({placeholders})",
+            [
+                checksum,
+                str(path),
+                result.rows,
+                result.inserted,
+                result.updated,
+                loaded_at,
+            ],
+        )
+
+    def create_indexes(self):
+        if self._backend != "sqlite":
+            return
+        for name, definition in SQLITE_INDEXES.items():
+            self._conn.execute(
+                f"CREATE INDEX IF NOT EXISTS {self.table}_{name} "
+                f"ON {self.table} {definition}"
+            )
+
+    def analyze(self):
+        logger.info(f"Analyzing table: {self.table}")
+        self._conn.execute(f"ANALYZE {self.table}")
+
+    def _insert_chunk(self, chunk: pd.DataFrame, table: Optional[str] = None):
+        table = table or self.table
+        if "row_key" not in chunk.columns:
+            chunk = with_row_keys(chunk)
+        else:
+            chunk = chunk.copy(deep=False)
+        for col in DATE_COLUMNS:
+            chunk[col] = _to_dates(chunk[col])
+        for col in ["total_orders", "voucher_amount"]:
+            chunk[col] = pd.to_numeric(chunk[col]).astype("Int64")
+        columns = ", ".join(DB_COLUMNS)
+        if self._backend == "duckdb":
+            self._conn.register("chunk", chunk)
+            try:
+                self._conn.execute(
+                    f"INSERT INTO {table} ({columns}) SELECT {columns} FROM chunk"
+                )
+            finally:
+                self._conn.unregister("chunk")
+        else:
+            rows = chunk.astype(object).where(chunk.notna(), None)
+            placeholders = ", ".join(["?"] * len(DB_COLUMNS))
+            self._conn.executemany(
+                f"INSERT INTO {table} ({columns}) VALUES ({placeholders})",
+                rows.itertuples(index=False),
+            )
+
+    def insert_from_file(
+        self,
+        path: Union[str, Path],
+        batch_size: int = SEED_BATCH_SIZE,
+        cluster: bool = False,
+        replace: bool = False,
+    ) -> int:
+        """Loads the dataset from a csv or parquet file (see `iter_dataset`)
+        `batch_size` rows at a time, in a single transaction. With `replace`,
+        the previous rows are dropped in the same transaction: readers see
+        either the previous or the new rows. Returns the number of rows.
+        """
+        if batch_size < 1:
+            raise ValueError(f"Invalid batch size: {batch_size}")
+        if cluster:
+            logger.warning(f"Clustering is not supported by {self._backend}")
+        size = 0
+        started = time.monotonic()
+        with self._transaction():
+            if replace:
+                self.drop_table()
+            self.create_table()
+            for chunk in iter_stage("read", iter_dataset(path, batch_size)):
+                with stage("write", len(chunk)):
+                    self._insert_chunk(chunk)
+                size += len(chunk)
+                elapsed = time.monotonic() - started
+                logger.info(f"Inserted {size} rows in {elapsed:.1f}s")
+            self.create_indexes()
+            if replace:
+                # the table now holds the rows of this file only
+                self.create_files_table()
+                self._conn.execute(f"DELETE FROM {self.files_table}")
+                self._record_file(file_checksum(path), path, UpsertResult(size, size))
+        logger.info(f"Successfully inserted {size} rows from {path}")
+        self.analyze()
+        return size
+
+    def replace_from_file(
+        self,
+        path: Union[str, Path],
+        batch_size: int = SEED_BATCH_SIZE,
+        cluster: bool = False,
+    ) -> int:
+        return self.insert_from_file(path, batch_size, cluster=cluster, replace=True)
+
+    def insert_from_csv(
+        self, csv_path: Union[str, Path], batch_size: int = SEED_BATCH_SIZE
+    ) -> int:
+        return self.insert_from_file(csv_path, batch_size=batch_size)
+
+    def upsert_from_file(
+        self, path: Union[str, Path], batch_size: int = SEED_BATCH_SIZE
+    ) -> UpsertResult:
+        """Same as `DBManager.upsert_from_file`, in a single transaction"""
+        if batch_size < 1:
+            raise ValueError(f"Invalid batch size: {batch_size}")
+        if self._get_kind() == "VIEW":
+            raise ValueError(f"Cannot load rows into {self.table}: a file in place")
+        self.create_table()
+        self.create_files_table()
+        checksum = file_checksum(path)
+        sql = f"SELECT path FROM {self.files_table} WHERE checksum = ?"
+        found = self._conn.execute(sql, [checksum]).fetchone()
+        if found is not None:
+            logger.info(f"Skipping {path}: already loaded from {found[0]}")
+            return UpsertResult(skipped=True)
+
+        delta = f"{self.table}_delta"
+        columns = ", ".join(f"{k} {v}" for k, v in DB_COLUMNS.items())
+        upsert = build_upsert_query(self.table, delta)
+        joined = f"SELECT COUNT(*) FROM {delta} JOIN {self.table} USING (row_key)"
+        rows = inserted = updated = 0
+        started = time.monotonic()
+        with self._transaction():
+            self._create_row_key_index()
+            self._conn.execute(f"CREATE TEMP TABLE {delta} ({columns})")
+            try:
+                for chunk in iter_stage("read", iter_dataset(path, batch_size)):
+                    chunk = with_row_keys(chunk)
+                    chunk = chunk.drop_duplicates("row_key", keep="last")
+                    self._conn.execute(f"DELETE FROM {delta}")
+                    with stage("write", len(chunk)):
+                        self._insert_chunk(chunk, table=delta)
+                    new = len(chunk) - self._conn.execute(joined).fetchone()[0]
+                    changed = len(self._conn.execute(upsert).fetchall())
+                    rows += len(chunk)
+                    inserted += new
+                    updated += changed - new
+                    elapsed = time.monotonic() - started
+                    logger.info(f"Upserted {rows} rows in {elapsed:.1f}s")
+            finally:
+                self._conn.execute(f"DROP TABLE IF EXISTS {delta}")
+            self.create_indexes()
+            result = UpsertResult(rows, inserted, updated)
+            self._record_file(checksum, path, result)
+        logger.info(
+            f"Successfully loaded {rows} rows from {path}: "
+            f"{inserted} inserted, {updated} updated"
+        )
+        self.analyze()
+        return result
+
+    def _integrity_errors(self) -> tuple:
+        if self._backend == "duckdb":
+            return (duckdb.IntegrityError,)
+        return (sqlite3.IntegrityError,)
+
+    def _create_row_key_index(self):
+        found = self._conn.execute(
+            f"SELECT 1 FROM {self.table} WHERE row_key IS NULL LIMIT 1"
+        ).fetchone()
+        if found is not None:
+            raise ValueError(
+                f"Table {self.table} has rows without keys, replace it first"
+            )
+        try:
+            self._conn.execute(
+                f"CREATE UNIQUE INDEX IF NOT EXISTS {self.table}_{ROW_KEY_INDEX} "
+                f"ON {self.table} (row_key)"
+            )
+        except self._integrity_errors():
+            raise ValueError(
+                f"Table {self.table} has duplicate rows, replace it first"
+            ) from None
+
+    def attach_file(self, path: Union[str, Path]):
+        """DuckDB only: replaces the table by a view over a cleaned dataset in
+        parquet or csv format, which is then queried in place (not copied).
+        """
+        if self._backend != "duckdb":
+            raise ValueError("Querying files in place requires the duckdb backend")
+        path = Path(path).resolve()
+        reader = "read_parquet" if path.suffix == ".parquet" else "read_csv_auto"
+        quoted = str(path).replace("'", "''")
+        # the view is bound on creation: fails if the file cannot be read
+        with self._transaction():
+            self.drop_table()
+            self._conn.execute(
+                dedent(
+                    f"""\
+                    CREATE VIEW {self.table} AS SELECT
+                        country_code, total_orders, voucher_amount,
+                        CAST(last_order_ts AS DATE) AS last_order_ts
+                    FROM {reader}('{quoted}')
+                    """
+                )
+            )
+        logger.info(f"Querying {path} in place as {self.table}")
+
+    def _build_voucher_amount_query(
+        self, params: VoucherSelectionParameters, now: datetime
+    ) -> Tuple[str, List[Union[int, str]]]:
+        """Same query as `build_voucher_amount_query`, with the recency segment
+        as dates (see `VoucherSelectionParameters.to_last_order_days`).
+        """
+        constraints, args = [], []
+        if params.country_code:
+            constraints.append("country_code = ?")
+            args.append(params.country_code)
+        days = params.to_last_order_days(now)
+        if days is not None:
+            constraints.append("last_order_ts >= ? AND last_order_ts <= ?")
+            args += [(EPOCH + timedelta(days=day)).isoformat() for day in days]
+        if params.total_orders_from and params.total_orders_to:
+            constraints.append("total_orders >= ? AND total_orders <= ?")
+            args += [int(params.total_orders_from), int(params.total_orders_to)]
+        where_clause = f"WHERE {' AND '.join(constraints)}" if constraints else ""
+        sql = dedent(
+            f"""\
+            SELECT
+                COUNT(DISTINCT(voucher_amount)), AVG(DISTINCT(voucher_amount)), COUNT(*)
+            FROM {self.table}
+            {where_clause}
+            """
+        )
+        return sql, args
+
+    def get_voucher_amount(
+        self, params: VoucherSelectionParameters, now: Optional[datetime] = None
+    ) -> Optional[int]:
+        now = now or datetime.now(timezone.utc)
+        with stage("build query", 1):
+            sql, args = self._build_voucher_amount_query(params, now)
+        with DB_QUERY_DURATION.time(timing="db", query="voucher_amount"):
+            with closing(self._conn.cursor()) as cur, stage("execute", 1):
+                found = cur.execute(sql, args).fetchone()
+        return to_voucher_amount(params, *found)
+
+    def get_voucher_amounts(
+        self, params_list: List[VoucherSelectionParameters]
+    ) -> List[Optional[int]]:
+        """Same as `get_voucher_amount` for many parameter sets, one query
+        each: queries are in-process, without round trips to batch.
+        """
+        now = datetime.now(timezone.utc)
+        return [self.get_voucher_amount(params, now=now) for params in params_list]
@@ -0,0 +1,139 @@
+"""In-memory columnar index of the (read-only) orders dataset, which answers
+`DBManager.get_voucher_amount` queries without a database round trip.
+"""
+import logging
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+
+import numpy as np
+import pandas as pd
+
+from ..data_cleaning import load_csv, load_parquet
+from .db import DBManager, VoucherSelectionParameters
+from .metrics import ROWS_MATCHED
+
+
+logger = logging.getLogger()
+
+INDEX_COLUMNS = ["country_code", "total_orders", "last_order_ts", "voucher_amount"]
+
+# Rows with unknown `last_order_ts` never match a recency segment (NULL in SQL)
+NULL_DAY = np.iinfo(np.int32).min
+
+
+@dataclass(frozen=True)
+class _Bucket:
+    """Rows of one country (or of all countries) sorted by `total_orders`"""
+
+    total_orders: np.ndarray
+    last_order_day: np.ndarray  # days since epoch
+    voucher_code: np.ndarray  # position in `VoucherIndex.voucher_amounts`
+
+
+class VoucherIndex:
+    """Rows are bucketed by `country_code` and sorted by `total_orders` within
+    a bucket, so that a frequency segment is a contiguous slice found by binary
+    search, and the recency segment is a vectorized mask over that slice.
+    Voucher amounts are stored as codes into the (small) array of distinct
+    amounts, so that the distinct ones are collected without sorting.
+    """
+
+    def __init__(self, df: pd.DataFrame):
+        df = df[INDEX_COLUMNS]
+        amounts = df["voucher_amount"].to_numpy()
+        valid = ~pd.isna(amounts)
+        df, amounts = df[valid], amounts[valid].astype(np.int64)
+        self.voucher_amounts, voucher_code = np.unique(amounts, return_inverse=True)
+
+        last_order = pd.to_datetime(df["last_order_ts"], utc=True)
+        last_order = last_order.dt.tz_localize(None).to_numpy("datetime64[D]")
+        last_order_day = last_order.astype(np.int64)
+        last_order_day[np.isnat(last_order)] = NULL_DAY
+
+        columns = pd.DataFrame(
+            {
+                "country_code": df["country_code"].to_numpy(),
+                "total_orders": df["total_orders"].to_numpy(np.int64),
+                "last_order_day": last_order_day.astype(np.int32),
+                "voucher_code": voucher_code.astype(np.int32),
+            }
+        ).sort_values("total_orders", kind="stable")
+
+        self._buckets: Dict[Optional[str], _Bucket] = {None: self._bucket(columns)}
+        for country_code, rows in columns.groupby("country_code", sort=False):
+            self._buckets[country_code] = self._bucket(rows)
+        self.size = len(columns)
+        logger.info(
+            f"Indexed {self.size} rows of {len(self._buckets) - 1} countries "
+            f"with {len(self.voucher_amounts)} distinct voucher amounts"
+        )
+
+    @staticmethod
+    def _bucket(rows: pd.DataFrame) -> _Bucket:
+        return _Bucket(
+            total_orders=rows["total_orders"].to_numpy(),
+            last_order_day=rows["last_order_day"].to_numpy(),
+            voucher_code=rows["voucher_code"].to_numpy(),
+        )
+
+    @classmethod
+    def from_file(cls, path: Union[str, Path], compact: bool = False) -> "VoucherIndex":
+        """Loads a cleaned dataset in csv or parquet format, with a compact
+        schema if `compact` (see `compact_dtypes`), which lowers the peak
+        memory of loading large datasets.
+        """
+        if Path(path).suffix == ".parquet":
+            return cls(load_parquet(path, columns=INDEX_COLUMNS, compact=compact))
+        return cls(load_csv(path, compact=compact))
+
+    @classmethod
+    def from_db(cls, db: DBManager) -> "VoucherIndex":
+        logger.info(f"Loading dataset from DB table: {db.table}")
+        with db.get_cursor() as cur:
+            cur.execute(f"SELECT {', '.join(INDEX_COLUMNS)} FROM {db.table}")
+            df = pd.DataFrame(cur.fetchall(), columns=INDEX_COLUMNS)
+        return cls(df)
+
+    def get_voucher_amount(
+        self, params: VoucherSelectionParameters, now: Optional[datetime] = None
+    ) -> Optional[int]:
+        """Same semantics as `DBManager.get_voucher_amount`, including
+        the recency segment being relative to the current time `now`.
+        """
+        recency = params.to_last_order_days(now or datetime.now(timezone.utc))
+
+        bucket = self._buckets.get(params.country_code or None)
+        if bucket is None:
+            return None
+
+        start, stop = 0, len(bucket.total_orders)
+        if params.total_orders_from and params.total_orders_to:
+            orders = bucket.total_orders
+            start = np.searchsorted(orders, params.total_orders_from, side="left")
+            stop = np.searchsorted(orders, params.total_orders_to, side="right")
+        codes = bucket.voucher_code[start:stop]
+
+        if recency:
+            lower_day, upper_day = recency
+            days = bucket.last_order_day[start:stop]
+            codes = codes[(days >= lower_day) & (days <= upper_day)]
+
+        ROWS_MATCHED.observe(len(codes), source="memory")
+        present = np.zeros(len(self.voucher_amounts), dtype=bool)
+        present[codes] = True
+        count = int(present.sum())
+        if count == 0:
+            return None
+        total = int(self.voucher_amounts[present].sum())
+        # truncate towards zero like `int(Decimal)` does for the SQL average
+        value = abs(total) // count * (1 if total >= 0 else -1)
+        logger.debug(f"Found {count} distinct voucher values for `{params}`: {value}")
+        return value
+
+    def get_voucher_amounts(
+        self, params_list: List[VoucherSelectionParameters]
+    ) -> List[Optional[int]]:
+        now = datetime.now(timezone.utc)
+        return [self.get_voucher_amount(params, now=now) for params in params_list]
@@ -0,0 +1,172 @@
+"""In-process metrics of the API, exposed in the Prometheus text format by
+`GET /metrics` (no client library required). Each server process has its own
+metrics: Prometheus aggregates them over the scraped processes.
+"""
+import math
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+
+# Seconds, from a cache hit to a slow query
+DEFAULT_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+ROWS_BUCKETS = (1, 10, 100, 1000, 10000, 100000, 1000000, 10000000)
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{_escape(str(v))}"' for n, v in zip(names, values))
+    return f"{{{pairs}}}"
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def format_metric(name: str, type: str, help: str, value: float) -> str:
+    """Formats a metric without labels, e.g. computed on scrape"""
+    return (
+        f"# HELP {name} {help}\n# TYPE {name} {type}\n"
+        f"{name} {_format_value(value)}\n"
+    )
+
+
+class Histogram:
+    """Cumulative histogram of observed values (e.g. durations in seconds),
+    from which Prometheus computes quantiles such as the p99 latency.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._lock = threading.Lock()
+        # per label values: count of each bucket (not cumulative), sum
+        self._values: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: str):
+        key = tuple(labels[name] for name in self.labels)
+        index = next(i for i, bound in enumerate(self.buckets) if value <= bound)
+        with self._lock:
+            counts, total = self._values.setdefault(
+                key, ([0] * len(self.buckets), [0.0])
+            )
+            counts[index] += 1
+            total[0] += value
+
+    def count(self, **labels: str) -> int:
+        key = tuple(labels[name] for name in self.labels)
+        return sum(self._values[key][0]) if key in self._values else 0
+
+    @contextmanager
+    def time(self, timing: Optional[str] = None, **labels: str) -> Iterator[None]:
+        """Observes the duration of the block, also added to the timing
+        `timing` of the current request (see `request_timings`) if set.
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            self.observe(elapsed, **labels)
+            if timing is not None:
+                add_request_timing(timing, elapsed)
+
+    def expose(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        names = (*self.labels, "le")
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    labels = _format_labels(names, (*key, _format_value(bound)))
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = _format_labels(self.labels, key)
+                lines.append(f"{self.name}_sum{labels} {_format_value(total[0])}")
+                lines.append(f"{self.name}_count{labels} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+
+REQUEST_DURATION = Histogram(
+    "voucher_http_request_duration_seconds",
+    "Duration of HTTP requests by route",
+    labels=("method", "route", "status"),
+)
+DB_QUERY_DURATION = Histogram(
+    "voucher_db_query_duration_seconds",
+    "Duration of DB queries by query",
+    labels=("query",),
+)
+DB_POOL_WAIT = Histogram(
+    "voucher_db_pool_wait_seconds", "Time waited for a free DB connection"
+)
+ROWS_MATCHED = Histogram(
+    "voucher_rows_matched",
+    "Number of orders matching the constraints of a query",
+    labels=("source",),
+    buckets=ROWS_BUCKETS,
+)
+METRICS = [REQUEST_DURATION, DB_QUERY_DURATION, DB_POOL_WAIT, ROWS_MATCHED]
+
+
+def expose_metrics() -> str:
+    return "".join(metric.expose() for metric in METRICS)
+
+
+# Durations (seconds) by name of the request being served, if tracked
+_request_timings: ContextVar[Optional[Dict[str, float]]] = ContextVar(
+    "request_timings", default=None
+)
+
+
+@contextmanager
+def request_timings() -> Iterator[Dict[str, float]]:
+    """Tracks durations of the current request, e.g. for `Server-Timing`.
+    The dict is shared with the threads and tasks the request runs in.
+    """
+    timings: Dict[str, float] = {}
+    token = _request_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _request_timings.reset(token)
+
+
+def add_request_timing(name: str, seconds: float):
+    timings = _request_timings.get()
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + seconds
@@ -0,0 +1,356 @@
+"""Voucher selectors: the objects the HTTP API uses to compute voucher amounts.
+
+All selectors expose the same asynchronous interface, so that the API does not
+depend on whether the underlying DB driver is blocking or not:
+- `startup()` / `shutdown()`: called with the API's event loop running
+- `get_voucher_amount(params)`
+- `get_voucher_amounts(params_list)`: same for many (distinct) parameter sets
+- `reload()`: switches to the current data, while serving requests meanwhile
+"""
+import asyncio
+import logging
+import threading
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+from starlette.concurrency import run_in_threadpool
+
+from .cache import VoucherCache
+from .config import DBConfig
+from .db import ConnectionPool, VoucherSelectionParameters, get_db_by_pool
+from .db_async import create_async_pool, get_async_db_by_pool
+from .db_embedded import EmbeddedDBManager, get_embedded_db
+from .index import VoucherIndex
+
+
+logger = logging.getLogger("api")
+
+
+class PoolVoucherSelector:
+    """Runs blocking `psycopg2` queries on pooled connections in a thread pool.
+    The pool is created by `create_pool` on startup, so that each server
+    process opens its own connections.
+    With `precomputed`, looks up precomputed segments first (see
+    `DBManager.precompute_segments`) and falls back to the ad-hoc query
+    (batches are always computed by a single grouped query). With `rollup`,
+    queries the rollup (see `DBManager.build_rollup`) instead if it is built.
+    """
+
+    def __init__(
+        self,
+        create_pool: Callable[[], ConnectionPool],
+        precomputed: bool = False,
+        rollup: bool = False,
+    ):
+        self._create_pool = create_pool
+        self._precomputed = precomputed
+        self._rollup = rollup
+        self._pool: Optional[ConnectionPool] = None
+
+    async def startup(self):
+        self._pool = await run_in_threadpool(self._create_pool)
+
+    async def shutdown(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+
+    async def reload(self):
+        # the table is swapped atomically by the DB (`DBManager.replace_from_file`)
+        pass
+
+    def _get_voucher_amount(self, params: VoucherSelectionParameters):
+        with get_db_by_pool(self._pool) as db:
+            if self._precomputed:
+                try:
+                    return db.get_precomputed_voucher_amount(params)
+                except KeyError as e:
+                    logger.debug(e)
+            if self._rollup:
+                try:
+                    return db.get_rollup_voucher_amount(params)
+                except KeyError as e:
+                    logger.debug(e)
+            return db.get_voucher_amount(params)
+
+    async def get_voucher_amount(
+        self, params: VoucherSelectionParameters
+    ) -> Optional[int]:
+        return await run_in_threadpool(self._get_voucher_amount, params)
+
+    def _get_voucher_amounts(self, params_list: List[VoucherSelectionParameters]):
+        with get_db_by_pool(self._pool) as db:
+            return db.get_voucher_amounts(params_list)
+
+    async def get_voucher_amounts(
+        self, params_list: List[VoucherSelectionParameters]
+    ) -> List[Optional[int]]:
+        return await run_in_threadpool(self._get_voucher_amounts, params_list)
+
+
+class AsyncPoolVoucherSelector:
+    """Runs queries with `asyncpg` directly on the event loop. The pool is
+    created on startup, as it is bound to the running event loop.
+    See `PoolVoucherSelector` for `precomputed` and `rollup`.
+    """
+
+    def __init__(
+        self, db_config: DBConfig, precomputed: bool = False, rollup: bool = False
+    ):
+        self._db_config = db_config
+        self._precomputed = precomputed
+        self._rollup = rollup
+        self._pool = None
+
+    async def startup(self):
+        self._pool = await create_async_pool(self._db_config)
+
+    async def shutdown(self):
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+
+    async def reload(self):
+        # the table is swapped atomically by the DB, reconnect to drop the
+        # statements cached by `asyncpg` once the connections are released
+        if self._pool is not None:
+            await self._pool.expire_connections()
+
+    async def get_voucher_amount(
+        self, params: VoucherSelectionParameters
+    ) -> Optional[int]:
+        timeout = self._db_config.pool_timeout
+        async with get_async_db_by_pool(self._pool, timeout=timeout) as db:
+            if self._precomputed:
+                try:
+                    return await db.get_precomputed_voucher_amount(params)
+                except KeyError as e:
+                    logger.debug(e)
+            if self._rollup:
+                try:
+                    return await db.get_rollup_voucher_amount(params)
+                except KeyError as e:
+                    logger.debug(e)
+            return await db.get_voucher_amount(params)
+
+    async def get_voucher_amounts(
+        self, params_list: List[VoucherSelectionParameters]
+    ) -> List[Optional[int]]:
+        timeout = self._db_config.pool_timeout
+        async with get_async_db_by_pool(self._pool, timeout=timeout) as db:
+            return await db.get_voucher_amounts(params_list)
+
+
+class EmbeddedVoucherSelector:
+    """Queries an embedded DB file (see `db_embedded`) in a thread pool, with
+    a read-only connection per thread, opened on first use. Reloading makes
+    the threads reconnect, e.g. to a DuckDB file replaced meanwhile.
+    """
+
+    def __init__(self, db_config: DBConfig):
+        self._db_config = db_config
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._dbs: List[EmbeddedDBManager] = []
+
+    def _connect(self) -> EmbeddedDBManager:
+        db = get_embedded_db(self._db_config, read_only=True)
+        with self._lock:
+            self._dbs.append(db)
+        return db
+
+    def _close(self, db: EmbeddedDBManager):
+        with self._lock:
+            if db not in self._dbs:
+                return  # already closed on shutdown
+            self._dbs.remove(db)
+        db.close()
+
+    def _get_db(self) -> EmbeddedDBManager:
+        local = self._local
+        if getattr(local, "generation", None) != self._generation:
+            if getattr(local, "db", None) is not None:
+                self._close(local.db)
+            local.db, local.generation = self._connect(), self._generation
+        return local.db
+
+    async def startup(self):
+        # fail on startup if the DB cannot be opened
+        await run_in_threadpool(self._get_db)
+
+    async def shutdown(self):
+        self._generation += 1
+        with self._lock:
+            dbs, self._dbs = self._dbs, []
+        for db in dbs:
+            db.close()
+
+    async def reload(self):
+        # connections are replaced by the threads when they next query
+        self._generation += 1
+
+    async def get_voucher_amount(
+        self, params: VoucherSelectionParameters
+    ) -> Optional[int]:
+        return await run_in_threadpool(
+            lambda: self._get_db().get_voucher_amount(params)
+        )
+
+    async def get_voucher_amounts(
+        self, params_list: List[VoucherSelectionParameters]
+    ) -> List[Optional[int]]:
+        return await run_in_threadpool(
+            lambda: self._get_db().get_voucher_amounts(params_list)
+        )
+
+
+class IndexVoucherSelector:
+    """Answers from an in-memory `VoucherIndex` built on startup."""
+
+    def __init__(self, load: Callable[[], VoucherIndex]):
+        self._load = load
+        self._index: Optional[VoucherIndex] = None
+
+    async def startup(self):
+        self._index = await run_in_threadpool(self._load)
+
+    async def shutdown(self):
+        self._index = None
+
+    async def reload(self):
+        # requests use the previous index until the new one is loaded
+        self._index = await run_in_threadpool(self._load)
+
+    async def get_voucher_amount(
+        self, params: VoucherSelectionParameters
+    ) -> Optional[int]:
+        return self._index.get_voucher_amount(params)
+
+    async def get_voucher_amounts(
+        self, params_list: List[VoucherSelectionParameters]
+    ) -> List[Optional[int]]:
+        return self._index.get_voucher_amounts(params_list)
+
+
+class CachedVoucherSelector:
+    """Answers from `cache` if possible, otherwise from `selector`. The cache is
+    keyed on the normalized parameters, so that equivalent requests share it.
+    Values computed while the cache was invalidated (e.g. by a reload) are not
+    cached, as they may come from the previous data.
+    """
+
+    def __init__(self, selector: "VoucherSelector", cache: VoucherCache):
+        self._selector = selector
+        self.cache = cache
+
+    async def startup(self):
+        await self._selector.startup()
+
+    async def shutdown(self):
+        await self._selector.shutdown()
+        self.cache.invalidate()
+
+    async def reload(self):
+        await self._selector.reload()
+        self.cache.invalidate()
+
+    async def get_voucher_amount(
+        self, params: VoucherSelectionParameters
+    ) -> Optional[int]:
+        key = params.to_segment_key()
+        try:
+            return self.cache.get(key)
+        except KeyError:
+            pass
+        generation = self.cache.generation
+        value = await self._selector.get_voucher_amount(params)
+        self.cache.set(key, value, generation=generation)
+        return value
+
+    async def get_voucher_amounts(
+        self, params_list: List[VoucherSelectionParameters]
+    ) -> List[Optional[int]]:
+        values, missing = {}, []
+        for params in params_list:
+            key = params.to_segment_key()
+            try:
+                values[key] = self.cache.get(key)
+            except KeyError:
+                missing.append(params)
+        if missing:
+            generation = self.cache.generation
+            found = await self._selector.get_voucher_amounts(missing)
+            for params, value in zip(missing, found):
+                key = params.to_segment_key()
+                self.cache.set(key, value, generation=generation)
+                values[key] = value
+        return [values[params.to_segment_key()] for params in params_list]
+
+
+class CoalescingVoucherSelector:
+    """Runs a single query of `selector` for concurrent requests of the same
+    (normalized) parameters: requests arriving while the query is in flight
+    wait for its result (or error) instead of querying again. The query runs
+    in a task of its own, so that it completes even if the request which
+    started it is cancelled. Requests after a reload do not wait for queries
+    started before it.
+    """
+
+    def __init__(self, selector: "VoucherSelector"):
+        self._selector = selector
+        self._inflight: Dict[Tuple, asyncio.Future] = {}
+        self.queries = 0
+        self.coalesced = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "queries": self.queries,
+            "coalesced": self.coalesced,
+            "inflight": len(self._inflight),
+        }
+
+    async def startup(self):
+        await self._selector.startup()
+
+    async def shutdown(self):
+        await self._selector.shutdown()
+        self._inflight.clear()
+
+    async def reload(self):
+        await self._selector.reload()
+        self._inflight.clear()
+
+    def _forget(self, key: Tuple, task: asyncio.Future):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            task.exception()  # retrieved, even if all requests were cancelled
+
+    async def get_voucher_amount(
+        self, params: VoucherSelectionParameters
+    ) -> Optional[int]:
+        key = params.to_segment_key()
+        task = self._inflight.get(key)
+        if task is None:
+            self.queries += 1
+            task = asyncio.ensure_future(self._selector.get_voucher_amount(params))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._forget(key, task))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    async def get_voucher_amounts(
+        self, params_list: List[VoucherSelectionParameters]
+    ) -> List[Optional[int]]:
+        return await self._selector.get_voucher_amounts(params_list)
+
+
+VoucherSelector = Union[
+    PoolVoucherSelector,
+    AsyncPoolVoucherSelector,
+    EmbeddedVoucherSelector,
+    IndexVoucherSelector,
+    CachedVoucherSelector,
+    CoalescingVoucherSelector,
+]